@@ -26,6 +26,17 @@ def getCSignatures():
         'mt_seed32new': (None, [ctypes.c_uint32])
     }
 
+def getLLVMBitcode():
+    """The LLVM bitcode of mtwist, which Stella links into the compiled code
+    so that mt_drand() can be inlined. None if it was not built, see the
+    Makefile."""
+    import os
+    path = os.path.join(os.path.dirname(__file__), 'mtwist.bc')
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        return f.read()
+
 def mt_drand():
     return c_mt_drand()
 
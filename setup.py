@@ -34,8 +34,14 @@ classifiers = ['Development Status :: 3 - Alpha',
 
 import versioneer
 
+version = versioneer.get_version()
+# stella reads its __version__ from this file instead of running versioneer,
+# which runs git, on every import
+with open(os.path.join(os.path.dirname(__file__), 'stella', '_static_version.py'), 'w') as fh:
+    fh.write("# generated by setup.py\nversion = {!r}\n".format(version))
+
 setup(
-    version=versioneer.get_version(),
+    version=version,
     cmdclass=versioneer.get_cmdclass(),
     name="stella",
     packages=['stella','stella.intrinsics'],
@@ -48,4 +54,7 @@ setup(
     extras_require={
         'test': ['pytest', 'pystache', 'mtpy']
     },
+    entry_points={
+        'console_scripts': ['stella = stella.__main__:main'],
+    },
 )
@@ -12,17 +12,116 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-import logging
+"""
+Stella compiles a subset of Python to native code, see wrap().
+
+Importing stella is cheap and has no side effects: llvmlite and numpy are
+only imported with the first wrap(), and the parts of the package on the
+first call of stella.array(), stella.prange() etc.
+"""
 import faulthandler
+import functools
+import logging
+import os
+import threading
+import types
 
-from . import analysis
-from . import codegen
+from . import exc
+from . import rng  # noqa
 from . import utils
 
-_f = open('faulthandler.err', 'w')
-faulthandler.enable(_f)
 logging.addLevelName(utils.VERBOSE, 'VERBOSE')
 
+# Imported on first use. A module __getattr__ (PEP 562) would need Python
+# 3.7, so these are functions which import their implementation when called.
+
+def array(dtype=float, ndim=1, shape=None):
+    """Declares a numpy array argument, see signature.array."""
+    from .signature import array
+    return array(dtype, ndim, shape)
+
+
+def const(obj):
+    """Mark obj as constant while compiled code runs, see storage.const()."""
+    from .storage import const
+    return const(obj)
+
+
+def prange(start, stop=None, chunk=0, schedule='static'):
+    """Like range(), but compiled code runs the iterations in parallel, see
+    parallel.prange()."""
+    from .parallel import prange
+    return prange(start, stop, chunk, schedule)
+
+
+def soa(objects):
+    """Lay out a list of objects as one array per attribute, see tp.soa()."""
+    from .tp import soa
+    return soa(objects)
+
+
+def resident(obj, static_shape=False):
+    """Keep obj in native memory across calls, see native.resident()."""
+    from .native import resident
+    return resident(obj, static_shape)
+
+
+def ensemble(f, grid=({},), seeds=None, processes=None, retries=0, compile=True,
+             seed_arg='seed', **options):
+    """Run f for many parameters and seeds on a process pool, see
+    sweep.ensemble()."""
+    from .sweep import ensemble
+    return ensemble(f, grid, seeds, processes, retries, compile, seed_arg, **options)
+
+
+try:
+    # written by setup.py
+    from ._static_version import version as __version__
+except ImportError:
+    # a source checkout which was never built, see _version()
+    __version__ = '0+unknown'
+
+_full_version = None
+
+
+def _version():
+    """The version, e.g. for the disk cache. In a source checkout which was
+    never built versioneer has to run git, so this is only done when needed
+    and never on import."""
+    global _full_version
+    if _full_version is None:
+        if __version__ != '0+unknown':
+            _full_version = __version__
+        else:
+            from ._version import get_versions
+            _full_version = get_versions()['version']
+    return _full_version
+
+
+_faulthandler_file = None
+
+
+def enable_faulthandler(path=None):
+    """Dump the Python traceback if the compiled code crashes, into the file
+    path or to stderr.
+
+    Enabled on import if $STELLA_FAULTHANDLER is set to a file name.
+    """
+    global _faulthandler_file
+    if path is None:
+        faulthandler.enable()
+    else:
+        _faulthandler_file = open(path, 'w')
+        faulthandler.enable(_faulthandler_file)
+
+
+if os.environ.get('STELLA_FAULTHANDLER'):
+    enable_faulthandler(os.environ['STELLA_FAULTHANDLER'])
+
+# see wrap(hot=...)
+HOT_CALLS = 1000
+HOT_OPT = 3
+
 
 def logLevel(name='VERBOSE'):
     if name == 'VERBOSE':
@@ -35,7 +134,9 @@ def logLevel(name='VERBOSE'):
             raise AttributeError("Invalid log level {}".format(name))
 
 
-def wrap(f, debug=False, p=False, ir=False, lazy=False, opt=None, stats=None):
+def wrap(f, debug=False, p=False, ir=False, lazy=False, opt=None, stats=None,
+         static_shape=False, cache_dir=None, hot=HOT_CALLS, cpu='', features='',
+         loop_vectorize=False, slp_vectorize=False, unroll=True, fastmath=False):
     """
     Parameters:
         bool debug: increase the log level to DEBUG
@@ -43,41 +144,287 @@ def wrap(f, debug=False, p=False, ir=False, lazy=False, opt=None, stats=None):
         mixed ir:   return the LLVM IR if True, or save to file if a str.
         bool lazy:  construct the Stella representation and return the object without
                     any action.
-        int opt:    specify an optimization level for LLVM (usually 1-4)
-        dict stats: if a dict is passed in, then a detailed split of execution
-                    time will be stored in this parameter
+        int opt:    specify an optimization level for LLVM (usually 1-4). If
+                    None the code is compiled without optimization passes at
+                    first, see hot.
+        mixed stats: if a dict is passed in, then a detailed split of the
+                    time of the last call is stored in it: the compilation
+                    phases and the native call in ns under 'time_ns', sizes
+                    under 'counts', and the native call in s under
+                    'elapsed'. A callable is called with such a dict after
+                    every call, and after background compilations.
+        bool static_shape: compile the shape of numpy arrays into the code.
+                    This allows more optimizations for small arrays of a
+                    fixed size, but a new compilation for every shape.
+        str cache_dir: store the object code in this directory so that other
+                    processes can load it instead of compiling again. Defaults
+                    to $STELLA_CACHE_DIR, the disk cache is disabled if unset.
+        int hot:    if opt is None, recompile at HOT_OPT with vectorization on
+                    a background thread once the compiled code has been called
+                    this many times with the same argument types. The
+                    optimized code replaces the first version when it is
+                    ready. 0 disables this.
+        str cpu:    the LLVM name of the CPU to generate code for. 'host'
+                    selects this machine including all its features, e.g.
+                    AVX2 or AVX-512. The default is a generic CPU.
+        str features: LLVM target features to enable or disable, e.g.
+                    '+avx2,-avx512f'.
+        bool loop_vectorize, slp_vectorize: run the loop and the
+                    superword-level parallelism vectorizers of LLVM.
+        bool unroll: allow LLVM to unroll loops.
+        mixed fastmath: relax the IEEE semantics of floating point
+                    operations. True for all of LLVM's fast-math flags, or a
+                    list of flags, e.g. ['reassoc', 'nnan', 'contract'].
+                    'contract' allows fusing into FMA instructions.
 
     Unless lazy is specified, a callable will be returned which can be executed
     in place of `f'. Lazy returns the generated .codegen.Program object .
+
+    The compiled code is cached per argument type signature, so calling the
+    returned function again with arguments of the same types does not compile
+    again. The cache is available as the `cache' attribute of the returned
+    function, which also has an `invalidate()' method to drop all compiled
+    code, e.g. after changing a function that `f' calls.
+
+    See `stella cache --help' to inspect the disk cache.
     """
 
+    from . import analysis, cache, codegen, signature
+
     if debug:
         logLevel('DEBUG')
 
-    def run(*args, **kwargs):
-        if stats is None:
-            pass_stats = {}
-        else:
-            pass_stats = stats
+    fcache = cache.FunctionCache(getattr(f, '__name__', None))
+    if cache_dir is None:
+        cache_dir = cache.default_cache_dir()
+    if cache_dir:
+        dcache = cache.DiskCache(cache_dir, _version())
+    else:
+        dcache = None
+
+    def callArgs(args):
+        if isinstance(f, types.MethodType):
+            return (f.__self__, ) + args
+        return args
+
+    fastmath = codegen.fastmath_flags(fastmath)
+    tiered = opt is None and hot
+    # everything the generated code depends on besides f and the arguments
+    opt_key = (opt, cpu, features, loop_vectorize, slp_vectorize, unroll, fastmath)
+    hot_opt = (HOT_OPT, cpu, features, True, True, unroll, fastmath)
+    run_tier_workers = {}
+    # Compilations have a context.Context of their own, so different
+    # functions compile concurrently. This only protects the caches of f.
+    lock = threading.RLock()
 
-        module = analysis.main(f, args, kwargs)
-        prog = codegen.Program(module)
+    def compile(args, kwargs, call_stats):
+        module = analysis.main(f, args, kwargs, static_shape, call_stats)
+        prog = codegen.Program(module, cpu=cpu, features=features, fastmath=fastmath)
+        prog.optimize(opt, loop_vectorize, slp_vectorize, unroll)
+        return prog
 
-        prog.optimize(opt)
+    def report(call_stats, background=False):
+        if callable(stats):
+            stats(call_stats)
+        elif stats is not None and not background:
+            stats.clear()
+            stats.update(call_stats)
 
-        if lazy:
+    def load(disk_key):
+        """Returns the program from the disk cache, or None."""
+        entry = dcache.load(disk_key)
+        if entry is None:
+            return None
+        prog = codegen.CachedProgram.load(f, entry)
+        if prog is None:
+            dcache.remove(disk_key)
+        return prog
+
+    def store(key, disk_key, prog):
+        info = disk_key and prog.describe()
+        if info:
+            dcache.store(disk_key, info, prog.emitObject())
+        prog.release()
+        fcache.insert(key, prog)
+
+    def getProgram(args, kwargs, key, call_stats):
+        """Returns the reusable program for key, or a program which can only
+        be run once."""
+        prog = fcache.lookup(key)
+        if prog is not None:
             return prog
-        elif ir is True:
-            return prog.getLlvmIR()
-        elif type(ir) == str:
-            print("Writing LLVM IR to {}...".format(ir))
-            with open(ir, 'w') as fh:
-                fh.write(prog.getLlvmIR())
-            return
-        elif p:
-            print(prog.getLlvmIR())
+
+        if tiered and dcache:
+            hot_key = dcache.key(f, key, hot_opt, static_shape)
+            prog = hot_key and load(hot_key)
+            if prog is not None:
+                prog.tier = 1
+                fcache.insert(key, prog)
+                return prog
+
+        disk_key = dcache and dcache.key(f, key, opt_key, static_shape)
+        if disk_key:
+            prog = load(disk_key)
+            if prog is not None:
+                fcache.insert(key, prog)
+                return prog
+
+        prog = compile(args, kwargs, call_stats)
+        if prog.reusable:
+            store(key, disk_key, prog)
+        return prog
+
+    def tierUp(key, old, args, kwargs):
+        """Recompile the program old for key with all optimizations and swap it
+        in. The calls continue in the meantime with the old program."""
+        worker_stats = {'tier': 1}
+        prog = None
+        try:
+            module = analysis.main(f, args, kwargs, static_shape, worker_stats)
+            disk_key = dcache and dcache.key(f, key, hot_opt, static_shape)
+            # the foreground compilations use LLVM, too
+            with utils.llvm_lock:
+                prog = codegen.Program(module, cpu=cpu, features=features, fastmath=fastmath)
+                prog.optimize(HOT_OPT, loop_vectorize=True, slp_vectorize=True, unroll=unroll)
+                prog.addToEngine()
+                obj = disk_key and prog.emitObject()
+
+            with lock:
+                info = obj and prog.describe()
+                if info:
+                    dcache.store(disk_key, info, obj)
+                prog.release()
+                prog.tier = 1
+                # Only replaces old if it is still the entry of key, otherwise
+                # prog is closed. old is closed once no call runs it anymore.
+                replaced = fcache.replace(key, old, prog)
+                prog = None
+                if replaced:
+                    logging.info("Optimized {} for {}".format(f, key))
+            report(worker_stats, background=True)
+        except Exception:
+            logging.exception("Optimizing {} in the background failed".format(f))
+            if prog is not None:
+                prog.close()
+
+    def countCall(key, prog, args, kwargs):
+        prog.calls += 1
+        worker = run_tier_workers.get(key)
+        if prog.calls == hot and (worker is None or not worker.is_alive()):
+            worker = threading.Thread(target=tierUp, args=(key, prog, args, kwargs),
+                                      name="stella.tierUp({})".format(f.__name__),
+                                      daemon=True)
+            run_tier_workers[key] = worker
+            worker.start()
+
+    def run(*args, **kwargs):
+        if run.compile_thread is not None:
+            # see jit(background=True)
+            run.compile_thread.join()
+        with lock:
+            if lazy or ir or p:
+                prog = compile(args, kwargs, None)
+                if lazy:
+                    return prog
+                elif ir is True:
+                    return prog.getLlvmIR()
+                elif type(ir) == str:
+                    print("Writing LLVM IR to {}...".format(ir))
+                    with open(ir, 'w') as fh:
+                        fh.write(prog.getLlvmIR())
+                    return
+                else:
+                    print(prog.getLlvmIR())
+                    return
+
+        call_stats = {}
+        call_args = callArgs(args)
+        key = cache.signature(call_args, kwargs, static_shape)
+        with lock:
+            prog = getProgram(args, kwargs, key, call_stats)
+            if prog.reusable:
+                if tiered and prog.tier == 0:
+                    countCall(key, prog, args, kwargs)
+                prog.enter()
+
+        # The lock is not held while the code runs, so other threads can
+        # call f concurrently. ctypes releases the GIL during the call.
+        if prog.reusable:
+            try:
+                retval = prog.call(call_args, kwargs, call_stats)
+            finally:
+                prog.leave()
         else:
-            return prog.run(pass_stats)
+            retval = prog.run(call_stats)
+        with lock:
+            report(call_stats)
+        return retval
+
+    def precompile(declared):
+        """Compile for the declared signature, see stella.signature, without
+        calling f."""
+        args = signature.example_args(declared, static_shape)
+        call_stats = {}
+        with lock:
+            key = cache.signature(callArgs(args), {}, static_shape)
+            prog = getProgram(args, {}, key, call_stats)
+            if not prog.reusable:
+                prog.close()
+                raise exc.UnimplementedError(
+                    "{}{} cannot be compiled in advance, because it uses the values of "
+                    "objects stored in globals".format(f, tuple(declared)))
+        report(call_stats, background=True)
+
+    functools.update_wrapper(run, f)
+    run.cache = fcache
+    run.disk_cache = dcache
+    run.invalidate = fcache.invalidate
+    run.precompile = precompile
+    run.tier_workers = run_tier_workers
+    run.compile_thread = None
+    return run
+
+
+def jit(f=None, signatures=(), background=False, **options):
+    """Decorator which compiles f right away for the declared signatures.
+
+    Parameters:
+        list signatures: the argument types to compile for, e.g.
+                    [(int, stella.array(float))], see stella.signature. Only
+                    positional arguments are declared.
+        bool background: compile on a background thread instead of blocking.
+                    Calls wait for the compilation to finish.
+        options:    are passed on to wrap().
+
+    Usage:
+        @stella.jit(signatures=[(int, int), (float, float)])
+        def add(a, b):
+            ...
+    """
+    if f is None:
+        return lambda f: jit(f, signatures, background, **options)
+
+    run = wrap(f, **options)
+    run.__stella_signatures__ = tuple(signatures)
+
+    def precompileAll():
+        for declared in signatures:
+            run.precompile(declared)
+
+    def precompileBackground():
+        try:
+            precompileAll()
+        except Exception:
+            logging.exception("Compiling {} in the background failed".format(f))
+
+    if background:
+        run.compile_thread = threading.Thread(target=precompileBackground,
+                                              name="stella.jit({})".format(f.__name__),
+                                              daemon=True)
+        run.compile_thread.start()
+    else:
+        run.compile_thread = None
+        precompileAll()
     return run
 
 
@@ -96,7 +443,3 @@ def run_tests(args=None):
 # namespace TODO maybe this isn't the best idea? It may be confusing. On the
 # other hand, I don't plan to add more directly to the stella module.
 # from .intrinsics.python import *
-
-from ._version import get_versions
-__version__ = get_versions()['version']
-del get_versions
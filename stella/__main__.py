@@ -0,0 +1,113 @@
+# Copyright 2013-2015 David Mohr
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+The `stella' command.
+"""
+import argparse
+import importlib
+import importlib.util
+import os
+import sys
+import time
+
+from . import cache
+
+
+def cmd_cache(args):
+    path = args.dir or cache.default_cache_dir()
+    if not path:
+        print("No cache directory: set $STELLA_CACHE_DIR or pass --dir", file=sys.stderr)
+        return 1
+    dcache = cache.DiskCache(path)
+
+    if args.action == 'purge':
+        n = len(dcache)
+        dcache.purge()
+        print("Removed {} entries from {}".format(n, path))
+    elif args.action == 'list':
+        for key, size, mtime in dcache.entries():
+            print("{}  {:>10}  {}  {}".format(key[:16], size,
+                                             time.strftime('%Y-%m-%d %H:%M:%S',
+                                                           time.localtime(mtime)),
+                                             dcache.describe(key)))
+    else:
+        entries = dcache.entries()
+        print("Cache directory: {}".format(path))
+        print("Entries:         {} (max {})".format(len(entries), dcache.max_entries))
+        print("Size:            {} bytes (max {})".format(sum(e[1] for e in entries),
+                                                          dcache.max_size))
+    return 0
+
+
+def _importModule(name):
+    if name.endswith('.py'):
+        module_name = os.path.splitext(os.path.basename(name))[0]
+        spec = importlib.util.spec_from_file_location(module_name, name)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[module_name] = module
+        spec.loader.exec_module(module)
+        return module
+    return importlib.import_module(name)
+
+
+def cmd_compile(args):
+    from . import aot
+
+    sys.path.insert(0, os.getcwd())
+    module = _importModule(args.module)
+    exports = [f for f in vars(module).values() if hasattr(f, '__stella_signatures__')]
+    if not exports:
+        print("{} has no functions declared with stella.aot.export()".format(args.module),
+              file=sys.stderr)
+        return 1
+
+    output = args.output or os.path.splitext(os.path.basename(args.module))[0] + '_aot'
+    loader = aot.compile(exports, output, opt=args.opt, static_shape=args.static_shape,
+                         cpu=args.cpu, features=args.features)
+    print("Wrote {}.so and the loader {}".format(output, loader))
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='stella')
+    subparsers = parser.add_subparsers(dest='command')
+
+    p = subparsers.add_parser('cache', help="inspect or purge the on-disk cache of compiled code")
+    p.add_argument('action', nargs='?', choices=['stats', 'list', 'purge'], default='stats')
+    p.add_argument('--dir', help="the cache directory, defaults to $STELLA_CACHE_DIR")
+    p.set_defaults(func=cmd_cache)
+
+    p = subparsers.add_parser('compile', help="compile the exported functions of a module "
+                              "into a shared library")
+    p.add_argument('module', help="module name or path of a .py file")
+    p.add_argument('-o', '--output', help="path of the library without suffix, defaults to "
+                   "MODULE_aot")
+    p.add_argument('-O', '--opt', type=int, default=3, help="LLVM optimization level")
+    p.add_argument('--static-shape', action='store_true',
+                   help="compile the shape of arrays into the code")
+    p.add_argument('--cpu', default='',
+                   help="target CPU, 'host' for this machine; the library may then not "
+                        "run on other machines")
+    p.add_argument('--features', default='', help="target features, e.g. +avx2")
+    p.set_defaults(func=cmd_compile)
+
+    args = parser.parse_args(argv)
+    if not hasattr(args, 'func'):
+        parser.print_help()
+        return 1
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
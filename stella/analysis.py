@@ -15,9 +15,12 @@ import dis
 import logging
 import inspect
 
+from . import cache
+from . import context
 from . import exc
 from . import bytecode
 from . import ir
+from . import parallel
 from . import tp
 from . import utils
 
@@ -35,13 +38,6 @@ class DebugInfo(object):
 
 
 class Function(object):
-    funcs = {}
-    analysis_count = 0
-
-    @classmethod
-    def clearCache(klass):
-        klass.funcs.clear()
-
     @classmethod
     def get(klass, f, module):
         if isinstance(f, ir.FunctionRef):
@@ -53,11 +49,12 @@ class Function(object):
 
         logging.debug("Function.get({0}|{1}, {2})".format(
             impl, id(impl), module))
+        funcs = module.context.functions
         try:
-            return klass.funcs[(impl, module)]
+            return funcs[(impl, module)]
         except KeyError:
             self = klass(impl, module)
-            klass.funcs[(impl, module)] = self
+            funcs[(impl, module)] = self
             return self
 
     def __init__(self, impl, module):
@@ -65,12 +62,14 @@ class Function(object):
         self.labels = {}
         self.incoming_jumps = {}
 
-        self.f = impl.pyFunc()
+        self.f = parallel.outline(impl.pyFunc())
         self.impl = impl
         self.module = module
 
         self.log = logging.getLogger(str(self))
         self.todo = utils.Stack("Todo", log=self.log, quiet=True)
+        # typing stopped at a call with an unknown return type
+        self.incomplete = False
         logging.info("Analyzing {0}".format(self))
 
     def __str__(self):
@@ -230,8 +229,10 @@ class Function(object):
 
         i = 0
         reachable = True
+        self.incomplete = False
         while not self.todo.empty():
             self.log.debug("Type analysis iteration {0}".format(i))
+            utils.count(self.module.stats, 'type_iterations')
             self.analyze_again = False
             bc_list = self.todo.pop()
 
@@ -263,7 +264,7 @@ class Function(object):
                     if abort:
                         self.log.debug("Aborting typing, resuming later.")
                         self.log.debug("{!r}".format(self.todo))
-                        self.impl.analyzeAgain()
+                        self.incomplete = True
                         break
                 except exc.StellaException as e:
                     e.addDebug(bc.debuginfo)
@@ -284,26 +285,36 @@ class Function(object):
             self.impl.setupArgs(args, kwargs)
 
             self.log.debug("Analysis of " + self.impl.nameAndType())
+            stats = self.module.stats
+            utils.count(stats, 'functions')
 
-            self.disassemble()
+            with utils.timed(stats, 'disassemble'):
+                self.disassemble()
+            utils.count(stats, 'bytecodes', sum(1 for _ in self.bytecodes))
             self.bytecodes.printAll(self.log)
 
-            self.rewrite()
+            with utils.timed(stats, 'rewrite'):
+                self.rewrite()
             self.bytecodes.printAll(self.log)
 
-            self.intraflow()
+            with utils.timed(stats, 'intraflow'):
+                self.intraflow()
             self.bytecodes.printAll(self.log)
 
-            self.stack_to_register()
+            with utils.timed(stats, 'stack_to_register'):
+                self.stack_to_register()
 
-            self.type_analysis()
+            with utils.timed(stats, 'type_analysis'):
+                self.type_analysis()
 
             self.impl.bytecodes = self.bytecodes
             self.impl.incoming_jumps = self.incoming_jumps
         else:
             self.log.debug("Re-typing " + self.impl.nameAndType())
+            utils.count(self.module.stats, 'retypes')
 
-            self.type_analysis()
+            with utils.timed(self.module.stats, 'type_analysis'):
+                self.type_analysis()
 
     def disassemble(self):
         """Disassemble a code object."""
@@ -420,59 +431,80 @@ class Function(object):
                 bc.blockEnd(self.last_bc)
 
 
-def cleanup():
-    logging.debug("Cleaning up...")
-    Function.clearCache()
-    tp.destruct()
-
-
-def main(f, args, kwargs):
-    # Clean up first since an internal failure may have prevented the
-    # destructors from running.
-    cleanup()
-
-    try:
-        module = ir.Module()
-        f_type = tp.get(f)
-        funcref = module.getFunctionRef(f_type)
-
-        if f_type.bound:
-            f_self = tp.wrapValue(f.__self__)
-            funcref.f_self = f_self
-
-        # TODO: why do I use wrapValue for args but Const for kwargs...?
-        const_kw = {}
-        for k, v in kwargs.items():
-            const_kw[k] = tp.Const(v)
-        funcref.makeEntry(list(map(tp.wrapValue, args)), const_kw)
-
-        f = Function.get(funcref, module)
-
-        wrapped_args = [tp.wrapValue(arg) for arg in args]
-        wrapped_kwargs = {k: tp.wrapValue(v) for k, v in kwargs.items()}
-
-    except exc.StellaException as e:
-        # An error occurred while preparing the entry call, so at this point
-        # it's best to attribute it to the caller
-        (frame, filename, line_number,
-         function_name, lines, index) = inspect.getouterframes(inspect.currentframe())[2]
-        debuginfo = DebugInfo(filename, line_number)
-        e.addDebug(debuginfo)
-        raise e
-
-    f.analyzeCall(wrapped_args, wrapped_kwargs)
-
-    while module.todoCount() > 0:
-        f.log.debug("called functions: {} ({})".format(module.todoList(), module.todoCount()))
-        # TODO add kwargs support!
-        (call_impl, call_args, call_kwargs) = module.todoNext()
-        call_f = Function.get(call_impl, module)
-        if call_f.analysis_count > 30:
-            # TODO: abitrary limit, it would be better to check if the return
-            # type changed or not
-            raise Exception("Stopping {} after {} call analysis iterations (failsafe)".format(
-                call_f, call_f.analysis_count))
-        call_f.analyzeCall(call_args, call_kwargs)
-        call_f.analysis_count += 1
-    module.addDestruct(cleanup)
-    return module
+def main(f, args, kwargs, static_shape=False, stats=None):
+    """Analyze f for the arguments args and kwargs and return the ir.Module.
+
+    If stats is a dict, the time spent in each phase is added to it, see
+    utils.timed().
+
+    The analysis has a context.Context of its own, which lives as long as
+    the module.
+    """
+    ctx = context.Context(static_shape)
+    with context.use(ctx):
+        try:
+            module = ir.Module(ctx)
+            if stats is not None:
+                module.stats = stats
+            f_type = tp.get(f)
+            funcref = module.getFunctionRef(f_type)
+
+            if f_type.bound:
+                f_self = tp.wrapValue(f.__self__)
+                funcref.f_self = f_self
+
+            # TODO: why do I use wrapValue for args but Const for kwargs...?
+            const_kw = {}
+            for k, v in kwargs.items():
+                const_kw[k] = tp.Const(v)
+            funcref.makeEntry(list(map(tp.wrapValue, args)), const_kw)
+
+            f = Function.get(funcref, module)
+
+            wrapped_args = [tp.wrapValue(arg) for arg in args]
+            wrapped_kwargs = {k: tp.wrapValue(v) for k, v in kwargs.items()}
+
+        except exc.StellaException as e:
+            # An error occurred while preparing the entry call, so at this point
+            # it's best to attribute it to the caller
+            (frame, filename, line_number,
+             function_name, lines, index) = inspect.getouterframes(inspect.currentframe())[2]
+            debuginfo = DebugInfo(filename, line_number)
+            e.addDebug(debuginfo)
+            raise e
+
+        analyze_call(f, wrapped_args, wrapped_kwargs)
+
+        # Worklist of the call graph: a function is only analyzed again when the
+        # return type of one of its callees changed. Types only ever widen, so
+        # this reaches a fixpoint.
+        while module.todoCount() > 0:
+            f.log.debug("called functions: {} ({})".format(module.todoList(),
+                                                           module.todoCount()))
+            # TODO add kwargs support!
+            (call_impl, call_args, call_kwargs) = module.todoNext()
+            analyze_call(Function.get(call_impl, module), call_args, call_kwargs)
+
+        for func in ctx.functions.values():
+            if func.incomplete:
+                raise exc.TypeError("Cannot determine the return type of {}: it depends on "
+                                    "itself".format(func))
+
+        # The registers of a recursive entry function would refer to other arrays
+        # in the nested calls.
+        entry_regs = module.entry.function.args
+        if len(entry_regs) == len(module.entry_args) and \
+                not module.callers(module.entry.function):
+            module.noalias_args = [entry_regs[i] for i in
+                                   cache.disjoint_arrays([getattr(arg, 'value', None)
+                                                          for arg in module.entry_args])]
+        module.addDestruct(ctx.destruct)
+        return module
+
+
+def analyze_call(f, args, kwargs):
+    """Analyze f and queue its callers if the return type changed."""
+    before = f.impl.result.type
+    f.analyzeCall(args, kwargs)
+    if f.impl.result.type != before:
+        f.module.returnTypeChanged(f.impl)
@@ -0,0 +1,253 @@
+# Copyright 2013-2015 David Mohr
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Ahead-of-time compilation into a shared library.
+
+compile() analyzes and compiles functions for declared signatures, see
+signature, and writes `<output>.so' together with a Python loader module
+`<output>.py'. The loader calls the C entry points of the library through
+ctypes with the same argument marshalling as wrap(), so LLVM is not needed
+at run time.
+"""
+import ctypes
+import inspect
+import logging
+import os
+import pprint
+import subprocess
+import tempfile
+import types
+
+from . import cache
+from . import exc
+from . import native
+from . import signature
+from . import tp
+from . import utils
+
+
+def export(*signatures):
+    """Decorator declaring the signatures to compile f for with `stella compile'.
+
+    Functions decorated with stella.jit() are exported as well.
+    """
+    def decorator(f):
+        f.__stella_signatures__ = signatures
+        return f
+    return decorator
+
+
+class ExportedFunctionType(tp.FunctionType):
+    """The signature of a compiled function, without the Python function."""
+    def __init__(self, name, arg_names, arg_defaults):
+        self.name = name
+        self._func = None
+        self.bound = None
+        self._builtin = False
+        self.arg_names = arg_names
+        self.arg_defaults = [tp.Const(default) for default in arg_defaults]
+        self.def_offset = len(self.arg_names)-len(self.arg_defaults)
+
+
+class ExportedFunction(native.NativeCode):
+    """One specialization of a function in a compiled library."""
+    reusable = True
+
+    def __init__(self, lib, entry_type, entry, static_shape):
+        self.entry_type = entry_type
+        self.symbol = entry['symbol']
+        self.params = entry['params']
+        self.static_shape = static_shape
+        self.ret_type = native.type_from_description(entry['ret_type'])
+        self.arg_ctypes = native.arg_ctypes(entry['arg_types'])
+        self._bind(ctypes.cast(getattr(lib, self.symbol), ctypes.c_void_p).value)
+
+    def __str__(self):
+        return "<exported {}>".format(self.symbol)
+
+
+class Dispatcher(object):
+    """Calls the specialization of a compiled function matching the types of
+    the arguments."""
+    def __init__(self, name, entry_type, specializations, static_shape):
+        self.__name__ = name
+        self.entry_type = entry_type
+        self.specializations = specializations
+        self.static_shape = static_shape
+        self.defaults = [default.value for default in entry_type.arg_defaults]
+
+    def __call__(self, *args, **kwargs):
+        combined = self.entry_type._combineArgs(list(args), kwargs, self.defaults)
+        try:
+            key = cache.stable_signature(combined, {}, self.static_shape)
+            prog = self.specializations[key]
+        except (cache.NotPersistable, KeyError):
+            raise exc.TypeError("{} was not compiled for the arguments {}".format(
+                self.__name__, combined))
+        return prog.call(args, kwargs, {})
+
+    def __repr__(self):
+        return "<compiled function {}: {} specializations>".format(self.__name__,
+                                                                  len(self.specializations))
+
+
+class Library(object):
+    """A shared library written by compile(); used by the generated loader."""
+    def __init__(self, path, exports, static_shape=False):
+        self.lib = ctypes.CDLL(path)
+        self.functions = {}
+        for name, export in exports.items():
+            entry_type = ExportedFunctionType(name, export['arg_names'], export['arg_defaults'])
+            specializations = {}
+            for entry in export['specializations']:
+                specializations[entry['key']] = ExportedFunction(self.lib, entry_type, entry,
+                                                                 static_shape)
+            self.functions[name] = Dispatcher(name, entry_type, specializations, static_shape)
+
+
+def _argSpec(f):
+    argspec = inspect.getargspec(f)
+    defaults = list(argspec.defaults or [])
+    for default in defaults:
+        if not (tp.supported_scalar(type(default)) or default is None
+                or type(default) == tuple):
+            raise exc.UnimplementedError(
+                "Default value {} of {} cannot be compiled ahead of time".format(default, f))
+    return argspec.args, defaults
+
+
+def _link(obj, output):
+    """Link the object code obj into the shared library output."""
+    fd, obj_file = tempfile.mkstemp(suffix='.o')
+    try:
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(obj)
+        cc = os.environ.get('CC', 'cc')
+        subprocess.check_call([cc, '-shared', '-o', output, obj_file])
+    finally:
+        os.unlink(obj_file)
+
+
+_loader = '''\
+# Generated by stella, do not edit.
+import os
+
+from stella import aot
+
+_library = aot.Library(os.path.join(os.path.dirname(os.path.abspath(__file__)), {lib!r}),
+                       {exports},
+                       static_shape={static_shape!r})
+
+{functions}
+'''
+
+
+def compile(exports, output, opt=3, static_shape=False, cpu='', features=''):
+    """Compile functions ahead of time.
+
+    Parameters:
+        exports:    a list of (function, [signature, ...]) pairs, or of
+                    functions decorated with export().
+        str output: the path of the library without the suffix. Writes
+                    output.so and the loader output.py.
+        int opt:    the LLVM optimization level.
+        bool static_shape: see wrap().
+        str cpu, features: the target, see wrap(). By default the library
+                    runs on any CPU of the architecture.
+
+    Returns the path of the loader.
+    """
+    # Only needed to compile, not to load the library
+    import llvmlite.binding as llvm
+    from . import analysis
+    from . import codegen
+
+    prefix = os.path.basename(output)
+    linked = None
+    meta = {}
+
+    for export in exports:
+        if isinstance(export, tuple):
+            f, signatures = export
+        else:
+            f, signatures = export, export.__stella_signatures__
+        # e.g. decorated with stella.jit()
+        f = getattr(f, '__wrapped__', f)
+        if not isinstance(f, types.FunctionType):
+            raise exc.UnimplementedError("Only functions can be compiled ahead of time, "
+                                         "not {}".format(f))
+        arg_names, defaults = _argSpec(f)
+        entry_type = ExportedFunctionType(f.__name__, arg_names, defaults)
+        specializations = []
+
+        for i, declared in enumerate(signatures):
+            args = signature.example_args(declared, static_shape)
+            logging.info("Compiling {}{}".format(f.__name__, tuple(declared)))
+
+            module = analysis.main(f, args, {}, static_shape)
+            symbol = "{}_{}_{}".format(prefix, f.__name__, i)
+            prog = codegen.Program(module, symbol, cpu, features)
+            prog.optimize(opt, loop_vectorize=True, slp_vectorize=True)
+            info = prog.describe()
+            if module.runtime_symbols:
+                prog.close()
+                raise exc.UnimplementedError(
+                    "{}{} cannot be compiled ahead of time: it uses prange".format(
+                        f.__name__, tuple(declared)))
+            if info is None:
+                prog.close()
+                raise exc.UnimplementedError(
+                    "{}{} cannot be compiled ahead of time: it uses globals or returns "
+                    "an object".format(f.__name__, tuple(declared)))
+
+            combined = entry_type._combineArgs(list(args), {}, defaults)
+            specializations.append({'symbol': symbol,
+                                    'key': cache.stable_signature(combined, {}, static_shape),
+                                    'params': info['params'],
+                                    'arg_types': info['arg_types'],
+                                    'ret_type': info['ret_type']})
+
+            llmod = prog.llmod()
+            prog.destruct()
+            if linked is None:
+                linked = llmod
+            else:
+                with utils.llvm_lock:
+                    linked.link_in(llmod)
+
+        meta[f.__name__] = {'arg_names': arg_names,
+                            'arg_defaults': defaults,
+                            'specializations': specializations}
+
+    if linked is None:
+        raise exc.StellaException("Nothing to compile")
+
+    # shared libraries need position independent code
+    cpu, features = codegen.resolve_target(cpu, features)
+    with utils.llvm_lock:
+        target_machine = llvm.Target.from_default_triple().create_target_machine(
+            cpu=cpu, features=features, opt=opt, reloc='pic', codemodel='default')
+        obj = target_machine.emit_object(linked)
+    lib = output + '.so'
+    _link(obj, lib)
+
+    loader = output + '.py'
+    with open(loader, 'w') as fh:
+        fh.write(_loader.format(
+            lib=os.path.basename(lib),
+            exports=pprint.pformat(meta, indent=1).replace('\n', '\n' + ' ' * 23),
+            static_shape=static_shape,
+            functions='\n'.join("{0} = _library.functions[{0!r}]".format(name)
+                                for name in sorted(meta))))
+    return loader
@@ -193,6 +193,7 @@ class STORE_GLOBAL(Bytecode):
             self.result = func.loadGlobal(name)
         except exc.UndefinedError:
             self.result = func.newGlobal(name)
+        self.result.written = True
 
     @pop_stack(1)
     def stack_eval(self, func, stack):
@@ -309,9 +310,62 @@ class BINARY_MULTIPLY(BinaryOp):
     b_func = {tp.Float: 'fmul', tp.Int: 'mul'}
 
 
+def _sign_differs(cge, r, b):
+    """(r != 0) and r, b have different signs: the remainder of the C
+    division needs the correction to Python's floor semantics."""
+    builder = cge.builder
+    if r.type == tp.tp_double:
+        zero = tp.Float.constant(0.0)
+        return builder.and_(builder.fcmp_ordered('!=', r, zero),
+                            builder.icmp_signed('!=', builder.fcmp_ordered('<', r, zero),
+                                                builder.fcmp_ordered('<', b, zero)))
+    zero = tp.Int.constant(0)
+    return builder.and_(builder.icmp_signed('!=', r, zero),
+                        builder.icmp_signed('<', builder.xor(r, b), zero))
+
+
+def _guardDivisor(cge, b):
+    """Returns b with 0 and -1 replaced by 1, so that `sdiv' and `srem'
+    cannot trap, and whether b is -1. The callers correct the result for -1.
+    The result for 0 is meaningless: compiled code cannot raise a
+    ZeroDivisionError."""
+    builder = cge.builder
+    is_minus_one = builder.icmp_signed('==', b, tp.Int.constant(-1))
+    traps = builder.or_(builder.icmp_signed('==', b, tp.Int.constant(0)), is_minus_one)
+    return builder.select(traps, tp.Int.constant(1), b), is_minus_one
+
+
 class BINARY_MODULO(BinaryOp):
+    """Python compliant `%' operator: the result has the sign of the divisor.
+
+    The correction of the C remainder is left out if the value ranges show
+    that it is not needed, and so is the guard against a trapping divisor,
+    see ranges.Ranges."""
     b_func = {tp.Float: 'frem', tp.Int: 'srem'}
 
+    def translate(self, cge):
+        self.cast(cge)
+        builder = cge.builder
+        a = self.args[0].translate(cge)
+        b = self.args[1].translate(cge)
+        if self.result.type == tp.Float:
+            r = builder.frem(a, b)
+            self.result.llvm = builder.select(_sign_differs(cge, r, b), builder.fadd(r, b), r)
+            return
+
+        shift = cge.ranges.power_of_two(self.args[1])
+        if shift is not None:
+            self.result.llvm = builder.and_(a, tp.Int.constant((1 << shift) - 1))
+            return
+        if not cge.ranges.safe_divisor(self.args[0], self.args[1]):
+            # x % -1 is 0, like x % 1
+            b, _ = _guardDivisor(cge, b)
+        r = builder.srem(a, b)
+        if cge.ranges.nonnegative(self.args[0]) and cge.ranges.nonnegative(self.args[1]):
+            self.result.llvm = r
+        else:
+            self.result.llvm = builder.select(_sign_differs(cge, r, b), builder.add(r, b), r)
+
 
 class BINARY_POWER(BinaryOp):
     b_func = {tp.Float: 'llvm.pow', tp.Int: 'llvm.powi'}
@@ -362,7 +416,10 @@ class BINARY_POWER(BinaryOp):
 class BINARY_FLOOR_DIVIDE(BinaryOp):
     """Python compliant `//' operator.
 
-    Slow since it has to perform type conversions and floating point division for integers"""
+    Integers are divided with `sdiv', rounding towards negative infinity
+    unless the value ranges show that both operands are non-negative. A
+    divisor of 0 or -1 is guarded against unless the ranges exclude it, see
+    ranges.Ranges."""
     b_func = {
         tp.Float: 'fdiv',
         tp.Int: 'fdiv'}  # NOT USED, but required to make it a concrete class
@@ -376,8 +433,31 @@ class BINARY_FLOOR_DIVIDE(BinaryOp):
             widened, _ = self.result.unify_type(arg.type, self.debuginfo)
             func.retype(widened)
 
+    def translateInt(self, cge):
+        builder = cge.builder
+        a = self.args[0].translate(cge)
+        b = self.args[1].translate(cge)
+        shift = cge.ranges.power_of_two(self.args[1])
+        if shift is not None:
+            return builder.ashr(a, tp.Int.constant(shift))
+        is_minus_one = None
+        if not cge.ranges.safe_divisor(self.args[0], self.args[1]):
+            b, is_minus_one = _guardDivisor(cge, b)
+        q = builder.sdiv(a, b)
+        if cge.ranges.nonnegative(self.args[0]) and cge.ranges.nonnegative(self.args[1]):
+            return q
+        r = builder.srem(a, b)
+        q = builder.sub(q, builder.zext(_sign_differs(cge, r, b), tp.tp_int))
+        if is_minus_one is not None:
+            # wraps around for the smallest integer instead of trapping
+            q = builder.select(is_minus_one, builder.neg(a), q)
+        return q
+
     def translate(self, cge):
         is_int = all([arg.type == tp.Int for arg in self.args])
+        if is_int:
+            self.result.llvm = self.translateInt(cge)
+            return
         for i in range(len(self.args)):
             if self.args[i].type != tp.Float:
                 self.args[i] = Cast(self.args[i], tp.Float)
@@ -390,16 +470,6 @@ class BINARY_FLOOR_DIVIDE(BinaryOp):
                                                        [tp.Float.llvmType(cge.module)])
         self.result.llvm = cge.builder.call(llvm_floor, [tmp])
 
-        if is_int:
-            # TODO this may be superflous if both args got converted to float
-            # in the translation stage -> move toFloat partially to the
-            # analysis stage.
-            self.result.llvm = cge.builder.fptosi(
-                self.result.translate(cge),
-                tp.Int.llvmType(cge.module),
-                "(int)" +
-                self.result.name)
-
 
 class BINARY_TRUE_DIVIDE(BinaryOp):
     b_func = {tp.Float: 'fdiv'}
@@ -728,7 +798,10 @@ class LOAD_GLOBAL(Bytecode):
         if isinstance(self.var, ir.FunctionRef):
             pass
         elif isinstance(self.var, GlobalVariable):
-            self.result.llvm = cge.builder.load(self.var.translate(cge))
+            if self.var.isConstant():
+                self.result.llvm = self.var.initial_value.translate(cge)
+            else:
+                self.result.llvm = cge.builder.load(self.var.translate(cge))
 
     def type_eval(self, func):
         self.grab_stack()
@@ -755,6 +828,15 @@ class LOAD_GLOBAL(Bytecode):
             self.result.unify_type(self.var.type, self.debuginfo)
 
 
+def const_object(arg):
+    """The object marked with stella.const() which arg was loaded from a
+    global, or None."""
+    bc = getattr(arg, 'bc', None)
+    if isinstance(bc, LOAD_GLOBAL) and isinstance(bc.var, GlobalVariable):
+        return bc.var.constObject()
+    return None
+
+
 class LOAD_ATTR(Bytecode):
     def __init__(self, func, debuginfo):
         super().__init__(func, debuginfo)
@@ -786,7 +868,7 @@ class LOAD_ATTR(Bytecode):
             return
 
         type_ = arg.type.dereference()
-        if isinstance(type_, tp.StructType):
+        if isinstance(type_, (tp.StructType, tp.SoAElementType)):
             try:
                 attr_type = arg.type.dereference().getMemberType(self.name)
             except KeyError:
@@ -802,7 +884,7 @@ class LOAD_ATTR(Bytecode):
         elif isinstance(type_, tp.ArrayType):
             if self.result is None:
                 self.result = Register(func.impl)
-            self.result.unify_type(tp.get(type_.shape), self.debuginfo)
+            self.result.unify_type(type_.shapeType(), self.debuginfo)
         else:
             raise exc.TypeError("Cannot load attribute {} from type {}".format(self.name,
                                                                                arg.type),
@@ -814,19 +896,29 @@ class LOAD_ATTR(Bytecode):
             return
 
         type_ = arg.type.dereference()
-        if isinstance(type_, tp.StructType):
+        if isinstance(type_, tp.SoAElementType):
+            p = type_.memberPointer(cge, arg, self.name)
+            self.result.llvm = cge.builder.load(p)
+            cge.module.annotateAccess(self.result.llvm, type_.fieldName(self.name))
+        elif isinstance(type_, tp.StructType):
             tp_attr = type_.getMemberType(self.name)
             if isinstance(tp_attr, tp.FunctionType):
                 self.result.f_self = arg
                 return
+            obj = const_object(arg)
+            if obj is not None and self.name in vars(obj) and tp.supported_scalar(tp_attr):
+                value = getattr(obj, self.name)
+                cge.module.guards.append((vars(obj), self.name, value))
+                self.result.llvm = tp.Const(value).translate(cge)
+                return
             idx = type_.getMemberIdx(self.name)
             idx_llvm = tp.getIndex(idx)
             struct_llvm = arg.translate(cge)
             p = cge.builder.gep(struct_llvm, [tp.Int.constant(0), idx_llvm], inbounds=True)
             self.result.llvm = cge.builder.load(p)
+            cge.module.annotateAccess(self.result.llvm, type_.fieldName(self.name))
         elif isinstance(type_, tp.ArrayType):
-            val = tp.wrapValue(type_.shape)
-            self.result.llvm = val.translate(cge)
+            self.result.llvm = type_.loadShape(cge, arg)
         else:
             raise exc.UnimplementedError(type(arg))
 
@@ -848,7 +940,7 @@ class STORE_ATTR(Bytecode):
     def type_eval(self, func):
         self.grab_stack()
         type_ = self.args[1].type.dereference()
-        if isinstance(type_, tp.StructType):
+        if isinstance(type_, (tp.StructType, tp.SoAElementType)):
             member_type = type_.getMemberType(self.name)
             arg_type = self.args[0].type
             if member_type != arg_type:
@@ -869,7 +961,16 @@ class STORE_ATTR(Bytecode):
                     type(self.args[1])))
 
     def translate(self, cge):
-        if (isinstance(self.args[1], tp.Typable)
+        if const_object(self.args[1]) is not None:
+            raise exc.TypeError("Cannot assign attribute {0} of an object marked with "
+                                "stella.const()".format(self.name))
+        type_ = getattr(self.args[1], 'type', None)
+        if isinstance(type_, tp.SoAElementType):
+            p = type_.memberPointer(cge, self.args[1], self.name)
+            self.result.llvm = cge.builder.store(self.args[0].translate(cge), p)
+            cge.module.annotateAccess(self.result.llvm, type_.fieldName(self.name))
+            cge.module.written.add(type_.fieldName(self.name))
+        elif (isinstance(self.args[1], tp.Typable)
                 and isinstance(self.args[1].type.dereference(), tp.StructType)):
             struct_llvm = self.args[1].translate(cge)
             idx = self.args[1].type.dereference().getMemberIdx(self.name)
@@ -877,6 +978,9 @@ class STORE_ATTR(Bytecode):
             val_llvm = self.args[0].translate(cge)
             p = cge.builder.gep(struct_llvm, [tp.Int.constant(0), idx_llvm], inbounds=True)
             self.result.llvm = cge.builder.store(val_llvm, p)
+            field = self.args[1].type.dereference().fieldName(self.name)
+            cge.module.annotateAccess(self.result.llvm, field)
+            cge.module.written.add(field)
         else:
             raise exc.UnimplementedError(type(self.args[1]))
 
@@ -936,13 +1040,18 @@ class CALL_FUNCTION(Bytecode):
             self.result = self.func.getResult(func.impl)
 
             if not isinstance(self.func, Intrinsic):
-                func.module.functionCall(self.func, self.args, self.kw_args)
+                func.module.functionCall(func.impl, self.func, self.args, self.kw_args)
+            else:
+                for callee, args in self.func.calls(self.args, self.kw_args):
+                    func.module.functionCall(func.impl, callee, args, {})
 
         type_ = self.func.getReturnType(self.args, self.kw_args)
         tp_change = self.result.unify_type(type_, self.debuginfo)
 
         if self.result.type == tp.NoType:
-            # abort here because mostly everything downstream will be unknown types
+            # abort here because mostly everything downstream will be unknown
+            # types. The function is retyped once the return type is known,
+            # see ir.Module.returnTypeChanged()
             return True
         else:
             func.retype(tp_change)
@@ -1026,7 +1135,8 @@ class ForLoop(HasTarget, ir.IR):
         cur = bc.prev
         if isinstance(cur, (LOAD_ATTR, LOAD_GLOBAL, LOAD_FAST)):
             iterable = cur
-            limit = Const(0)
+            # set in rewrite()
+            limit = None
             cur.remove()
             cur = bc.prev
             if isinstance(iterable, LOAD_ATTR):
@@ -1124,8 +1234,6 @@ class ForLoop(HasTarget, ir.IR):
                 else:
                     last.insert_before(b)
                 b = copy(self.iterable.next)
-                if after:
-                    self.iterable_attr = b
                 if after:
                     last.insert_after(b)
                     last = b
@@ -1165,6 +1273,23 @@ class ForLoop(HasTarget, ir.IR):
 
             return last
 
+        def iterable_len():
+            """The bytecodes for len(iterable), in the same reverse order as a
+            limit which is the result of a function call.
+
+            The shape of an array may only be known at run time, so the limit
+            cannot be a constant.
+            """
+            b = LOAD_GLOBAL(func.impl, self.debuginfo)
+            b.addName(func.impl, 'len')
+            limit = [b, copy(self.iterable)]
+            if isinstance(self.iterable.next, LOAD_ATTR):
+                limit.append(copy(self.iterable.next))
+            b = CALL_FUNCTION(func.impl, self.debuginfo)
+            b.addRawArg(1)
+            limit.append(b)
+            return list(reversed(limit))
+
         last = self
         (self.limit_minus_one, _) = func.impl.getOrNewStackLoc(
             str(self.test_loc) + "__limit")
@@ -1172,6 +1297,7 @@ class ForLoop(HasTarget, ir.IR):
             self.loop_value = self.loop_var
             (self.loop_var, _) = func.impl.getOrNewStackLoc(
                 self.loop_value.name + "__idx")
+            self.limit = iterable_len()
 
         # init
         if self.start:
@@ -1364,21 +1490,6 @@ class ForLoop(HasTarget, ir.IR):
 
     def type_eval(self, func):
         self.grab_stack()
-        if self.iterable:
-            # TODO if we have an iterable, then we must populate the limit
-            # here. Yet I am not sure how to detect when this was never
-            # successful
-            if isinstance(self.iterable.next, LOAD_ATTR):
-                if self.iterable_attr.result:
-                    iterable = self.iterable_attr.result
-                else:
-                    func.retype()
-                    return
-            else:
-                iterable = self.iterable.source
-            if iterable.type != tp.NoType:
-                type_ = iterable.type.dereference()
-                self.limit.value = type_.shape
 
 
 class STORE_SUBSCR(Bytecode):
@@ -0,0 +1,446 @@
+# Copyright 2013-2015 David Mohr
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Caching of compiled programs.
+
+A wrapped function keeps one finalized codegen.Program per argument type
+signature so that repeated calls with the same types skip analysis and code
+generation entirely.
+
+Optionally the object code is also stored in a DiskCache, so that other
+processes can load it instead of compiling again.
+"""
+import hashlib
+import logging
+import os
+import pickle
+import sys
+import tempfile
+import time
+import types
+import weakref
+
+import numpy as np
+
+from . import utils
+
+
+_scalars = (int, float, bool)
+
+# class -> {names of the instance attributes: (fingerprint, names)}, see _attributeNames()
+_attribute_names = weakref.WeakKeyDictionary()
+
+
+def _classFingerprint(type_):
+    """Changes if attributes are added to or removed from the class type_ or
+    its bases."""
+    return tuple(len(klass.__dict__) for klass in type_.__mro__)
+
+
+def _attributeNames(value):
+    """The names of the attributes of value, sorted like in tp.StructType.
+
+    dir() is slow, so they are cached per class and set of instance
+    attributes. Only the types of the attribute values are looked at for
+    every call.
+    """
+    type_ = type(value)
+    instance = tuple(getattr(value, '__dict__', ()))
+    # a class passed as a value has attributes of its own and of its bases
+    fingerprint = _classFingerprint(value if isinstance(value, type) else type_)
+    by_instance = _attribute_names.setdefault(type_, {})
+    cached = by_instance.get(instance)
+    if cached is None or cached[0] != fingerprint:
+        names = sorted(filter(lambda s: not s.startswith('__'), dir(value)))
+        cached = by_instance[instance] = (fingerprint, names)
+    return cached[1]
+
+
+def _valueSignature(value, seen, static_shape):
+    type_ = type(value)
+    if type_ in _scalars or value is None:
+        return type_
+    elif type_ == np.ndarray:
+        # see tp.DynArrayType
+        sig = (np.ndarray, value.dtype.str, value.shape if static_shape else value.ndim)
+        align = utils.array_alignment(value)
+        if align < value.itemsize:
+            # see tp.ArrayType.align
+            sig += (align,)
+        return sig
+    elif type_ == tuple:
+        # tuples are compiled in as constants
+        return (tuple, value)
+    elif isinstance(value, list):
+        # including tp.SoAList, which has a layout of its own
+        if len(value) == 0:
+            return (type_, 0)
+        # lists are typed by their first element, see tp.ListType.fromObj()
+        return (type_, len(value), _valueSignature(value[0], seen, static_shape))
+    elif isinstance(value, types.MethodType):
+        return (types.MethodType, value.__func__)
+    elif isinstance(value, (types.FunctionType, types.BuiltinFunctionType, types.ModuleType)):
+        return value
+
+    # Everything else is an object which is mapped to a tp.StructType. The
+    # struct type is determined once per class, so the layout only needs to be
+    # recorded the first time the class is encountered.
+    if type_ in seen:
+        return type_
+    seen.add(type_)
+    layout = [type_]
+    for name in _attributeNames(value):
+        layout.append((name, _valueSignature(getattr(value, name), seen, static_shape)))
+    return tuple(layout)
+
+
+def disjoint_arrays(values):
+    """Returns the indices of the numpy arrays in values whose memory does not
+    overlap with any of the other arrays."""
+    arrays = [(i, v) for i, v in enumerate(values) if type(v) == np.ndarray]
+    return [i for i, a in arrays
+            if not any(j != i and np.may_share_memory(a, b) for j, b in arrays)]
+
+
+def signature(args, kwargs, static_shape=False):
+    """Returns a hashable key describing the types of the call arguments.
+
+    Scalars contribute their type, numpy arrays their dtype and number of
+    dimensions (or their shape if static_shape is set), lists their length and
+    element type, and objects the layout of their attributes. If arrays
+    overlap, which ones do not is recorded, too: otherwise the code assumes
+    that they are all distinct.
+    """
+    seen = set()
+    sig_args = tuple(_valueSignature(arg, seen, static_shape) for arg in args)
+    sig_kwargs = tuple((k, _valueSignature(v, seen, static_shape))
+                       for k, v in sorted(kwargs.items()))
+    values = list(args) + [v for _, v in sorted(kwargs.items())]
+    disjoint = disjoint_arrays(values)
+    if len(disjoint) < sum(1 for v in values if type(v) == np.ndarray):
+        return (sig_args, sig_kwargs, tuple(disjoint))
+    return (sig_args, sig_kwargs)
+
+
+class FunctionCache(object):
+    """Compiled programs of a single wrapped function, keyed by signature()."""
+
+    def __init__(self, name=None):
+        self.name = name
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key):
+        """Returns the cached program for key, or None on a miss."""
+        prog = self.entries.get(key)
+        if prog is not None and not prog.valid():
+            logging.debug("Cached program for {} is stale".format(self.name))
+            self.invalidate(key)
+            prog = None
+
+        if prog is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return prog
+
+    def insert(self, key, prog):
+        assert prog.reusable
+        self.entries[key] = prog
+
+    def replace(self, key, old, prog):
+        """Swap in prog for the program old, e.g. after recompiling it with more
+        optimizations. Returns False and closes prog if the entry for key
+        is no longer old."""
+        assert prog.reusable
+        if self.entries.get(key) is not old:
+            prog.close()
+            return False
+        self.entries[key] = prog
+        old.close()
+        return True
+
+    def invalidate(self, key=None):
+        """Drop the program compiled for key, or all of them if key is None."""
+        if key is None:
+            progs = list(self.entries.values())
+            self.entries.clear()
+        else:
+            progs = [self.entries.pop(key)]
+        for prog in progs:
+            prog.close()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __str__(self):
+        return "<cache of {}: {} entries, {} hits, {} misses>".format(
+            self.name, len(self), self.hits, self.misses)
+
+
+class NotPersistable(Exception):
+    """The value cannot be identified across processes."""
+    pass
+
+
+def _codeDigest(code, h):
+    h.update(code.co_code)
+    h.update(repr((code.co_names, code.co_varnames)).encode())
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            _codeDigest(const, h)
+        else:
+            h.update(repr(const).encode())
+
+
+def code_digest(f):
+    """Hash of the byte code of the function f, including its default arguments."""
+    if isinstance(f, types.MethodType):
+        f = f.__func__
+    h = hashlib.sha256()
+    _codeDigest(f.__code__, h)
+    h.update(repr(f.__defaults__).encode())
+    return h.hexdigest()
+
+
+def _qualname(obj):
+    return "{}.{}".format(obj.__module__, getattr(obj, '__qualname__', obj.__name__))
+
+
+def _stableRepr(value):
+    """A representation of a signature() which is the same in every process."""
+    if isinstance(value, tuple):
+        return '(' + ','.join(_stableRepr(v) for v in value) + ')'
+    elif value is None or isinstance(value, (str, int, float, bool)):
+        return repr(value)
+    elif isinstance(value, type):
+        return _qualname(value)
+    elif isinstance(value, types.FunctionType):
+        return "{}:{}".format(_qualname(value), code_digest(value))
+    elif isinstance(value, types.BuiltinFunctionType):
+        return _qualname(value)
+    elif isinstance(value, types.ModuleType):
+        return value.__name__
+    raise NotPersistable(value)
+
+
+def stable_signature(args, kwargs, static_shape=False):
+    """Like signature(), but a string which is the same in every process.
+
+    Raises NotPersistable if an argument cannot be identified across
+    processes.
+    """
+    return _stableRepr(signature(args, kwargs, static_shape))
+
+
+def _fingerprint(item):
+    if isinstance(item, types.FunctionType):
+        return ('function', code_digest(item))
+    elif isinstance(item, types.BuiltinFunctionType):
+        return ('builtin', _qualname(item))
+    elif isinstance(item, types.ModuleType):
+        return ('module', item.__name__)
+    elif type(item) in (bool, int, float):
+        # compiled in, see storage.GlobalVariable.isConstant()
+        return ('value', type(item).__name__, repr(item))
+    raise NotPersistable(item)
+
+
+def _moduleName(d):
+    name = d.get('__name__')
+    if name not in sys.modules or sys.modules[name].__dict__ is not d:
+        raise NotPersistable(name)
+    return name
+
+
+def guard_fingerprints(guards):
+    """Describe the guards of ir.Module in a way that can be checked by another
+    process, or return None if that is not possible."""
+    try:
+        return [(_moduleName(d), key, _fingerprint(item)) for d, key, item in guards]
+    except NotPersistable:
+        return None
+
+
+def resolve_guards(fingerprints):
+    """Turn the result of guard_fingerprints() back into guards, or return None
+    if any of the globals has changed since."""
+    guards = []
+    for name, key, fingerprint in fingerprints:
+        module = sys.modules.get(name)
+        if module is None or key not in module.__dict__:
+            return None
+        item = module.__dict__[key]
+        try:
+            if _fingerprint(item) != fingerprint:
+                return None
+        except NotPersistable:
+            return None
+        guards.append((module.__dict__, key, item))
+    return guards
+
+
+def default_cache_dir():
+    """The directory of the DiskCache, if enabled with $STELLA_CACHE_DIR."""
+    return os.environ.get('STELLA_CACHE_DIR')
+
+
+class DiskCache(object):
+    """Object code of compiled programs stored in a directory which is shared
+    between processes.
+
+    Every entry is a pickled dict with the object code and the information
+    needed to call it, see codegen.Program.describe(). Once the cache grows
+    beyond max_size bytes or max_entries files the least recently used entries
+    are evicted.
+    """
+    suffix = '.stc'
+    format_version = 1
+
+    def __init__(self, path, version=None, max_size=None, max_entries=None):
+        self.path = os.path.expanduser(path)
+        self.version = version
+        if max_size is None:
+            # in MiB
+            max_size = int(os.environ.get('STELLA_CACHE_SIZE', 256)) * 1024 * 1024
+        self.max_size = max_size
+        self.max_entries = max_entries or 10000
+
+    def key(self, f, sig, opt, static_shape):
+        """Returns the file name for the compiled function f, or None if f or
+        its signature sig cannot be identified across processes."""
+        # only load LLVM when it is needed, see aot
+        import llvmlite
+        import llvmlite.binding as llvm
+
+        try:
+            sig_repr = _stableRepr(sig)
+        except NotPersistable as e:
+            logging.debug("Not caching {} on disk: {}".format(f, e))
+            return None
+
+        h = hashlib.sha256()
+        for part in (self.format_version, self.version, sys.version_info[:2],
+                     llvmlite.__version__, llvm.llvm_version_info,
+                     llvm.get_host_cpu_name(), llvm.get_host_cpu_features().flatten(),
+                     opt, static_shape, code_digest(f), sig_repr):
+            h.update(repr(part).encode())
+            h.update(b'\0')
+        return h.hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.path, key + self.suffix)
+
+    def _read(self, key):
+        fname = self._file(key)
+        try:
+            with open(fname, 'rb') as fh:
+                return pickle.load(fh)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.warn("Removing corrupt cache entry {}: {}".format(fname, e))
+            self.remove(key)
+            return None
+
+    def load(self, key):
+        """Returns the entry for key, or None."""
+        entry = self._read(key)
+        if entry is not None:
+            # update the access time for the LRU eviction
+            try:
+                os.utime(self._file(key))
+            except OSError:
+                pass
+        return entry
+
+    def store(self, key, info, obj):
+        """Store the object code obj, see codegen.Program.describe() for info.
+
+        Failing to write is not an error, the program just is not cached.
+        """
+        entry = dict(info, object=obj, created=time.time())
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            # write to a temporary file first so that other processes never
+            # see a partial entry
+            fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as fh:
+                    pickle.dump(entry, fh, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp, self._file(key))
+            except BaseException:
+                os.unlink(tmp)
+                raise
+            self.evict()
+        except OSError as e:
+            logging.warn("Could not write to the cache {}: {}".format(self.path, e))
+
+    def remove(self, key):
+        try:
+            os.unlink(self._file(key))
+        except FileNotFoundError:
+            pass
+
+    def describe(self, key):
+        """Returns the name of the function compiled in the entry for key."""
+        entry = self._read(key)
+        return entry and entry['name']
+
+    def entries(self):
+        """Returns a list of (key, size, last use) tuples, most recently used first."""
+        try:
+            names = os.listdir(self.path)
+        except FileNotFoundError:
+            return []
+        entries = []
+        for name in names:
+            if not name.endswith(self.suffix):
+                continue
+            try:
+                st = os.stat(os.path.join(self.path, name))
+            except FileNotFoundError:
+                # concurrently evicted
+                continue
+            entries.append((name[:-len(self.suffix)], st.st_size, st.st_mtime))
+        entries.sort(key=lambda e: e[2], reverse=True)
+        return entries
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        """Remove the least recently used entries until the limits are met."""
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        while entries and (total > self.max_size or len(entries) > self.max_entries):
+            key, size, _ = entries.pop()
+            logging.debug("Evicting cache entry {}".format(key))
+            self.remove(key)
+            total -= size
+
+    def purge(self):
+        """Remove all entries."""
+        for key, _, _ in self.entries():
+            self.remove(key)
+
+    def __len__(self):
+        return len(self.entries())
+
+    def __str__(self):
+        return "<disk cache {}: {} entries, {} bytes>".format(self.path, len(self), self.size())
@@ -16,46 +16,213 @@
 import llvmlite.ir as ll
 import llvmlite.binding as llvm
 
+import ctypes
 import logging
-import time
+import threading
+import uuid
 
 from . import tp
 from . import ir
 from . import exc
+from . import cache
+from . import context
+from . import native
+from . import parallel
+from . import ranges
+from . import utils
 
 
-class CGEnv(object):
-    module = None
-    builder = None
+def _addRuntimeSymbols():
+    import llvmlite
+    import os
+
+    _lib_dir = os.path.dirname(llvm.ffi.__file__)
+    clib = ctypes.CDLL(os.path.join(_lib_dir, llvmlite.utils.get_library_name()))
+    # Direct access as below mangles the name
+    # f = clib.__powidf2
+    f = getattr(clib, '__powidf2')
+    llvm.add_symbol('__powidf2', ctypes.cast(f, ctypes.c_void_p).value)
+
+    for name, address in parallel.runtime_symbols():
+        llvm.add_symbol(name, address)
+
 
+_initialized = False
 
-class Program(object):
-    def __init__(self, module):
+
+def _initialize():
+    global _initialized
+    if not _initialized:
         llvm.initialize()
         llvm.initialize_native_target()
         llvm.initialize_native_asmprinter()
+        _addRuntimeSymbols()
+        _initialized = True
+
+
+def resolve_target(cpu='', features=''):
+    """Returns the (cpu, features) to create a target machine with.
+
+    cpu='host' selects the CPU of this machine and all its features, features
+    may then add or remove some, e.g. '-avx512f'.
+    """
+    if cpu == 'host':
+        cpu = llvm.get_host_cpu_name()
+        host_features = llvm.get_host_cpu_features().flatten()
+        features = ','.join(filter(None, [host_features, features]))
+    return cpu, features
+
+
+class JIT(object):
+    """The LLVM execution engine shared by all programs of the process.
+
+    LLVM is initialized and the runtime symbols are resolved only once. The
+    modules of new programs are added to the existing engine, and removed
+    again when the program is closed. There is one engine per target CPU and
+    feature set, see resolve_target().
+    """
+    _instances = {}
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def get(klass, cpu='', features=''):
+        key = (cpu, features)
+        if key not in klass._instances:
+            with klass._instance_lock:
+                if key not in klass._instances:
+                    klass._instances[key] = klass(cpu, features)
+        return klass._instances[key]
+
+    def __init__(self, cpu='', features=''):
+        _initialize()
+
+        cpu, features = resolve_target(cpu, features)
+        self.target_machine = llvm.Target.from_default_triple().create_target_machine(
+            cpu=cpu, features=features)
+        with utils.llvm_lock:
+            self.ee = llvm.create_mcjit_compiler(llvm.parse_assembly(""), self.target_machine)
+
+    def addModule(self, llmod):
+        with utils.llvm_lock:
+            self.ee.add_module(llmod)
+            self.ee.finalize_object()
+
+    def addObject(self, obj):
+        """Load object code, which cannot be removed again."""
+        with utils.llvm_lock:
+            self.ee.add_object_file(llvm.ObjectFileRef.from_data(obj))
+            self.ee.finalize_object()
+
+    def removeModule(self, llmod):
+        with utils.llvm_lock:
+            self.ee.remove_module(llmod)
+
+    def getAddress(self, name):
+        with utils.llvm_lock:
+            return self.ee.get_function_address(name)
+
+
+def stub_name(function):
+    """A name for the stub of function which is unique within the engine, even
+    if object code compiled by other processes is loaded."""
+    return "{}__stub__{}".format(function, uuid.uuid4().hex[:12])
+
+
+class CGEnv(object):
+    module = None
+    builder = None
+    # of the function being emitted
+    ranges = None
+    # the fields to write back into Python objects after a call, None for all
+    # of them, see ir.Module.written
+    written = None
+
+
+_fastmath_flags = ('fast', 'reassoc', 'nnan', 'ninf', 'nsz', 'arcp', 'contract', 'afn')
+_float_ops = ('fadd', 'fsub', 'fmul', 'fdiv', 'frem')
+
+
+def fastmath_flags(fastmath):
+    """The LLVM flags for the fastmath option of wrap(): True for all, or an
+    iterable of flags like ('reassoc', 'contract')."""
+    if not fastmath:
+        return ()
+    if fastmath is True:
+        return ('fast',)
+    if isinstance(fastmath, str):
+        fastmath = fastmath.split(',')
+    flags = tuple(sorted(set(fastmath)))
+    for flag in flags:
+        if flag not in _fastmath_flags:
+            raise exc.UnimplementedError("Unknown fast-math flag {}, use one of {}".format(
+                flag, ', '.join(_fastmath_flags)))
+    return flags
+
+
+class Program(native.NativeCode):
+    def __init__(self, module, name=None, cpu='', features='', fastmath=()):
+        """name is the symbol of the entry point, unique by default.
+
+        cpu and features select the target, see resolve_target(), fastmath
+        the flags of floating point operations, see fastmath_flags().
+        """
+        self.jit_engine = JIT.get(cpu, features)
+        self.cpu = cpu
+        self.features = features
+        # the timings of the compilation are added to the analysis statistics
+        self.stats = module.stats
 
         self.module = module
-        self.module.translate()
+        with utils.timed(self.stats, 'emit_ir'), context.use(module.context):
+            self.module.translate()
 
-        self.cge = CGEnv()
-        self.cge.module = module
+            self.cge = CGEnv()
+            self.cge.module = module
+            # filled in while the functions are translated
+            self.cge.written = module.written
 
-        self.llvm = self.makeStub()
+            self.llvm = self.makeStub(name)
+            self.reusable = self._isReusable()
+            # arguments passed to call() must be wrapped the same way
+            self.static_shape = module.context.static_shape
 
-        for _, func in self.module.namestore.all(ir.Function):
-            self.blockAndCode(func)
+            for _, func in self.module.namestore.all(ir.Function):
+                self.blockAndCode(func)
+            if fastmath:
+                self.setFastMath(fastmath)
 
-        self.target_machine = llvm.Target.from_default_triple().create_target_machine()
+        self.target_machine = self.jit_engine.target_machine
 
         logging.debug("Verifying... ")
         self._llmod = None
+        self.in_engine = False
 
     def llmod(self):
         if not self._llmod:
-            self._llmod = llvm.parse_assembly(str(self.module.llvm))
+            with utils.timed(self.stats, 'serialize_ir'):
+                ir_text = str(self.module.llvm)
+            utils.count(self.stats, 'ir_bytes', len(ir_text))
+            with utils.llvm_lock:
+                with utils.timed(self.stats, 'parse_ir'):
+                    llmod = llvm.parse_assembly(ir_text)
+                # the cost models of the optimizations depend on the target
+                llmod.triple = self.target_machine.triple
+                llmod.data_layout = str(self.target_machine.target_data)
+                # before any optimization, so that C helpers can be inlined
+                with utils.timed(self.stats, 'link_bitcode'):
+                    for ext_module in self.module.getExternalModules():
+                        ext_module.link(llmod)
+            self._llmod = llmod
         return self._llmod
 
+    def setFastMath(self, flags):
+        """Relax the IEEE semantics of all floating point operations."""
+        for func in self.module.llvm.functions:
+            for block in func.blocks:
+                for instr in block.instructions:
+                    if instr.opname in _float_ops:
+                        instr.flags = list(instr.flags) + list(flags)
+
     def blockAndCode(self, impl):
         func = impl.llvm
         # create blocks
@@ -86,6 +253,7 @@ class Program(object):
         impl.log.debug("Emitting code:")
         bb = None
         cge = self.cge
+        cge.ranges = ranges.Ranges(impl)
         for bc in impl.bytecodes:
             try:
                 if bb != bc.block:
@@ -102,18 +270,43 @@ class Program(object):
                 e.addDebug(bc.debuginfo)
                 raise
 
-    def makeStub(self):
+    def makeStub(self, name=None):
+        """The stub is the native entry point: it sets up the globals and calls
+        the entry function.
+
+        Arguments are parameters of the stub so that the compiled code can be
+        called again with different values: scalars are passed by value,
+        arrays, objects and lists as pointers. Only constants which are not
+        scalars, e.g. tuples, are compiled in.
+        """
         impl = self.module.entry
-        func_tp = ll.FunctionType(impl.result.type.llvmType(self.module), [])
-        func = ll.Function(self.module.llvm, func_tp, name=str(impl.function)+'__stub__')
+        self.params = []
+        for i, arg in enumerate(self.module.entry_args):
+            if not isinstance(arg, tp.Const) or tp.supported_scalar(arg.type):
+                self.params.append(i)
+
+        param_types = [self.module.entry_args[i].llvmType(self.module) for i in self.params]
+        func_tp = ll.FunctionType(impl.result.type.llvmType(self.module), param_types)
+        func = ll.Function(self.module.llvm, func_tp, name=name or stub_name(impl.function))
         bb = func.append_basic_block("entry")
         builder = ll.IRBuilder(bb)
         self.cge.builder = builder
 
         for name, var in self.module.namestore.all(ir.GlobalVariable):
+            if var.isConstant():
+                # compiled in where it is loaded
+                continue
             var.translate(self.cge)
-
-        llvm_args = [arg.translate(self.cge) for arg in self.module.entry_args]
+            if isinstance(var.initial_value, tp.Const) and not var.type.on_heap:
+                # Reset the global in case the code is run more than once
+                builder.store(var.llvm.initializer, var.llvm)
+
+        llvm_args = []
+        for i, arg in enumerate(self.module.entry_args):
+            if i in self.params:
+                llvm_args.append(func.args[self.params.index(i)])
+            else:
+                llvm_args.append(arg.translate(self.cge))
 
         call = builder.call(impl.llvm, llvm_args)
 
@@ -123,21 +316,38 @@ class Program(object):
             builder.ret(call)
         return func
 
+    def _isReusable(self):
+        """True if the compiled code does not depend on the specific values of
+        the arguments it was compiled for, i.e. it can be cached.
+
+        Objects and lists stored in globals are still compiled in as addresses.
+        """
+        for name, var in self.module.namestore.all(ir.GlobalVariable):
+            if var.type.on_heap and not isinstance(var.initial_value, tp.NumpyArray):
+                return False
+        return True
+
     def elapsed(self):
         if self.start is None or self.end is None:
             return None
         return self.end - self.start
 
-    def optimize(self, opt):
+    def optimize(self, opt, loop_vectorize=False, slp_vectorize=False, unroll=True):
         if opt is not None:
             logging.warn("Running optimizations level {0}... ".format(opt))
 
-            # TODO was build_pass_managers(tm, opt=opt, loop_vectorize=True, fpm=False)
-            pmb = llvm.create_pass_manager_builder()
-            pmb.opt_level = opt
-            pm = llvm.create_module_pass_manager()
-            pmb.populate(pm)
-            pm.run(self.llmod())
+            llmod = self.llmod()
+            with utils.llvm_lock:
+                pmb = llvm.create_pass_manager_builder()
+                pmb.opt_level = opt
+                pmb.loop_vectorize = loop_vectorize
+                pmb.slp_vectorize = slp_vectorize
+                pmb.disable_unroll_loops = not unroll
+                pm = llvm.create_module_pass_manager()
+                self.target_machine.add_analysis_passes(pm)
+                pmb.populate(pm)
+                with utils.timed(self.stats, 'optimize'):
+                    pm.run(llmod)
 
     def destruct(self):
         self.module.destruct()
@@ -146,52 +356,115 @@ class Program(object):
     def __del__(self):
         logging.debug("DEL  {}: {}".format(repr(self), hasattr(self, 'module')))
 
-    def run(self, stats):
-        logging.debug("Preparing execution...")
+    def jit(self):
+        """Compile to machine code. The code stays in the engine until close()."""
+        if self.cfunc is not None:
+            return
 
-        import ctypes
-        import llvmlite
-        import os
+        logging.debug("Preparing execution...")
 
-        _lib_dir = os.path.dirname(llvm.ffi.__file__)
-        clib = ctypes.CDLL(os.path.join(_lib_dir, llvmlite.utils.get_library_name()))
-        # Direct access as below mangles the name
-        # f = clib.__powidf2
-        f = getattr(clib, '__powidf2')
-        llvm.add_symbol('__powidf2', ctypes.cast(f, ctypes.c_void_p).value)
+        self.addToEngine()
 
-        with llvm.create_mcjit_compiler(self.llmod(), self.target_machine) as ee:
-            ee.finalize_object()
+        entry = self.module.entry
+        self.ret_type = entry.result.type
+        self.entry_type = entry.type_
 
-            entry = self.module.entry
-            ret_type = entry.result.type
+        entry_ptr = self.jit_engine.getAddress(self.llvm.name)
+        self.arg_ctypes = []
+        for i in self.params:
+            type_ = self.module.entry_args[i].type
+            if type_.on_heap:
+                self.arg_ctypes.append(ctypes.c_void_p)
+            else:
+                self.arg_ctypes.append(type_.Ctype())
+        self._bind(entry_ptr)
+
+    def addToEngine(self):
+        """Generate the machine code. Only LLVM is involved, so unlike the rest
+        of the program this may run concurrently with the analysis."""
+        if not self.in_engine:
+            llmod = self.llmod()
+            with utils.timed(self.stats, 'finalize'):
+                self.jit_engine.addModule(llmod)
+            self.in_engine = True
 
-            logging.info("running {0}{1}".format(entry,
-                                                 list(zip(entry.type_.arg_types,
-                                                          self.module.entry_args))))
+    def run(self, stats):
+        """Compile and run once with the arguments the program was analyzed for."""
+        self.jit()
 
-            entry_ptr = ee.get_pointer_to_global(self.llmod().get_function(self.llvm.name))
-            ret_ctype = entry.result.type.Ctype()
-            if ret_type.on_heap:
-                ret_ctype = ctypes.POINTER(ret_ctype)
-            cfunc = ctypes.CFUNCTYPE(ret_ctype)(entry_ptr)
+        entry = self.module.entry
+        logging.info("running {0}{1}".format(entry,
+                                             list(zip(entry.type_.arg_types,
+                                                      self.module.entry_args))))
 
-            time_start = time.time()
-            retval = cfunc()
-            stats['elapsed'] = time.time() - time_start
+        with context.use(self.module.context):
+            args = [native.resident_arg(self.module.entry_args[i]) for i in self.params]
+            retval = self._invoke(args, stats)
 
-        for arg in self.module.entry_args:
-            arg.ctype2Python(self.cge)  # may be a no-op if not necessary
+        logging.debug("Returning...")
+        self.close()
 
-        retval = ret_type.unpack(retval)
+        return retval
 
-        logging.debug("Returning...")
+    def release(self):
+        """Free the analysis state once the code is compiled, keeping only what
+        call() needs."""
+        self.jit()
+        self.guards = self.module.guards
         self.destruct()
 
-        return retval
+    def _close(self):
+        """Free the machine code. Releases the analysis state if still present."""
+        if hasattr(self, 'module'):
+            self.destruct()
+        if self.in_engine:
+            self.jit_engine.removeModule(self._llmod)
+            self.in_engine = False
+            self._llmod = None
+        super()._close()
+
+    def describe(self):
+        """The information needed to call the compiled code from another
+        process, or None if it cannot be stored in a cache.DiskCache.
+
+        Must be called before release().
+        """
+        if not self.reusable or self.module.getExternalModules():
+            return None
+        # globals are initialized with their values at compile time, and may
+        # be compiled in as addresses. Constants are guarded by value.
+        if not all(var.isConstant() for _, var in self.module.namestore.all(ir.GlobalVariable)):
+            return None
+
+        entry = self.module.entry
+        ret_type = native.describe_type(entry.result.type)
+        arg_types = [native.describe_type(self.module.entry_args[i].type) for i in self.params]
+        guards = cache.guard_fingerprints(self.module.guards)
+        if ret_type is None or entry.result.type.on_heap or None in arg_types \
+                or guards is None:
+            return None
+
+        return {'name': str(entry.function),
+                'stub': self.llvm.name,
+                'params': self.params,
+                'arg_types': arg_types,
+                'ret_type': ret_type,
+                'static_shape': self.static_shape,
+                'cpu': self.cpu,
+                'features': self.features,
+                'written': sorted(self.module.written),
+                'guards': guards}
+
+    def emitObject(self):
+        """Returns the object code of the program."""
+        llmod = self.llmod()
+        with utils.llvm_lock, utils.timed(self.stats, 'emit_object'):
+            return self.target_machine.emit_object(llmod)
 
     def getAssembly(self):
-        return self.target_machine.emit_assembly(self.llmod())
+        llmod = self.llmod()
+        with utils.llvm_lock:
+            return self.target_machine.emit_assembly(llmod)
 
     def getLlvmIR(self):
         ret = self.module.getLlvmIR()
@@ -200,3 +473,38 @@ class Program(object):
         self.destruct()
 
         return ret
+
+
+class CachedProgram(native.NativeCode):
+    """Object code loaded from a cache.DiskCache instead of being compiled."""
+    reusable = True
+
+    @classmethod
+    def load(klass, f, entry):
+        """Returns the program for the Python function f, or None if a global
+        it depends on has changed."""
+        guards = cache.resolve_guards(entry['guards'])
+        if guards is None:
+            return None
+        return klass(f, entry, guards)
+
+    def __init__(self, f, entry, guards):
+        # the object code must be loaded into an engine for its target
+        jit_engine = JIT.get(entry.get('cpu', ''), entry.get('features', ''))
+
+        self.name = entry['name']
+        self.guards = guards
+        self.entry_type = tp.FunctionType(f)
+        self.params = entry['params']
+        self.static_shape = entry['static_shape']
+        self.ret_type = native.type_from_description(entry['ret_type'])
+        self.arg_ctypes = native.arg_ctypes(entry['arg_types'])
+
+        jit_engine.addObject(entry['object'])
+        self.cge = CGEnv()
+        if 'written' in entry:
+            self.cge.written = set(entry['written'])
+        self._bind(jit_engine.getAddress(entry['stub']))
+
+    def __str__(self):
+        return "<cached program {}>".format(self.name)
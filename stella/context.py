@@ -0,0 +1,89 @@
+# Copyright 2013-2015 David Mohr
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+The state of one compilation or call.
+
+Types and wrapped values are cached while a function is analyzed and while
+compiled code is called. Every analysis and every call has a Context of its
+own, which is current for the thread doing the work, see use(). Several
+threads can therefore compile and call at the same time.
+"""
+import contextlib
+import threading
+
+
+class Context(object):
+    def __init__(self, static_shape=False, types=None):
+        """The type caches of the Context types are shared instead of
+        starting empty, e.g. by the calls of a compiled program."""
+        # compile the shape of numpy arrays into the code, see tp.DynArrayType
+        self.static_shape = static_shape
+        # (ir.Function, ir.Module) -> analysis.Function
+        self.functions = {}
+        # caches of tp.FunctionType.get(), tp.StructType.fromObj(),
+        # tp.ListType and tp.CType.getStruct()
+        self.shared = types is not None
+        if self.shared:
+            self.function_types = types.function_types
+            self.struct_types = types.struct_types
+            self.list_types = types.list_types
+            self.ctypes = types.ctypes
+        else:
+            self.function_types = {}
+            self.struct_types = {}
+            self.list_types = {}
+            self.ctypes = {}
+        # id(obj) -> the wrapper of obj, see tp.Struct and tp.List
+        self.structs = {}
+        self.lists = {}
+        # address of the transfer value -> tp.Struct, to map returned objects
+        # back to Python
+        self.objects = {}
+        # wrapped values with transfer values to free
+        self.values = []
+
+    def destruct(self):
+        """Free the transfer values and forget all cached types, except for
+        shared ones."""
+        for value in self.values:
+            value.destruct()
+        self.values = []
+        stores = [self.functions, self.structs, self.lists, self.objects]
+        if not self.shared:
+            stores += [self.function_types, self.struct_types, self.list_types, self.ctypes]
+        for store in stores:
+            store.clear()
+
+
+_local = threading.local()
+
+
+def current():
+    """The context of this thread. Outside of use() every thread has a default
+    context."""
+    ctx = getattr(_local, 'context', None)
+    if ctx is None:
+        ctx = _local.context = Context()
+    return ctx
+
+
+@contextlib.contextmanager
+def use(ctx):
+    """Make ctx the current context of this thread."""
+    previous = getattr(_local, 'context', None)
+    _local.context = ctx
+    try:
+        yield ctx
+    finally:
+        _local.context = previous
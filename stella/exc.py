@@ -63,6 +63,10 @@ class TypeError(StellaException, TypeError):
         self.addDebug(debuginfo)
 
 
+class ValueError(StellaException, ValueError):
+    pass
+
+
 class UnimplementedError(StellaException):
     pass
 
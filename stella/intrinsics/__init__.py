@@ -22,7 +22,7 @@ import builtins
 import llvmlite.ir as ll
 
 from . import python
-from .. import tp, exc
+from .. import tp, exc, parallel, rng
 from ..storage import Register
 import numpy as np
 
@@ -43,6 +43,10 @@ class Intrinsic(tp.Foreign, tp.Callable):
     def getResult(self, func):
         return Register(func)
 
+    def calls(self, args, kw_args):
+        """Returns the (function, args) which the intrinsic calls."""
+        return []
+
 
 class Zeros(Intrinsic):
     py_func = python.zeros
@@ -72,7 +76,8 @@ class Zeros(Intrinsic):
 
 class Len(Intrinsic):
     """
-    Determine the length of the array based on its type.
+    Determine the length of the array, at run time unless its shape is
+    static.
     """
     py_func = len
     arg_names = ['obj']
@@ -80,11 +85,6 @@ class Len(Intrinsic):
     def getReturnType(self, args, kw_args):
         return tp.Int
 
-    def getResult(self, func):
-        # we need the reference to back-patch
-        self.result = tp.Const(-42)
-        return self.result
-
     def call(self, cge, args, kw_args):
         obj = args[0]
         if obj.type.isReference():
@@ -93,9 +93,7 @@ class Len(Intrinsic):
             type_ = obj.type
         if not isinstance(type_, tp.ArrayType):
             raise exc.TypeError("Invalid array type {0}".format(obj.type))
-        self.result.value = type_.shape
-        self.result.translate(cge)
-        return self.result.llvm
+        return type_.loadLength(cge, obj)
 
 
 class Log(Intrinsic):
@@ -264,6 +262,9 @@ class Tuple(Intrinsic):
     def getReturnType(self, args, kw_args):
         type_ = args[0].type.dereference()
         assert isinstance(type_, tp.Subscriptable)
+        if isinstance(type_, tp.DynArrayType):
+            raise exc.TypeError("tuple() requires an array with a static shape, see "
+                                "wrap(static_shape=True)")
         # there are no Nd tuples, accept only 1d
         assert not isinstance(type_.shape, list)
 
@@ -284,6 +285,337 @@ class Tuple(Intrinsic):
         return llvm
 
 
+_i8p = ll.IntType(8).as_pointer()
+
+
+def _declare(llmod, name, fnty):
+    try:
+        return llmod.get_global(name)
+    except KeyError:
+        return ll.Function(llmod, fnty, name=name)
+
+
+def _loop(builder, start, stop, value, emit):
+    """Emit `for i in range(start, stop)' which carries value from one
+    iteration to the next. emit(builder, i, value) generates the body and
+    returns the next value. Returns the final value."""
+    fn = builder.function
+    pre = builder.block
+    loop = fn.append_basic_block('loop')
+    body = fn.append_basic_block('body')
+    done = fn.append_basic_block('done')
+    builder.branch(loop)
+
+    builder.position_at_end(loop)
+    i = builder.phi(start.type)
+    i.add_incoming(start, pre)
+    phi = None
+    if value is not None:
+        phi = builder.phi(value.type)
+        phi.add_incoming(value, pre)
+    builder.cbranch(builder.icmp_signed('<', i, stop), body, done)
+
+    builder.position_at_end(body)
+    next_value = emit(builder, i, phi)
+    i.add_incoming(builder.add(i, ll.Constant(i.type, 1)), builder.block)
+    if phi is not None:
+        phi.add_incoming(next_value, builder.block)
+    builder.branch(loop)
+
+    builder.position_at_end(done)
+    return phi
+
+
+class Uniform(Intrinsic):
+    """
+    rng.uniform(): a step of xoshiro256** inlined into the caller.
+
+    The state stays in the struct of the generator object, every call loads
+    and stores the four words.
+    """
+    py_func = rng.uniform
+    arg_names = ['gen']
+    words = ['s0', 's1', 's2', 's3']
+
+    def checkState(self, gen):
+        if gen.type == tp.NoType:
+            # not known yet, the analysis will come back to it
+            return
+        type_ = gen.type.dereference()
+        if not isinstance(type_, tp.StructType) or any(
+                word not in type_.attrib_type or type_.getMemberType(word) != tp.Int
+                for word in self.words):
+            raise exc.TypeError("Expected a random number generator, got {0}".format(gen.type))
+
+    def getReturnType(self, args, kw_args):
+        self.checkState(args[0])
+        return tp.Float
+
+    def next(self, cge, gen):
+        """Emit one step of the generator and return its 64 random bits."""
+        builder = cge.builder
+        type_ = gen.type.dereference()
+        struct_llvm = gen.translate(cge)
+        ptrs = []
+        s = []
+        for word in self.words:
+            p = builder.gep(struct_llvm, [tp.Int.constant(0),
+                                          tp.getIndex(type_.getMemberIdx(word))], inbounds=True)
+            ptrs.append(p)
+            s.append(builder.load(p))
+            cge.module.annotateAccess(s[-1], type_.fieldName(word))
+
+        def rotl(x, k):
+            return builder.or_(builder.shl(x, tp.Int.constant(k)),
+                               builder.lshr(x, tp.Int.constant(64 - k)))
+
+        result = builder.mul(rotl(builder.mul(s[1], tp.Int.constant(5)), 7),
+                             tp.Int.constant(9))
+        t = builder.shl(s[1], tp.Int.constant(17))
+        s[2] = builder.xor(s[2], s[0])
+        s[3] = builder.xor(s[3], s[1])
+        s[1] = builder.xor(s[1], s[2])
+        s[0] = builder.xor(s[0], s[3])
+        s[2] = builder.xor(s[2], t)
+        s[3] = rotl(s[3], 45)
+
+        for word, p, value in zip(self.words, ptrs, s):
+            instr = builder.store(value, p)
+            cge.module.annotateAccess(instr, type_.fieldName(word))
+            cge.module.written.add(type_.fieldName(word))
+        return result
+
+    def uniform(self, cge, gen):
+        bits = cge.builder.lshr(self.next(cge, gen), tp.Int.constant(11))
+        return cge.builder.fmul(cge.builder.sitofp(bits, tp.tp_double),
+                                tp.Float.constant(2.0 ** -53))
+
+    def log1m(self, cge, x):
+        """log(1 - x)"""
+        builder = cge.builder
+        log = cge.module.llvm.declare_intrinsic('llvm.log', [tp.tp_double])
+        return builder.call(log, [builder.fsub(tp.Float.constant(1.0), x)])
+
+    def call(self, cge, args, kw_args):
+        return self.uniform(cge, args[0])
+
+
+class Exponential(Uniform):
+    py_func = rng.exponential
+    arg_names = ['gen', 'rate']
+
+    def call(self, cge, args, kw_args):
+        rate = args[1]
+        if rate.type == tp.Int:
+            rate = tp.Cast(rate, tp.Float)
+        x = self.log1m(cge, self.uniform(cge, args[0]))
+        return cge.builder.fdiv(cge.builder.fmul(x, tp.Float.constant(-1.0)),
+                                rate.translate(cge))
+
+
+class Normal(Uniform):
+    py_func = rng.normal
+    arg_names = ['gen']
+
+    def call(self, cge, args, kw_args):
+        builder = cge.builder
+        u1 = self.uniform(cge, args[0])
+        u2 = self.uniform(cge, args[0])
+        sqrt = cge.module.llvm.declare_intrinsic('llvm.sqrt', [tp.tp_double])
+        cos = cge.module.llvm.declare_intrinsic('llvm.cos', [tp.tp_double])
+        r = builder.call(sqrt, [builder.fmul(tp.Float.constant(-2.0), self.log1m(cge, u1))])
+        phi = builder.call(cos, [builder.fmul(tp.Float.constant(2.0 * math.pi), u2)])
+        return builder.fmul(r, phi)
+
+
+class Randint(Uniform):
+    py_func = rng.randint
+    arg_names = ['gen', 'low', 'high']
+
+    def getReturnType(self, args, kw_args):
+        self.checkState(args[0])
+        for arg in args[1:]:
+            if arg.type not in (tp.Int, tp.NoType):
+                raise exc.TypeError("randint() bounds must be integers, got {0}".format(
+                    arg.type))
+        low, high = args[1:3]
+        if isinstance(low, tp.Const) and isinstance(high, tp.Const) and high.value < low.value:
+            raise exc.ValueError("empty range for randint({}, {})".format(low.value, high.value))
+        return tp.Int
+
+    def call(self, cge, args, kw_args):
+        """An empty range at run time results in low instead of a division
+        by zero, see rng.randint()."""
+        builder = cge.builder
+        low = args[1].translate(cge)
+        high = args[2].translate(cge)
+        n = builder.add(builder.sub(high, low), tp.Int.constant(1))
+        one = tp.Int.constant(1)
+        n = builder.select(builder.icmp_signed('<', n, one), one, n)
+        # drop the sign bit, then the remainder is never negative
+        bits = builder.lshr(self.next(cge, args[0]), tp.Int.constant(1))
+        return builder.add(low, builder.srem(bits, n))
+
+
+class PRange(Intrinsic):
+    """
+    A loop over stella.prange() as rewritten by parallel.outline().
+
+    The loop body is called from a chunk function, which parallel_for() runs
+    on its threads. Every thread accumulates into its own partial result,
+    which are combined after the loop.
+    """
+    py_func = parallel.prange_run
+    arg_names = ['body', 'start', 'stop', 'chunk', 'schedule', 'reduction']
+
+    _identity = {parallel.ADD: (0, 0.0),
+                 parallel.MUL: (1, 1.0),
+                 parallel.MIN: (2**63 - 1, float('inf')),
+                 parallel.MAX: (-2**63, float('-inf'))}
+
+    def split(self, args):
+        body, start, stop, chunk, schedule, reduction = args[:6]
+        if reduction.value == parallel.NONE:
+            acc, captured = None, args[6:]
+        else:
+            acc, captured = args[6], args[7:]
+        return body, (start, stop, chunk), schedule.value, reduction.value, acc, list(captured)
+
+    def calls(self, args, kw_args):
+        body, (start, _, _), _, _, acc, captured = self.split(args)
+        return [(body, [start] + ([] if acc is None else [acc]) + captured)]
+
+    def getReturnType(self, args, kw_args):
+        body, bounds, _, reduction, acc, _ = self.split(args)
+        for arg in bounds:
+            if arg.type not in (tp.Int, tp.NoType):
+                raise exc.TypeError("prange() requires int arguments, not {}".format(arg.type))
+        if reduction == parallel.NONE:
+            return tp.Void
+
+        type_ = body.getReturnType(None, None)
+        if type_ == tp.NoType:
+            return type_
+        if type_ not in (tp.Int, tp.Float):
+            raise exc.TypeError("prange loops can only accumulate int or float, not {}".format(
+                type_))
+        if type_ != acc.type:
+            raise exc.TypeError("The prange loop accumulates a {} into a variable of type {}, "
+                                "initialize it with a {}".format(type_, acc.type, type_))
+        return type_
+
+    def reduce(self, builder, reduction, x, y):
+        is_float = isinstance(x.type, ll.DoubleType)
+        if reduction == parallel.ADD:
+            return builder.fadd(x, y) if is_float else builder.add(x, y)
+        elif reduction == parallel.MUL:
+            return builder.fmul(x, y) if is_float else builder.mul(x, y)
+        op = '<' if reduction == parallel.MIN else '>'
+        if is_float:
+            cond = builder.fcmp_ordered(op, y, x)
+        else:
+            cond = builder.icmp_signed(op, y, x)
+        return builder.select(cond, y, x)
+
+    def chunkFunction(self, llmod, body, env_type, reduction):
+        """void chunk(i8* env, i64 start, i64 stop, i64 worker)"""
+        fn = ll.Function(llmod, ll.FunctionType(ll.VoidType(), [_i8p] + [tp.tp_int] * 3),
+                         name=llmod.get_unique_name('__prange_chunk'))
+        fn.linkage = 'internal'
+        env, start, stop, worker = fn.args
+        builder = ll.IRBuilder(fn.append_basic_block('entry'))
+        env = builder.bitcast(env, env_type.as_pointer())
+        fields = [builder.load(builder.gep(env, [tp.getIndex(0), tp.getIndex(i)]))
+                  for i in range(len(env_type.elements))]
+
+        acc = partial = None
+        if reduction != parallel.NONE:
+            partial = builder.gep(fields.pop(), [worker])
+            acc = builder.load(partial)
+
+        def emit(builder, i, acc):
+            args = [i] + ([] if acc is None else [acc]) + fields
+            return builder.call(body.llvm, args)
+
+        acc = _loop(builder, start, stop, acc, emit)
+        if partial is not None:
+            builder.store(acc, partial)
+        builder.ret_void()
+        return fn
+
+    def combineFunction(self, llmod, type_, reduction):
+        """void init(T* partials, i64 n) and T combine(T* partials, i64 n, T acc)"""
+        identity = ll.Constant(type_, self._identity[reduction][isinstance(type_, ll.DoubleType)])
+        pointer = type_.as_pointer()
+
+        init = ll.Function(llmod, ll.FunctionType(ll.VoidType(), [pointer, tp.tp_int]),
+                           name=llmod.get_unique_name('__prange_init'))
+        init.linkage = 'internal'
+        partials, n = init.args
+        builder = ll.IRBuilder(init.append_basic_block('entry'))
+
+        def emit_init(builder, i, _):
+            builder.store(identity, builder.gep(partials, [i]))
+        _loop(builder, ll.Constant(tp.tp_int, 0), n, None, emit_init)
+        builder.ret_void()
+
+        combine = ll.Function(llmod, ll.FunctionType(type_, [pointer, tp.tp_int, type_]),
+                              name=llmod.get_unique_name('__prange_combine'))
+        combine.linkage = 'internal'
+        partials, n, acc = combine.args
+        builder = ll.IRBuilder(combine.append_basic_block('entry'))
+
+        def emit_combine(builder, i, acc):
+            return self.reduce(builder, reduction, acc, builder.load(builder.gep(partials, [i])))
+        builder.ret(_loop(builder, ll.Constant(tp.tp_int, 0), n, acc, emit_combine))
+        return init, combine
+
+    def call(self, cge, args, kw_args):
+        body, bounds, schedule, reduction, acc, captured = self.split(args)
+        llmod = cge.module.llvm
+        builder = cge.builder
+        cge.module.runtime_symbols.update(['stella_parallel_for', 'stella_num_threads'])
+
+        fields = [arg.llvmType(cge.module) for arg in captured]
+        if reduction != parallel.NONE:
+            type_ = acc.llvmType(cge.module)
+            fields.append(type_.as_pointer())
+        env_type = ll.LiteralStructType(fields)
+        chunk_fn = self.chunkFunction(llmod, body, env_type, reduction)
+
+        parallel_for = _declare(llmod, 'stella_parallel_for', ll.FunctionType(
+            ll.VoidType(), [chunk_fn.type, _i8p] + [tp.tp_int] * 4))
+        num_threads = _declare(llmod, 'stella_num_threads', ll.FunctionType(tp.tp_int, []))
+        # the allocations are released after the loop, which may be nested
+        # in another one
+        stacksave = _declare(llmod, 'llvm.stacksave', ll.FunctionType(_i8p, []))
+        stackrestore = _declare(llmod, 'llvm.stackrestore',
+                                ll.FunctionType(ll.VoidType(), [_i8p]))
+
+        stack = builder.call(stacksave, [])
+        env = builder.alloca(env_type)
+        for i, arg in enumerate(captured):
+            builder.store(arg.translate(cge),
+                          builder.gep(env, [tp.getIndex(0), tp.getIndex(i)]))
+        if reduction != parallel.NONE:
+            init, combine = self.combineFunction(llmod, type_, reduction)
+            n = builder.call(num_threads, [])
+            partials = builder.alloca(type_, size=n)
+            builder.call(init, [partials, n])
+            builder.store(partials, builder.gep(env, [tp.getIndex(0),
+                                                      tp.getIndex(len(captured))]))
+
+        builder.call(parallel_for, [chunk_fn, builder.bitcast(env, _i8p)] +
+                     [arg.translate(cge) for arg in bounds] +
+                     [ll.Constant(tp.tp_int, schedule)])
+
+        result = None
+        if reduction != parallel.NONE:
+            result = builder.call(combine, [partials, n, acc.translate(cge)])
+        builder.call(stackrestore, [stack])
+        return result
+
+
 casts = (int, float, bool, tuple)
 
 
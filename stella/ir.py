@@ -18,6 +18,7 @@ import sys
 from abc import ABCMeta, abstractmethod
 import ctypes
 import inspect
+import itertools
 
 import llvmlite.ir as ll
 import llvmlite.binding as llvm
@@ -27,6 +28,7 @@ from . import utils
 from . import tp
 from .storage import Register, StackLoc, GlobalVariable
 from . import intrinsics
+from . import parallel
 
 
 @utils.linkedlist
@@ -232,16 +234,35 @@ class Globals(object):
 
 
 class Module(object):
-    i = 0
+    # numbers the LLVM modules, next() is atomic so that concurrent
+    # compilations get distinct names
+    _numbers = itertools.count()
 
-    def __init__(self):
+    def __init__(self, ctx):
         super().__init__()
+        # the types and values of this compilation, see context.Context
+        self.context = ctx
         self._todo = []
+        # callee -> the functions calling it, see functionCall()
+        self._callers = {}
+        # see utils.timed()
+        self.stats = {}
+        # registers of array arguments of the entry function whose memory
+        # does not overlap, see annotateAccess()
+        self.noalias_args = []
+        # functions the compiled code needs from the process, e.g. for prange
+        self.runtime_symbols = set()
         self.entry = None
         self.llvm = None
         self.namestore = Globals()
         self.external_modules = dict()
         self._cleanup = []
+        # (dict, key, value) of every Python global the program was compiled
+        # with, see native.guards_valid()
+        self.guards = []
+        # the fields assigned by the compiled code, see tp.StructType.fieldName()
+        # and tp.StructType.modified()
+        self.written = set()
         self.log = logging.getLogger(str(self))
 
     def _getFunction(self, item):
@@ -315,6 +336,7 @@ class Module(object):
                 raise e
 
             item = module.__dict__[attr]
+            self.guards.append((module.__dict__, attr, item))
             if hasattr(module, '__file__') and module.__file__[-3:] == '.so' and \
                     type(item) == type(print):
                 # external module
@@ -343,8 +365,12 @@ class Module(object):
                 item = len
             elif key in __builtins__:
                 item = __builtins__[key]
+            elif key in parallel.namespace:
+                # functions generated for prange loops
+                item = parallel.namespace[key]
             elif key in func.pyFunc().__globals__:
                 item = func.pyFunc().__globals__[key]
+                self.guards.append((func.pyFunc().__globals__, key, item))
             else:
                 raise e
             wrapped = self._wrapPython(key, item)
@@ -366,17 +392,28 @@ class Module(object):
         self.namestore[name] = wrapped
         return wrapped
 
-    def functionCall(self, funcref, args, kwargs):
+    def functionCall(self, caller, funcref, args, kwargs):
+        """caller calls funcref. It is analyzed if it was not yet, and caller
+        is retyped whenever the return type of funcref changes."""
         func = funcref.function
         if isinstance(func, tp.Foreign):
             # no need to analyze it
             return
 
+        self._callers.setdefault(func, set()).add(caller)
         if kwargs is None:
             kwargs = {}
-        if not func.analyzed or func.result.type is tp.NoType:
+        if not func.analyzed:
             self.todoAdd(funcref, args, kwargs)
 
+    def callers(self, func):
+        return self._callers.get(func, set())
+
+    def returnTypeChanged(self, func):
+        """Queue all callers of func for retyping."""
+        for caller in self.callers(func):
+            caller.analyzeAgain()
+
     def todoAdd(self, func, args, kwargs):
         # If the function was already in the list to be analyzed, remove it
         # so that it is only present once at the end
@@ -404,11 +441,50 @@ class Module(object):
         return self._todo
 
     def translate(self):
-        self.llvm = ll.Module('__stella__'+str(self.__class__.i), context=ll.context.Context())
-        self.__class__.i += 1
+        self.llvm = ll.Module('__stella__' + str(next(Module._numbers)),
+                              context=ll.context.Context())
+        self._tbaa = {}
+        self._tbaa_root = self.llvm.add_metadata([ll.MetaDataString(self.llvm, 'stella TBAA')])
+        self._makeAliasScopes()
         for _, impl in self.namestore.all(Function):
             impl.translate(self)
 
+    def _makeAliasScopes(self):
+        """One alias scope per array in noalias_args. An access to one of them
+        is known not to alias accesses to the others."""
+        self._alias_scopes = {}
+        if len(self.noalias_args) < 2:
+            return
+        domain = self.llvm.add_metadata([ll.MetaDataString(self.llvm,
+                                                           self.llvm.name + ' arguments')])
+        scopes = [self.llvm.add_metadata([ll.MetaDataString(
+            self.llvm, '{} {}'.format(self.llvm.name, reg.name)), domain])
+            for reg in self.noalias_args]
+        for i, reg in enumerate(self.noalias_args):
+            others = scopes[:i] + scopes[i+1:]
+            self._alias_scopes[id(reg)] = (self.llvm.add_metadata([scopes[i]]),
+                                           self.llvm.add_metadata(others))
+
+    def tbaa(self, name):
+        """The TBAA access tag for memory holding values called name. Accesses
+        with different names never alias."""
+        if name not in self._tbaa:
+            offset = ll.Constant(ll.IntType(64), 0)
+            node = self.llvm.add_metadata([ll.MetaDataString(self.llvm, name), self._tbaa_root,
+                                           offset])
+            self._tbaa[name] = self.llvm.add_metadata([node, node, offset])
+        return self._tbaa[name]
+
+    def annotateAccess(self, instr, name, container=None):
+        """Attach the aliasing information to the load or store instr of a
+        value called name, see tbaa(). container is the array accessed, if
+        any."""
+        instr.set_metadata('tbaa', self.tbaa(name))
+        if container is not None and id(container) in self._alias_scopes:
+            scope, noalias = self._alias_scopes[id(container)]
+            instr.set_metadata('alias.scope', scope)
+            instr.set_metadata('noalias', noalias)
+
     def destruct(self):
         """Clean up this objects so that gc will succeed.
 
@@ -531,10 +607,16 @@ class Function(Scope):
 
         func_tp = ll.FunctionType(self.result.type.llvmType(module), self.arg_types)
         self.llvm = ll.Function(module.llvm, func_tp, name=self.name)
+        # only the stub is called from outside, and the names must not clash
+        # with other modules in the same execution engine
+        self.llvm.linkage = 'internal'
 
         for i in range(len(self.args)):
             self.llvm.args[i].name = self.args[i].name
             self.args[i].llvm = self.llvm.args[i]
+            if isinstance(self.args[i].type.dereference(), tp.DynArrayType):
+                # array descriptors are only ever read
+                self.llvm.args[i].add_attribute('noalias')
 
     def remove(self, bc):
 
@@ -624,13 +706,13 @@ class BoundFunctionRef(FunctionRef):
 class ExtModule(object):
     python = None
     signatures = {}
-    funcs = dict()
 
     def __init__(self, python):
         assert type(python) == type(sys)
 
         self.python = python
         self.signatures = python.getCSignatures()
+        self.funcs = {}
 
         for name, sig in self.signatures.items():
             type_ = tp.ExtFunctionType(python, sig)
@@ -652,6 +734,68 @@ class ExtModule(object):
     def getFunctionRef(self, f):
         return ExtFunctionRef(self.funcs[f.__name__])
 
+    def getBitcode(self):
+        """The LLVM bitcode of the module, or None.
+
+        Like getCSignatures() this is provided by the module itself: an
+        optional getLLVMBitcode() returns the bitcode of the C code behind the
+        functions as bytes, or None if it is not available.
+        """
+        get = getattr(self.python, 'getLLVMBitcode', None)
+        if get is None:
+            return None
+        return get()
+
+    def link(self, llmod):
+        """Link the bitcode of the module into llmod so that LLVM can inline
+        its functions.
+
+        Symbols exported by the shared object stay there, their definitions
+        are only available_externally: the C library keeps a single state
+        shared with Python. Other functions become internal to llmod. A
+        variable which is not exported would get a second copy in llmod, so
+        then nothing is linked.
+        """
+        bitcode = self.getBitcode()
+        if bitcode is None:
+            return
+        try:
+            bcmod = llvm.parse_bitcode(bitcode)
+        except RuntimeError as e:
+            # e.g. produced by a newer version of LLVM
+            logging.warning("Ignoring the bitcode of {0}: {1}".format(self.python, e))
+            return
+        bcmod.triple = llmod.triple
+        bcmod.data_layout = llmod.data_layout
+
+        clib = ctypes.cdll.LoadLibrary(self.getFile())
+        exported = {}
+        for value in itertools.chain(bcmod.functions, bcmod.global_variables):
+            if value.is_declaration:
+                continue
+            address = None
+            if value.linkage == llvm.Linkage.external:
+                try:
+                    address = ctypes.addressof(ctypes.c_char.in_dll(clib, value.name))
+                except ValueError:
+                    pass
+            if address is not None:
+                exported[value.name] = address
+            elif not value.is_function and not _isConstant(value):
+                logging.warning("Ignoring the bitcode of {0}: the variable {1} is not exported "
+                                "by {2}".format(self.python, value.name, self.getFile()))
+                return
+
+        for value in itertools.chain(bcmod.functions, bcmod.global_variables):
+            if value.name in exported:
+                llvm.add_symbol(value.name, exported[value.name])
+                value.linkage = llvm.Linkage.available_externally
+            elif value.is_function and value.linkage == llvm.Linkage.external \
+                    and not value.is_declaration:
+                value.linkage = llvm.Linkage.internal
+        logging.debug("Linking the bitcode of {0}".format(self.python))
+        llmod.link_in(bcmod)
+
     def __str__(self):
         return str(self.python)
 
@@ -664,6 +808,16 @@ class ExtModule(object):
                 func.translate(clib, module)
 
 
+def _isConstant(variable):
+    """True if the global variable of a parsed module is read-only, e.g. a
+    string literal, so that a copy of it does no harm."""
+    # e.g. `@x = internal unnamed_addr constant [3 x i8] c"ab\00"'
+    for word in str(variable).split('=', 1)[1].split():
+        if word in ('constant', 'global'):
+            return word == 'constant'
+    return False
+
+
 class ExtFunction(tp.Foreign):
     llvm = None
     analyzed = True
@@ -684,7 +838,8 @@ class ExtFunction(tp.Foreign):
     def translate(self, clib, module):
         logging.debug("Adding external function {0}".format(self.name))
         f = getattr(clib, self.name)
-        llvm.add_symbol(self.name, ctypes.cast(f, ctypes.c_void_p).value)
+        with utils.llvm_lock:
+            llvm.add_symbol(self.name, ctypes.cast(f, ctypes.c_void_p).value)
 
         llvm_arg_types = [arg.llvmType(module) for arg in self.type_.arg_types]
 
@@ -0,0 +1,270 @@
+# Copyright 2013-2015 David Mohr
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Calling compiled code with Python values.
+
+This only requires the type wrappers of tp, not the LLVM library itself, so
+that it can also be used for code compiled ahead of time, see aot.
+"""
+import ctypes
+import threading
+
+from . import context
+from . import exc
+from . import parallel
+from . import tp
+from . import utils
+
+
+_missing = object()
+# protects NativeCode.active
+_calls_lock = threading.Lock()
+# id(obj) -> the Resident of obj
+_residents = {}
+
+
+def guards_valid(guards):
+    """True if none of the Python globals in guards was rebound since they were recorded."""
+    return all(d.get(key, _missing) is item for d, key, item in guards)
+
+
+_scalar_types = {type_.name: type_ for type_ in (tp.Int, tp.Float, tp.Bool, tp.None_)}
+
+
+def describe_type(type_):
+    """A name for type_ which can be stored on disk, or None."""
+    if isinstance(type_, tp.TupleType):
+        descs = [describe_type(t) for t in type_.types]
+        if None in descs:
+            return None
+        return descs
+    elif type_.on_heap:
+        return 'pointer'
+    elif _scalar_types.get(getattr(type_, 'name', None)) is type_:
+        return type_.name
+    return None
+
+
+def type_from_description(desc):
+    if isinstance(desc, list):
+        return tp.TupleType([type_from_description(d) for d in desc])
+    return _scalar_types[desc]
+
+
+def arg_ctypes(descs):
+    """The ctypes of the stub parameters described by describe_type()."""
+    ctypes_ = []
+    for desc in descs:
+        if desc == 'pointer':
+            ctypes_.append(ctypes.c_void_p)
+        else:
+            ctypes_.append(type_from_description(desc).Ctype())
+    return ctypes_
+
+
+class NativeCode(object):
+    """Calling compiled code with Python values.
+
+    Requires entry_type, params, ret_type, arg_ctypes, static_shape and guards.
+    """
+    cfunc = None
+    cge = None
+    guards = []
+    # tier 0 is compiled quickly, tier 1 with all optimizations, see wrap()
+    tier = 0
+    calls = 0
+    # calls running right now, see enter()
+    active = 0
+    _close_pending = False
+    # per thread: the Context holding the transfer types of the calls, see
+    # callContext()
+    _call_types = None
+
+    def _bind(self, entry_ptr):
+        ret_ctype = self.ret_type.Ctype()
+        if self.ret_type.on_heap:
+            ret_ctype = ctypes.POINTER(ret_ctype)
+        self.cfunc = ctypes.CFUNCTYPE(ret_ctype, *self.arg_ctypes)(entry_ptr)
+
+    def _invoke(self, args, stats):
+        """Call the native code with the wrapped arguments args and transfer
+        the results back."""
+        time_start = utils.clock_ns()
+        values = [arg.python2Ctype() for arg in args]
+
+        time_call = utils.clock_ns()
+        retval = self.cfunc(*values)
+        time_end = utils.clock_ns()
+        parallel.raise_failure()
+
+        for arg in args:
+            arg.ctype2Python(self.cge)  # may be a no-op if not necessary
+        retval = self.ret_type.unpack(retval)
+
+        utils.add_time(stats, 'marshal', time_call - time_start)
+        utils.add_time(stats, 'native', time_end - time_call)
+        utils.add_time(stats, 'write_back', utils.clock_ns() - time_end)
+        stats['elapsed'] = (time_end - time_call) / 1e9
+        return retval
+
+    def valid(self):
+        """False if a Python global used by the program has since been rebound."""
+        return guards_valid(self.guards)
+
+    def call(self, args, kwargs, stats):
+        """Run the compiled code with new arguments of the same types.
+
+        Precondition: the program is reusable and the machine code is ready.
+        For bound methods, args must start with self.
+        """
+        time_start = utils.clock_ns()
+        combined = self.entry_type._combineArgs(list(args), kwargs)
+        ctx = self.callContext()
+        with context.use(ctx):
+            try:
+                # default arguments are already wrapped
+                wrapped = [wrap_arg(combined[i]) for i in self.params]
+                utils.add_time(stats, 'marshal', utils.clock_ns() - time_start)
+                retval = self._invoke(wrapped, stats)
+            finally:
+                # free the transfer values of this call
+                ctx.destruct()
+        return retval
+
+    def callContext(self):
+        """A new Context for a call. The types of the transfer values, e.g.
+        the ctypes Structures of objects, are created by the first call and
+        reused by all later calls on the same thread."""
+        with _calls_lock:
+            if self._call_types is None:
+                self._call_types = threading.local()
+        types = getattr(self._call_types, 'context', None)
+        if types is None:
+            types = self._call_types.context = context.Context(self.static_shape)
+        return context.Context(self.static_shape, types)
+
+    def enter(self):
+        """A call is about to run: close() waits until it leave()s again.
+
+        Every call wraps its arguments in a context.Context of its own, so
+        several threads can run the code at the same time.
+        """
+        with _calls_lock:
+            self.active += 1
+
+    def leave(self):
+        with _calls_lock:
+            self.active -= 1
+            closing = self._close_pending and self.active == 0
+        if closing:
+            self._close()
+
+    def close(self):
+        """Free the machine code once no call is running it any more."""
+        with _calls_lock:
+            if self.active:
+                self._close_pending = True
+                return
+        self._close()
+
+    def _close(self):
+        self.cfunc = None
+
+
+def wrap_arg(value):
+    """Wrap the argument value of compiled code, or return its Resident."""
+    handle = _residents.get(id(value))
+    if handle is not None:
+        return handle
+    return tp.wrapValue(value)
+
+
+def resident_arg(wrapped):
+    """The Resident of the value of the wrapped argument, or wrapped."""
+    return _residents.get(id(getattr(wrapped, 'value', None)), wrapped)
+
+
+class Resident(tp.Typable):
+    """An object which lives in native memory, see resident()."""
+    def __init__(self, obj, static_shape=False):
+        if id(obj) in _residents:
+            raise exc.StellaException("{!r} is already resident".format(obj))
+        self.value = obj
+        self.context = context.Context(static_shape)
+        with context.use(self.context):
+            self.wrapped = tp.wrapValue(obj)
+            if not self.wrapped.type.on_heap:
+                raise exc.TypeError("Only objects and lists can be resident, not {}".format(
+                    self.wrapped.type))
+            self.type = self.wrapped.type
+            self.address = self.wrapped.python2Ctype()
+        _residents[id(obj)] = self
+
+    @property
+    def closed(self):
+        return _residents.get(id(self.value)) is not self
+
+    def python2Ctype(self):
+        return self.address
+
+    def ctype2Python(self, cge):
+        """Calls leave the results in native memory, see pull()."""
+        pass
+
+    def pull(self):
+        """Copy the native memory into the Python objects."""
+        with context.use(self.context):
+            self.wrapped.ctype2Python(None)
+
+    def push(self):
+        """Copy the Python objects into the native memory, e.g. after changing
+        them in Python. The types of their attributes and the lengths of their
+        lists must not change."""
+        with context.use(self.context):
+            for wrapped in list(self.context.values):
+                wrapped.ctypeUpdate()
+
+    def close(self):
+        """pull() and free the native memory. Calls use the Python objects
+        again afterwards."""
+        if self.closed:
+            return
+        self.pull()
+        del _residents[id(self.value)]
+        self.context.destruct()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __repr__(self):
+        return "<resident {!r}{}>".format(self.value, " (closed)" if self.closed else "")
+
+
+def resident(obj, static_shape=False):
+    """Move obj with the objects, lists and numpy arrays it refers to into
+    native memory once, instead of copying them for every call.
+
+    Calls of compiled code with obj, or bound methods of obj, then work on
+    that memory in place. The Python objects are only updated by pull() and
+    by close(). static_shape has to match that of wrap().
+
+        with stella.resident(sim) as handle:
+            for i in range(1000):
+                step(sim)
+            handle.pull()
+    """
+    return Resident(obj, static_shape)
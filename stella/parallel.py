@@ -0,0 +1,459 @@
+# Copyright 2013-2015 David Mohr
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Parallel loops.
+
+The body of a loop `for i in prange(...)' is moved into a function of its
+own before the function is analyzed, see outline(). The compiled code then
+calls the body for chunks of the iterations on a pool of native threads, see
+parallel_for(). Python is only involved once per chunk, not per iteration,
+and the GIL is released while a chunk runs.
+"""
+import ast
+import concurrent.futures
+import ctypes
+import inspect
+import itertools
+import logging
+import os
+import textwrap
+import threading
+import weakref
+
+from . import cache
+from . import exc
+
+STATIC = 0
+DYNAMIC = 1
+schedules = {'static': STATIC, 'dynamic': DYNAMIC}
+
+# reduction operators, see _Outliner.reduction()
+NONE, ADD, MUL, MIN, MAX = range(5)
+
+
+def prange(start, stop=None, chunk=0, schedule='static'):
+    """Like range(), but compiled code runs the iterations in parallel.
+
+    The iterations must be independent of each other. A single variable may
+    be accumulated with `+=', `*=', `min()' or `max()', other variables of
+    the function may only be read.
+
+    Parameters:
+        int chunk: the number of iterations a thread runs at once. By default
+                   `static' splits the range evenly between the threads.
+        str schedule: `static' assigns the chunks to the threads up front,
+                   `dynamic' hands them out as the threads become idle.
+
+    Executed by Python it is just a range().
+    """
+    if stop is None:
+        start, stop = 0, start
+    return range(start, stop)
+
+
+def prange_run(body, start, stop, chunk, schedule, reduction, *args):
+    """The loop as rewritten by outline(); intrinsics.PRange compiles it."""
+    if reduction == NONE:
+        for i in range(start, stop):
+            body(i, *args)
+        return None
+    acc = args[0]
+    for i in range(start, stop):
+        acc = body(i, acc, *args[1:])
+    return acc
+
+
+_run_name = '__stella_prange_run__'
+
+# The functions generated by outline(), by name. They are kept out of the
+# globals of the user's module, ir.Module.loadGlobal() looks them up here.
+# The rewritten functions keep their loop bodies alive.
+namespace = weakref.WeakValueDictionary({_run_name: prange_run})
+
+
+def _is_prange(obj):
+    """obj is prange() or stella.prange(), which imports it on first use."""
+    from . import prange as lazy_prange
+    return obj is prange or obj is lazy_prange
+
+
+def _parseStmt(src, lineno, col_offset):
+    """Parse a single statement generated from src and place it at lineno."""
+    stmt = ast.parse(src).body[0]
+    for node in ast.walk(stmt):
+        if 'lineno' in node._attributes:
+            node.lineno = lineno
+            node.col_offset = col_offset
+            # Python >= 3.8
+            node.end_lineno = lineno
+            node.end_col_offset = col_offset
+    return stmt
+
+
+class _Control(ast.NodeTransformer):
+    """Turns `continue' in the loop body into a return from the body
+    function."""
+    def __init__(self, acc):
+        self.acc = acc
+
+    def _nested(self, node):
+        # break and continue of nested loops are fine
+        return node
+
+    visit_For = visit_While = visit_FunctionDef = visit_Lambda = _nested
+
+    def visit_Continue(self, node):
+        src = 'return {}'.format(self.acc) if self.acc else 'return'
+        return _parseStmt(src, node.lineno, node.col_offset)
+
+    def visit_Break(self, node):
+        raise exc.UnimplementedError("break in a prange loop at line {}".format(node.lineno))
+
+    def visit_Return(self, node):
+        raise exc.UnimplementedError("return in a prange loop at line {}".format(node.lineno))
+
+
+def _names(nodes, skip=None):
+    """Returns the sets of names read and written in nodes, except in skip."""
+    loads, stores = set(), set()
+    todo = list(nodes)
+    while todo:
+        node = todo.pop()
+        if node is skip:
+            continue
+        if isinstance(node, ast.Name):
+            (loads if isinstance(node.ctx, ast.Load) else stores).add(node.id)
+        elif isinstance(node, ast.arg):
+            stores.add(node.arg)
+        todo.extend(ast.iter_child_nodes(node))
+    return loads, stores
+
+
+class _Outliner(object):
+    """Rewrites every `for i in prange(...)' loop of f into a call of
+    prange_run() with the body as a new function."""
+    def __init__(self, f):
+        self.f = f
+        self.globals = f.__globals__
+        self.prefix = '__stella_prange_{}_{}'.format(f.__name__, cache.code_digest(f)[:12])
+        self.bodies = []
+        # the reduction operator of each body, see reduction()
+        self.reductions = {}
+
+    def isPrange(self, node):
+        if not isinstance(node, ast.Call):
+            return False
+        func = node.func
+        if isinstance(func, ast.Name):
+            return _is_prange(self.globals.get(func.id))
+        if isinstance(func, ast.Attribute) and isinstance(func.value, ast.Name):
+            return _is_prange(getattr(self.globals.get(func.value.id), func.attr, None))
+        return False
+
+    def rewrite(self):
+        try:
+            source = textwrap.dedent(inspect.getsource(self.f))
+        except (OSError, TypeError) as e:
+            raise exc.UnimplementedError("prange needs the source code of {}: {}".format(
+                self.f, e))
+        tree = ast.parse(source)
+        ast.increment_lineno(tree, self.f.__code__.co_firstlineno - 1)
+        self.fdef = tree.body[0]
+        # e.g. stella.jit() must not wrap the rewritten function again
+        self.fdef.decorator_list = []
+
+        self.fdef.body = self.transform(self.fdef.body, _names([self.fdef])[1])
+
+        tree.body = [self.fdef] + self.bodies
+        ast.fix_missing_locations(tree)
+        defined = {}
+        exec(compile(tree, self.f.__code__.co_filename, 'exec'), self.globals, defined)
+        for body in self.bodies:
+            namespace[body.name] = defined[body.name]
+
+        rewritten = defined[self.fdef.name]
+        rewritten.__defaults__ = self.f.__defaults__
+        rewritten.__kwdefaults__ = self.f.__kwdefaults__
+        rewritten.__stella_bodies__ = [defined[body.name] for body in self.bodies]
+        return rewritten
+
+    def transform(self, stmts, scope):
+        """scope are the local variables the statements can see."""
+        result = []
+        for stmt in stmts:
+            if isinstance(stmt, ast.For) and self.isPrange(stmt.iter):
+                result.append(self.outline(stmt, scope))
+                continue
+            for field in ('body', 'orelse', 'finalbody'):
+                block = getattr(stmt, field, None)
+                if isinstance(block, list):
+                    setattr(stmt, field, self.transform(block, scope))
+            result.append(stmt)
+        return result
+
+    def rangeArgs(self, call):
+        if len(call.args) > 3 or call.keywords and any(
+                kw.arg not in ('chunk', 'schedule') for kw in call.keywords):
+            raise exc.UnimplementedError("Unsupported arguments of prange at line {}".format(
+                call.lineno))
+        args = list(call.args)
+        if len(args) == 1:
+            args.insert(0, ast.parse('0', mode='eval').body)
+        start, stop = args[:2]
+        chunk = args[2] if len(args) == 3 else ast.parse('0', mode='eval').body
+        schedule = 'static'
+        for kw in call.keywords:
+            if kw.arg == 'chunk':
+                chunk = kw.value
+            else:
+                schedule = getattr(kw.value, 'value', getattr(kw.value, 's', None))
+        if schedule not in schedules:
+            raise exc.UnimplementedError("The schedule of prange must be one of {}".format(
+                ', '.join(repr(s) for s in sorted(schedules))))
+        return start, stop, chunk, schedules[schedule]
+
+    def reduction(self, body, scope):
+        """Returns the (name, operator) of the variable accumulated in body,
+        or (None, NONE)."""
+        ops = {}
+        for node in ast.walk(ast.Module(body=body)):
+            name, op = None, None
+            if isinstance(node, ast.AugAssign) and isinstance(node.target, ast.Name):
+                name = node.target.id
+                op = {ast.Add: ADD, ast.Mult: MUL}.get(type(node.op))
+            elif isinstance(node, ast.Assign) and len(node.targets) == 1 and \
+                    isinstance(node.targets[0], ast.Name):
+                name = node.targets[0].id
+                value = node.value
+                if isinstance(value, ast.Call) and isinstance(value.func, ast.Name) and \
+                        value.func.id in ('min', 'max') and len(value.args) == 2 and \
+                        any(isinstance(arg, ast.Name) and arg.id == name
+                            for arg in value.args):
+                    op = MIN if value.func.id == 'min' else MAX
+                elif isinstance(value, ast.Call) and isinstance(value.func, ast.Name) and \
+                        value.func.id == _run_name:
+                    # a nested prange loop accumulating the same variable
+                    op = self.reductions[value.args[0].id]
+            if name is not None and name in scope:
+                ops.setdefault(name, set()).add(op)
+
+        candidates = [(name, op.pop()) for name, op in ops.items()
+                      if len(op) == 1 and None not in op]
+        if len(candidates) > 1:
+            raise exc.UnimplementedError(
+                "prange loops can only accumulate one variable, not {}".format(
+                    ', '.join(sorted(name for name, _ in candidates))))
+        return candidates[0] if candidates else (None, NONE)
+
+    def minMax(self, body, acc, op):
+        """Replace `acc = min(acc, x)' with a comparison."""
+        class Rewrite(ast.NodeTransformer):
+            def visit_Assign(_, node):
+                if not (isinstance(node.value, ast.Call) and len(node.targets) == 1 and
+                        isinstance(node.targets[0], ast.Name) and
+                        node.targets[0].id == acc):
+                    return node
+                value = [arg for arg in node.value.args
+                         if not (isinstance(arg, ast.Name) and arg.id == acc)]
+                value = value[0] if value else node.value.args[0]
+                assign = _parseStmt('__stella_value = 0', node.lineno, node.col_offset)
+                assign.value = value
+                update = _parseStmt('if __stella_value {} {}:\n    {} = __stella_value'.format(
+                    '<' if op == MIN else '>', acc, acc), node.lineno, node.col_offset)
+                return [assign, update]
+
+        module = Rewrite().visit(ast.Module(body=body))
+        return module.body
+
+    def outline(self, loop, scope):
+        if loop.orelse:
+            raise exc.UnimplementedError("prange loops cannot have an else clause")
+        if not isinstance(loop.target, ast.Name):
+            raise exc.UnimplementedError("The target of a prange loop must be a single name")
+        var = loop.target.id
+        start, stop, chunk, schedule = self.rangeArgs(loop.iter)
+
+        body_loads, body_stores = _names(loop.body)
+        body = self.transform(loop.body, scope | body_stores | {var})
+        acc, op = self.reduction(body, scope)
+
+        # the iterations run concurrently, so they cannot assign to
+        # variables which are used outside of the loop
+        outside_loads, _ = _names([self.fdef], skip=loop)
+        outside_loads |= _names([loop.iter])[0]
+        for name in sorted(body_stores - {var, acc}):
+            if name in scope and name in outside_loads:
+                raise exc.UnimplementedError(
+                    "The prange loop at line {} assigns to {}, which is used outside of "
+                    "the loop".format(loop.lineno, name))
+
+        captured = sorted((body_loads & scope) - body_stores - {var})
+        params = [var] + ([acc] if acc else []) + captured
+
+        name = '{}_{}'.format(self.prefix, len(self.bodies))
+        fdef = _parseStmt('def {}({}):\n    pass'.format(name, ', '.join(params)),
+                          loop.lineno, loop.col_offset)
+        if op in (MIN, MAX):
+            body = self.minMax(body, acc, op)
+        body = [_Control(acc).visit(stmt) for stmt in body]
+        if acc:
+            body.append(_parseStmt('return ' + acc, loop.lineno, loop.col_offset))
+        fdef.body = body
+        self.bodies.append(fdef)
+        self.reductions[name] = op
+
+        call = '{}({}, 0, 0, 0, {}, {}{})'.format(
+            _run_name, name, schedule, op,
+            ''.join(', ' + arg for arg in params[1:]))
+        stmt = _parseStmt('{} = {}'.format(acc, call) if acc else call,
+                          loop.lineno, loop.col_offset)
+        stmt.value.args[1:4] = [start, stop, chunk]
+        return stmt
+
+
+# code object -> the rewritten function, forgotten with the code
+_outlined = weakref.WeakKeyDictionary()
+_outline_lock = threading.Lock()
+
+
+def outline(f):
+    """Returns f with the bodies of its prange loops moved into functions of
+    their own, or f itself if it has none.
+
+    The body functions are added to the namespace of this module, not to the
+    globals of f.
+    """
+    code = getattr(f, '__code__', None)
+    if code is None or 'prange' not in code.co_names:
+        return f
+    with _outline_lock:
+        if code not in _outlined:
+            _outlined[code] = _Outliner(f).rewrite()
+        return _outlined[code]
+
+
+_num_threads = None
+_pool = None
+_pool_lock = threading.Lock()
+_local = threading.local()
+
+
+def num_threads():
+    """The number of threads running prange loops: $STELLA_NUM_THREADS or the
+    number of CPUs."""
+    global _num_threads
+    if _num_threads is None:
+        _num_threads = max(1, int(os.environ.get('STELLA_NUM_THREADS', 0)) or
+                           os.cpu_count() or 1)
+    return _num_threads
+
+
+def _getPool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = concurrent.futures.ThreadPoolExecutor(max_workers=num_threads())
+        return _pool
+
+
+def _fail(e):
+    """Remember the first exception of a prange loop run by compiled code on
+    this thread, see raise_failure()."""
+    if getattr(_local, 'failure', None) is None:
+        _local.failure = e
+
+
+def raise_failure():
+    """Raise the exception of a prange loop which failed while compiled code
+    ran on this thread. Called once the compiled code returned, its results
+    are incomplete then."""
+    failure = getattr(_local, 'failure', None)
+    if failure is not None:
+        _local.failure = None
+        raise failure
+
+
+def _work(run, worker):
+    _local.nested = True
+    try:
+        run(worker)
+        # of a nested loop, which ran on this thread
+        raise_failure()
+    finally:
+        _local.nested = False
+
+
+def parallel_for(chunk_fn, env, start, stop, chunk, schedule):
+    """Call chunk_fn(env, begin, end, worker) for chunks covering the range
+    start..stop on the thread pool.
+
+    Chunks with the same worker never run concurrently. A prange loop inside
+    of another one runs sequentially.
+    """
+    n = stop - start
+    if n <= 0:
+        return
+    workers = num_threads()
+    if workers == 1 or getattr(_local, 'nested', False):
+        chunk_fn(env, start, stop, 0)
+        return
+
+    if schedule == DYNAMIC:
+        if chunk <= 0:
+            chunk = max(1, n // (8 * workers))
+        # next() is atomic
+        begins = itertools.count(start, chunk)
+
+        def run(worker):
+            for begin in begins:
+                if begin >= stop:
+                    break
+                chunk_fn(env, begin, min(begin + chunk, stop), worker)
+    else:
+        if chunk <= 0:
+            chunk = -(-n // workers)
+
+        def run(worker):
+            for begin in range(start + worker * chunk, stop, workers * chunk):
+                chunk_fn(env, begin, min(begin + chunk, stop), worker)
+
+    pool = _getPool()
+    for future in [pool.submit(_work, run, worker) for worker in range(workers)]:
+        future.result()
+
+
+_chunk_type = ctypes.CFUNCTYPE(None, ctypes.c_void_p, ctypes.c_int64, ctypes.c_int64,
+                               ctypes.c_int64)
+
+
+@ctypes.CFUNCTYPE(None, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_int64, ctypes.c_int64,
+                  ctypes.c_int64, ctypes.c_int64)
+def _parallelFor(chunk_fn, env, start, stop, chunk, schedule):
+    try:
+        parallel_for(_chunk_type(chunk_fn), env, start, stop, chunk, schedule)
+    except BaseException as e:
+        # there is no way to raise through the compiled code
+        logging.debug("prange loop failed", exc_info=True)
+        _fail(e)
+
+
+@ctypes.CFUNCTYPE(ctypes.c_int64)
+def _numThreads():
+    return num_threads()
+
+
+def runtime_symbols():
+    """The (name, address) of the functions called by compiled prange loops."""
+    return [('stella_parallel_for', ctypes.cast(_parallelFor, ctypes.c_void_p).value),
+            ('stella_num_threads', ctypes.cast(_numThreads, ctypes.c_void_p).value)]
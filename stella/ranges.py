@@ -0,0 +1,186 @@
+# Copyright 2013-2015 David Mohr
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Value ranges of the integers of a function.
+
+An interval (lo, hi) bounds the values an integer can take, None stands for
+no bound. Local variables get the union of all values stored into them, so
+the counter of `for i in range(n)' is known to be at least 0. Code
+generation asks for ranges to emit cheaper code, e.g. a plain `sdiv' for a
+floor division of non-negative integers.
+"""
+from . import tp
+from . import bytecode
+from . import intrinsics
+from .storage import StackLoc, GlobalVariable
+
+UNKNOWN = (None, None)
+_INT_MIN = -2**63
+_INT_MAX = 2**63 - 1
+# how often a variable may grow before its bounds are given up, so that the
+# analysis of loops terminates
+_WIDEN_AFTER = 3
+
+
+def _bounded(lo, hi):
+    """Bounds outside of int64 may wrap around."""
+    if (lo is not None and lo < _INT_MIN) or (hi is not None and hi > _INT_MAX):
+        return UNKNOWN
+    return (lo, hi)
+
+
+def _union(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    lo = None if a[0] is None or b[0] is None else min(a[0], b[0])
+    hi = None if a[1] is None or b[1] is None else max(a[1], b[1])
+    return (lo, hi)
+
+
+def _add(a, b):
+    lo = None if a[0] is None or b[0] is None else a[0] + b[0]
+    hi = None if a[1] is None or b[1] is None else a[1] + b[1]
+    return _bounded(lo, hi)
+
+
+def _sub(a, b):
+    return _add(a, (None if b[1] is None else -b[1], None if b[0] is None else -b[0]))
+
+
+def _mul(a, b):
+    if None not in a and None not in b:
+        products = [x * y for x in a for y in b]
+        return _bounded(min(products), max(products))
+    if is_nonnegative(a) and is_nonnegative(b):
+        return (a[0] * b[0], None)
+    return UNKNOWN
+
+
+def _floordiv(a, b):
+    if not is_nonnegative(a) or not is_positive(b):
+        return UNKNOWN
+    lo = 0 if b[1] is None else a[0] // b[1]
+    hi = None if a[1] is None else a[1] // b[0]
+    return (lo, hi)
+
+
+def _mod(a, b):
+    # the result has the sign of the divisor
+    if not is_positive(b):
+        return UNKNOWN
+    if a[0] is not None and a[0] >= 0 and a[1] is not None and a[1] < b[0]:
+        return a
+    return (0, None if b[1] is None else b[1] - 1)
+
+
+def is_nonnegative(interval):
+    return interval[0] is not None and interval[0] >= 0
+
+
+def is_positive(interval):
+    return interval[0] is not None and interval[0] > 0
+
+
+class Ranges(object):
+    """The ranges of the integers of the ir.Function impl. The analysis runs
+    once all bytecodes are typed, on the first call of interval()."""
+    _ops = [(bytecode.BINARY_ADD, _add), (bytecode.BINARY_SUBTRACT, _sub),
+            (bytecode.BINARY_MULTIPLY, _mul), (bytecode.BINARY_FLOOR_DIVIDE, _floordiv),
+            (bytecode.BINARY_MODULO, _mod)]
+
+    def __init__(self, impl):
+        self.impl = impl
+        self.variables = None
+
+    def _analyze(self):
+        """Iterate over the stores into local variables until no range changes
+        anymore. A variable which has not been stored yet has no range at all
+        (None)."""
+        self.variables = {}
+        stores = [bc for bc in self.impl.bytecodes
+                  if isinstance(bc, bytecode.STORE_FAST) and isinstance(bc.result, StackLoc)
+                  and bc.result.type == tp.Int]
+        growth = {}
+        changed = True
+        while changed:
+            changed = False
+            for bc in stores:
+                loc = bc.result
+                old = self.variables.get(loc)
+                new = _union(old, self._eval(bc.args[0]))
+                if new == old:
+                    continue
+                growth[loc] = growth.get(loc, 0) + 1
+                if growth[loc] > _WIDEN_AFTER and old is not None:
+                    new = (new[0] if new[0] == old[0] else None,
+                           new[1] if new[1] == old[1] else None)
+                self.variables[loc] = new
+                changed = True
+
+    def _eval(self, value):
+        """The range of value, or None if it depends on a variable that has not
+        been stored yet."""
+        if isinstance(value, tp.Const):
+            if type(value.value) == int:
+                return (value.value, value.value)
+            return UNKNOWN
+        if isinstance(value, tp.Cast) or value.type != tp.Int:
+            return UNKNOWN
+
+        bc = getattr(value, 'bc', None)
+        if isinstance(bc, bytecode.LOAD_FAST) and isinstance(bc.source, StackLoc):
+            return self.variables.get(bc.source)
+        if isinstance(bc, bytecode.LOAD_GLOBAL) and isinstance(bc.var, GlobalVariable) \
+                and bc.var.isConstant():
+            return self._eval(bc.var.initial_value)
+        if isinstance(bc, bytecode.CALL_FUNCTION) and isinstance(bc.func, intrinsics.Len):
+            return (0, None)
+        for klass, op in self._ops:
+            if isinstance(bc, klass) and bc.result is value:
+                a = self._eval(bc.args[0])
+                b = self._eval(bc.args[1])
+                if a is None or b is None:
+                    return None
+                return op(a, b)
+        return UNKNOWN
+
+    def interval(self, value):
+        """The range (lo, hi) of the integer value."""
+        if self.variables is None:
+            self._analyze()
+        return self._eval(value) or UNKNOWN
+
+    def nonnegative(self, value):
+        return is_nonnegative(self.interval(value))
+
+    def safe_divisor(self, dividend, divisor):
+        """True if `sdiv' and `srem' of dividend by divisor cannot trap: the
+        divisor is not 0, and not -1 if the dividend may be the smallest
+        integer."""
+        lo, hi = self.interval(divisor)
+        if lo is not None and lo > 0:
+            return True
+        if hi is not None and hi < 0:
+            smallest = self.interval(dividend)[0]
+            return hi < -1 or (smallest is not None and smallest > _INT_MIN)
+        return False
+
+    def power_of_two(self, value):
+        """k if value is the constant 2**k, else None."""
+        lo, hi = self.interval(value)
+        if lo is not None and lo == hi and lo > 0 and lo & (lo - 1) == 0:
+            return lo.bit_length() - 1
+        return None
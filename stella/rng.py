@@ -0,0 +1,147 @@
+# Copyright 2013-2015 David Mohr
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Random numbers from a xoshiro256** generator.
+
+The state is an object with four integer attributes, so compiled code
+receives it as a struct and keeps it in registers. The functions of this
+module are intrinsics (see intrinsics.Uniform): compiled code does not call
+into Python or a C library for a random number, the generator is inlined.
+Compiled and interpreted code draw the same numbers.
+
+Every thread or process needs a generator of its own. jump() and split()
+derive streams which do not overlap.
+
+    def kernel(gen, n):
+        total = 0.0
+        for i in range(n):
+            total += rng.exponential(gen, 2.0)
+        return total
+
+    stella.wrap(kernel)(rng.Xoshiro256(seed=42), 1000)
+"""
+import math
+
+_MASK = (1 << 64) - 1
+# see Xoshiro256.jump()
+_JUMP = (0x180ec6d33cfd0aba, 0xd5a61266f0c9392c, 0xa9582618e03fc9aa, 0x39abdc4529b1661c)
+
+
+def _signed(x):
+    """Compiled code stores the state as int64."""
+    return x - (1 << 64) if x >> 63 else x
+
+
+def _rotl(x, k):
+    return ((x << k) | (x >> (64 - k))) & _MASK
+
+
+def _splitmix64(x):
+    x = (x + 0x9e3779b97f4a7c15) & _MASK
+    z = x
+    z = ((z ^ (z >> 30)) * 0xbf58476d1ce4e5b9) & _MASK
+    z = ((z ^ (z >> 27)) * 0x94d049bb133111eb) & _MASK
+    return x, z ^ (z >> 31)
+
+
+class Xoshiro256(object):
+    """The state of a generator.
+
+    The seed is expanded with splitmix64. stream selects one of 2**128
+    non-overlapping subsequences, see jump().
+    """
+    def __init__(self, seed=0, stream=0):
+        x = seed & _MASK
+        words = []
+        for i in range(4):
+            x, z = _splitmix64(x)
+            words.append(z)
+        self.s0, self.s1, self.s2, self.s3 = (_signed(w) for w in words)
+        for i in range(stream):
+            self.jump()
+
+    def state(self):
+        return tuple(s & _MASK for s in (self.s0, self.s1, self.s2, self.s3))
+
+    def jump(self):
+        """Advance by 2**128 numbers."""
+        state = [0, 0, 0, 0]
+        for word in _JUMP:
+            for b in range(64):
+                if word & (1 << b):
+                    state = [s ^ t for s, t in zip(state, self.state())]
+                next_word(self)
+        self.s0, self.s1, self.s2, self.s3 = (_signed(s) for s in state)
+
+    def split(self, n):
+        """n generators for parallel streams, following this one."""
+        streams = []
+        gen = Xoshiro256()
+        gen.s0, gen.s1, gen.s2, gen.s3 = self.s0, self.s1, self.s2, self.s3
+        for i in range(n):
+            gen.jump()
+            stream = Xoshiro256()
+            stream.s0, stream.s1, stream.s2, stream.s3 = gen.s0, gen.s1, gen.s2, gen.s3
+            streams.append(stream)
+        return streams
+
+    def __eq__(self, other):
+        return isinstance(other, Xoshiro256) and self.state() == other.state()
+
+    def __repr__(self):
+        return "<Xoshiro256 {}>".format(', '.join(hex(s) for s in self.state()))
+
+
+def next_word(gen):
+    """The next 64 random bits as an unsigned integer. Not available in
+    compiled code, which has no unsigned integers."""
+    s0, s1, s2, s3 = gen.state()
+    result = (_rotl((s1 * 5) & _MASK, 7) * 9) & _MASK
+    t = (s1 << 17) & _MASK
+    s2 ^= s0
+    s3 ^= s1
+    s1 ^= s2
+    s0 ^= s3
+    s2 ^= t
+    s3 = _rotl(s3, 45)
+    gen.s0, gen.s1, gen.s2, gen.s3 = _signed(s0), _signed(s1), _signed(s2), _signed(s3)
+    return result
+
+
+def uniform(gen):
+    """A float in [0, 1)."""
+    return (next_word(gen) >> 11) * 2.0 ** -53
+
+
+def exponential(gen, rate):
+    """Exponentially distributed with the given rate."""
+    return -math.log(1.0 - uniform(gen)) / rate
+
+
+def normal(gen):
+    """Standard normal distributed, by the Box-Muller transform."""
+    u1 = uniform(gen)
+    u2 = uniform(gen)
+    return math.sqrt(-2.0 * math.log(1.0 - u1)) * math.cos(2.0 * math.pi * u2)
+
+
+def randint(gen, low, high):
+    """An integer in [low, high], including both. Requires low <= high.
+
+    Like random.randint() this raises ValueError otherwise. Compiled code
+    cannot raise, so there the result is low.
+    """
+    if high < low:
+        raise ValueError("empty range for randint({}, {})".format(low, high))
+    return low + (next_word(gen) >> 1) % (high - low + 1)
@@ -0,0 +1,69 @@
+# Copyright 2013-2015 David Mohr
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Declared signatures, for compiling without calling the function.
+
+A signature is a sequence with one declaration per argument: int, float or
+bool for scalars, array(...) for numpy arrays, or an example value, which is
+required for objects and lists.
+"""
+import numpy as np
+
+from . import exc
+
+
+class array(object):
+    """Declares a numpy array argument.
+
+    The shape only needs to be given for wrap(static_shape=True).
+    """
+    def __init__(self, dtype=float, ndim=1, shape=None):
+        self.dtype = np.dtype(dtype)
+        if shape is not None:
+            ndim = len(shape)
+        self.ndim = ndim
+        self.shape = shape
+
+    def example(self, static_shape=False):
+        if self.shape is None:
+            if static_shape:
+                raise exc.TypeError("{!r} needs a shape, because the shape is compiled "
+                                    "into the code with static_shape=True".format(self))
+            return np.zeros((1,) * self.ndim, dtype=self.dtype)
+        return np.zeros(self.shape, dtype=self.dtype)
+
+    def __repr__(self):
+        if self.shape is None:
+            return "array({}, ndim={})".format(self.dtype, self.ndim)
+        return "array({}, shape={})".format(self.dtype, self.shape)
+
+
+_scalars = (int, float, bool)
+
+
+def example(decl, static_shape=False):
+    """A value of the type declared by decl."""
+    if decl in _scalars:
+        return decl()
+    elif isinstance(decl, array):
+        return decl.example(static_shape)
+    elif isinstance(decl, type):
+        raise exc.TypeError("Cannot declare an argument of type {}, pass an example "
+                            "value instead".format(decl.__name__))
+    return decl
+
+
+def example_args(signature, static_shape=False):
+    """Example argument values for the declared signature."""
+    return tuple(example(decl, static_shape) for decl in signature)
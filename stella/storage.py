@@ -11,7 +11,10 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import weakref
+
 from . import tp
+from . import exc
 import llvmlite.ir as ll
 
 
@@ -50,6 +53,8 @@ class StackLoc(tp.Typable):
 class GlobalVariable(tp.Typable):
     name = None
     initial_value = None
+    # assigned by the compiled code, see STORE_GLOBAL
+    written = False
 
     def __init__(self, name, initial_value=None):
         super().__init__()
@@ -65,6 +70,21 @@ class GlobalVariable(tp.Typable):
         self.type = self.initial_value.type
         self.type.makePointer(True)
 
+    def isConstant(self):
+        """True if the compiled code only reads this scalar, so its value can be
+        compiled in. Only valid after the analysis, when all STORE_GLOBALs are
+        known. The module guards the value, see ir.Module.loadGlobal()."""
+        return (not self.written and isinstance(self.initial_value, tp.Const)
+                and tp.supported_scalar(self.initial_value.type))
+
+    def constObject(self):
+        """The object marked with const() this read-only global refers to, or
+        None."""
+        if self.written or not isinstance(self.initial_value, tp.Struct):
+            return None
+        obj = self.initial_value.value
+        return obj if is_const(obj) else None
+
     def __str__(self):
         return "+{0}<{1}>".format(self.name, self.type)
 
@@ -76,6 +96,7 @@ class GlobalVariable(tp.Typable):
             return self.llvm
 
         self.llvm = ll.GlobalVariable(cge.module.llvm, self.llvmType(cge.module), self.name)
+        self.llvm.linkage = 'internal'
         # TODO: this condition is too complicated and likely means that my
         # code is not working consistently with the attribute
         llvm_init = None
@@ -90,3 +111,34 @@ class GlobalVariable(tp.Typable):
             self.llvm.initializer = llvm_init
 
         return self.llvm
+
+
+# id -> the objects marked with const()
+_const = weakref.WeakValueDictionary()
+
+
+def const(obj):
+    """Mark the object obj as constant while compiled code runs, and return it.
+
+    Scalar attributes of obj which are read through a global are compiled
+    into the code as constants. When Python changes one of them, the code is
+    compiled again before the next call. The compiled code must not assign
+    them.
+
+    Globals holding scalars need no marker: unless the compiled code assigns
+    them, they are always compiled in.
+
+    Usage:
+        settings = stella.const(Settings())
+    """
+    if tp.supported_scalar(type(obj)):
+        return obj
+    if not hasattr(obj, '__dict__'):
+        raise exc.TypeError("const() requires an object with a __dict__, not {0}".format(
+            type(obj)))
+    _const[id(obj)] = obj
+    return obj
+
+
+def is_const(obj):
+    return _const.get(id(obj)) is obj
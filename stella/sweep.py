@@ -0,0 +1,145 @@
+# Copyright 2013-2015 David Mohr
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Running a function for many parameters and seeds on a process pool.
+
+Every worker process wraps the function once and reuses the compiled code
+for all of its runs. With a cache.DiskCache the workers also share it.
+"""
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+import itertools
+import logging
+import os
+import time
+
+from . import cache
+
+
+class Run(object):
+    """One run of ensemble(): f(**params, seed=seed)."""
+    def __init__(self, params, seed):
+        self.params = params
+        self.seed = seed
+        self.result = None
+        # the exception of the last attempt if all of them failed
+        self.error = None
+        self.attempts = 0
+        # of the successful attempt, in seconds
+        self.elapsed = None
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def kwargs(self, seed_arg):
+        kwargs = dict(self.params)
+        if self.seed is not None:
+            kwargs[seed_arg] = self.seed
+        return kwargs
+
+    def __repr__(self):
+        outcome = "error={!r}".format(self.error) if self.error else "ok"
+        return "<Run {} seed={}: {}>".format(self.params, self.seed, outcome)
+
+
+def grid_points(grid):
+    """The parameter sets of grid: a dict of lists of values, whose cartesian
+    product is taken, or an iterable of dicts."""
+    if isinstance(grid, dict):
+        names = sorted(grid)
+        return [dict(zip(names, values))
+                for values in itertools.product(*(grid[name] for name in names))]
+    return [dict(point) for point in grid]
+
+
+# the functions wrapped by this worker process, see _work()
+_wrapped = {}
+
+
+def _work(f, options, kwargs):
+    if options is None:
+        run = f
+    else:
+        key = (f, repr(sorted(options.items())))
+        run = _wrapped.get(key)
+        if run is None:
+            from . import wrap
+            run = _wrapped[key] = wrap(f, **options)
+    start = time.perf_counter()
+    result = run(**kwargs)
+    return result, time.perf_counter() - start
+
+
+def ensemble(f, grid=({},), seeds=None, processes=None, retries=0, compile=True,
+             seed_arg='seed', **options):
+    """Run f for every parameter set of grid and every seed on a process pool.
+
+    Yields a Run for each of them as soon as it finished, in no particular
+    order. A failed run is attempted again up to retries times, after that
+    it is yielded with its error instead of aborting the others.
+
+    Parameters:
+        f:          a function which can be pickled, i.e. defined at the top
+                    level of a module. It is called with the parameters and
+                    the seed as keyword arguments.
+        grid:       see grid_points().
+        seeds:      the number of seeds per parameter set, an iterable of
+                    seeds, or None if f takes no seed.
+        int processes: the size of the pool, by default the number of CPUs.
+        bool compile: wrap f in every worker. Set it to False if f is a
+                    Python driver which calls compiled functions itself.
+        str seed_arg: the name of the argument of f receiving the seed.
+        options:    are passed on to wrap(). cache_dir defaults to
+                    $STELLA_CACHE_DIR, so that the workers share the code.
+
+    Usage:
+        for run in stella.ensemble(simulate, {'K': [10, 20]}, seeds=1000):
+            if run.ok:
+                ...
+    """
+    if isinstance(seeds, int):
+        seeds = range(seeds)
+    seeds = [None] if seeds is None else list(seeds)
+    runs = [Run(params, seed) for params in grid_points(grid) for seed in seeds]
+
+    if compile:
+        options.setdefault('cache_dir', cache.default_cache_dir())
+    else:
+        options = None
+
+    with concurrent.futures.ProcessPoolExecutor(processes or os.cpu_count()) as pool:
+        def submit(run):
+            run.attempts += 1
+            return pool.submit(_work, f, options, run.kwargs(seed_arg))
+
+        pending = {submit(run): run for run in runs}
+        while pending:
+            done, _ = concurrent.futures.wait(pending,
+                                              return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                run = pending.pop(future)
+                try:
+                    run.result, run.elapsed = future.result()
+                    run.error = None
+                except BrokenProcessPool as e:
+                    # the pool cannot run anything any more
+                    run.error = e
+                except Exception as e:
+                    run.error = e
+                    if run.attempts <= retries:
+                        logging.info("Retrying {}: {}".format(run, e))
+                        pending[submit(run)] = run
+                        continue
+                yield run
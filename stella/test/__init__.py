@@ -44,10 +44,12 @@ def make_eq_test(f, args):
     assert x == y and type(x) == type(y)
 
 
-def make_numpy_eq_test(f, args):
+def make_numpy_eq_test(f, args, **opts):
     """
     TODO stella right now won't return numpy types.
     This test will treat them as equal to the python counterparts.
+
+    opts are passed on to wrap().
     """
     args1 = []
     args2 = []
@@ -59,7 +61,7 @@ def make_numpy_eq_test(f, args):
             args1.append(a)
             args2.append(a)
     x = f(*args1)
-    y = wrap(f)(*args2)
+    y = wrap(f, **opts)(*args2)
 
     type_x = type(x)
     for type_name in ('int', 'float'):
@@ -0,0 +1,73 @@
+# Copyright 2013-2015 David Mohr
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import importlib.util
+
+import numpy as np
+import stella
+from stella import aot, exc
+from stella.__main__ import main
+
+from . import *  # noqa
+from .basicmath import addition
+from .langconstr import kwargs, numpy_len_direct, numpy_array2d_for4
+
+
+def load(loader):
+    spec = importlib.util.spec_from_file_location('aot_test_loader', loader)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@aot.export((int, int), (float, float))
+def aot_add(a, b):
+    return addition(a, b)
+
+
+def test_scalars(tmpdir):
+    lib = load(aot.compile([(addition, [(int, int), (float, int)])], str(tmpdir.join('lib'))))
+    assert lib.addition(40, 2) == 42
+    assert lib.addition(1.5, 2) == 3.5
+    with raises(exc.TypeError):
+        lib.addition(1, 1.5)
+
+
+def test_defaults(tmpdir):
+    lib = load(aot.compile([(kwargs, [(), (float, )])], str(tmpdir.join('lib'))))
+    assert lib.kwargs() == kwargs()
+    assert lib.kwargs(a=5) == kwargs(a=5)
+    assert lib.kwargs(1.5) == kwargs(1.5)
+
+
+def test_arrays(tmpdir):
+    lib = load(aot.compile([(numpy_len_direct, [(stella.array(int), )]),
+                            (numpy_array2d_for4, [(stella.array(float, ndim=2), )])],
+                           str(tmpdir.join('lib'))))
+    for n in (2, 7):
+        a = np.zeros(n, dtype=int)
+        b = np.zeros(n, dtype=int)
+        numpy_len_direct(a)
+        lib.numpy_len_direct(b)
+        assert all(a == b)
+
+    a = np.arange(12, dtype=float).reshape((3, 4))
+    assert lib.numpy_array2d_for4(a) == numpy_array2d_for4(a)
+
+
+def test_command(tmpdir):
+    output = str(tmpdir.join('cmd'))
+    assert main(['compile', __name__, '-o', output]) == 0
+    lib = load(output + '.py')
+    assert lib.aot_add(1, 2) == 3
+    assert lib.aot_add(1.0, 2.5) == 3.5
@@ -42,6 +42,21 @@ def modulo(a, b):
     return a % b
 
 
+def floor_division_4(a, b):
+    return a // 4
+
+
+def modulo_4(a, b):
+    return a % 4
+
+
+def loop_division(n):
+    r = 0
+    for i in range(n):
+        r += i // 3 + i % 3
+    return r
+
+
 def power1(a, b):
     return a ** b
 
@@ -111,14 +126,41 @@ def test_modulo(args):
 
 
 @mark.parametrize('args', filter(lambda e: e[0] < 0, arglist2))
-@mark.xfail(raises=AssertionError)
 def test_semantics_modulo(args):
-    """Semantic difference:
-    Modulo always has the sign of the divisor in Python, unlike C where it is
-    the sign of the dividend.
+    """Modulo always has the sign of the divisor in Python, unlike C where it
+    is the sign of the dividend.
     """
     make_delta_test(modulo, args)
 
+
+arglist_int = [(7, 2), (-7, 2), (7, -2), (-7, -2), (-8, 4), (9, 4), (-9, 4), (7, -1), (-7, -1),
+               (2**62 + 1, 3), (-randint(1, 1000000), randint(1, 1000))]
+
+
+@mark.parametrize('args', arglist_int)
+@mark.parametrize('f', [floor_division, modulo, floor_division_4, modulo_4])
+def test_integer_division(f, args):
+    """Exact integer results, rounding towards negative infinity"""
+    make_eq_test(f, args)
+
+
+def test_division_ranges():
+    """The counter of a loop cannot be negative, so no correction is needed"""
+    assert 'select' not in wrap(loop_division, ir=True)(10)
+    assert 'select' in wrap(modulo, ir=True)(10, 3)
+    make_eq_test(loop_division, (10,))
+
+
+def test_division_guard():
+    """A divisor of 0 or -1 must not trap: x // 0 has no meaningful result,
+    but it must not kill the process"""
+    f = wrap(floor_division)
+    f(7, 0)
+    assert f(-2**63, -1) == -2**63
+    assert wrap(modulo)(7, 0) == 0
+    assert 'select' not in wrap(floor_division_4, ir=True)(7, 2)
+
+
 arglist3 = [(0, 42), (42, 0), (2, 5.0), (2.0, 5), (1.2, 2), (4, 7.5), (-4, 2)]
 
 
@@ -148,3 +190,21 @@ def test4(f, args):
 @mark.parametrize('f', [unary_neg])
 def test5(f, args):
     make_delta_test(f, args)
+
+
+target_opts = [{'cpu': 'host'}, {'cpu': 'host', 'features': '-avx512f'},
+               {'opt': 3, 'loop_vectorize': True, 'slp_vectorize': True, 'unroll': False},
+               {'fastmath': ['contract']}, {'fastmath': True, 'opt': 3}]
+
+
+@mark.parametrize('opts', target_opts)
+@mark.parametrize('f', [chained, inplace])
+def test_target(f, opts):
+    args = (5.2, 2)
+    assert abs(f(*args) - wrap(f, **opts)(*args)) < 1e-6
+
+
+def test_fastmath_ir():
+    ir = wrap(chained, ir=True, fastmath=['reassoc', 'nnan'])(1.5, 2.5)
+    assert 'fadd nnan reassoc' in ir or 'fmul nnan reassoc' in ir
+    assert 'fast' not in wrap(chained, ir=True)(1.5, 2.5)
@@ -0,0 +1,356 @@
+# Copyright 2013-2015 David Mohr
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import stella
+from stella import cache, codegen, exc
+from stella.__main__ import main
+
+from . import *  # noqa
+from .basicmath import addition, subtraction
+from .langconstr import kwargs, numpy_len_direct
+from .objects import B, E, objList4, setAttrib
+
+
+cache_global = 1
+
+
+def add_global(x):
+    return x + cache_global
+
+
+def test_hit():
+    f = stella.wrap(addition)
+    assert f(1, 2) == 3
+    assert f(40, 2) == 42
+    assert f.cache.hits == 1 and f.cache.misses == 1
+    assert len(f.cache) == 1
+
+
+def test_miss():
+    f = stella.wrap(addition)
+    assert f(1, 2) == 3
+    assert f(1.5, 2) == 3.5
+    assert f(1, 2.5) == 3.5
+    assert f.cache.hits == 0 and f.cache.misses == 3
+    assert len(f.cache) == 3
+
+
+def test_defaults():
+    f = stella.wrap(kwargs)
+    assert f() == kwargs()
+    assert f(a=4) == kwargs(a=4)
+    assert f(a=5) == kwargs(a=5)
+    assert f.cache.hits == 1 and f.cache.misses == 2
+
+
+def test_invalidate():
+    f = stella.wrap(addition)
+    f(1, 2)
+    f.invalidate()
+    assert len(f.cache) == 0
+    assert f(1, 2) == 3
+    assert f.cache.hits == 0 and f.cache.misses == 2
+
+
+def test_global_rebound():
+    global cache_global
+
+    f = stella.wrap(add_global)
+    assert f(1) == 2
+    cache_global = 2
+    try:
+        assert f(1) == 3
+    finally:
+        cache_global = 1
+    assert f.cache.hits == 0 and f.cache.misses == 2
+
+
+def test_shared_engine():
+    """Programs with the same function names live in one execution engine"""
+    f = stella.wrap(addition)
+    g = stella.wrap(addition)
+    h = stella.wrap(subtraction)
+    assert f(1, 2) == 3
+    assert g(1.5, 2.0) == 3.5
+    assert h(3, 1) == 2
+    f.invalidate()
+    assert g(2.5, 2.0) == 4.5
+    assert f(2, 2) == 4
+
+
+def test_array_args():
+    f = stella.wrap(numpy_len_direct)
+    for i in range(3):
+        a = np.zeros(5, dtype=int)
+        b = np.zeros(5, dtype=int)
+        numpy_len_direct(a)
+        f(b)
+        assert all(a == b)
+    assert f.cache.hits == 2 and f.cache.misses == 1
+
+
+def test_array_shapes():
+    f = stella.wrap(numpy_len_direct)
+    for n in (5, 3, 8):
+        a = np.zeros(n, dtype=int)
+        b = np.zeros(n, dtype=int)
+        numpy_len_direct(a)
+        f(b)
+        assert all(a == b)
+    assert f.cache.hits == 2 and f.cache.misses == 1
+
+
+def test_array_static_shape():
+    f = stella.wrap(numpy_len_direct, static_shape=True)
+    for n in (5, 3, 3):
+        a = np.zeros(n, dtype=int)
+        b = np.zeros(n, dtype=int)
+        numpy_len_direct(a)
+        f(b)
+        assert all(a == b)
+    assert f.cache.hits == 1 and f.cache.misses == 2
+
+
+def test_object_args():
+    f = stella.wrap(setAttrib)
+    for args in [(1, 2), (3, 4)]:
+        b1 = B(*args)
+        b2 = B(*args)
+        setAttrib(b1)
+        f(b2)
+        assert b1 == b2
+    assert f.cache.hits == 1 and f.cache.misses == 1
+
+
+def test_object_signature():
+    class P(object):
+        def __init__(self, x):
+            self.x = x
+
+    assert cache.signature((P(1),), {}) == cache.signature((P(2),), {})
+    assert cache.signature((P(1),), {}) != cache.signature((P(1.0),), {})
+    p = P(1)
+    p.y = 2
+    assert cache.signature((P(1),), {}) != cache.signature((p,), {})
+    sig = cache.signature((P(1),), {})
+    P.z = 3
+    assert cache.signature((P(1),), {}) != sig
+
+
+def test_object_bound():
+    e1 = E(1)
+    e2 = E(1)
+    f = stella.wrap(e2.inc)
+    for i in range(3):
+        assert e1.inc(2) == f(2)
+        assert e1 == e2
+    assert f.cache.hits == 2 and f.cache.misses == 1
+
+
+def test_list_args():
+    f = stella.wrap(objList4)
+    for i in range(2):
+        l1 = [E(i), E(i+1)]
+        l2 = [E(i), E(i+1)]
+        objList4(l1)
+        f(l2)
+        assert l1 == l2
+    assert f.cache.hits == 1 and f.cache.misses == 1
+
+
+def test_disk_cache(tmpdir):
+    f = stella.wrap(addition, cache_dir=str(tmpdir))
+    assert f(1, 2) == 3
+    assert len(f.disk_cache) == 1
+
+    # as if in a new process
+    g = stella.wrap(addition, cache_dir=str(tmpdir))
+    assert g(40, 2) == 42
+    assert g(1.5, 2) == 3.5
+    assert len(g.disk_cache) == 2
+    progs = list(g.cache.entries.values())
+    assert isinstance(progs[0], codegen.CachedProgram) or isinstance(progs[1],
+                                                                      codegen.CachedProgram)
+
+
+def test_disk_cache_arrays(tmpdir):
+    for n in (3, 5):
+        a = np.zeros(n, dtype=int)
+        b = np.zeros(n, dtype=int)
+        numpy_len_direct(a)
+        stella.wrap(numpy_len_direct, cache_dir=str(tmpdir))(b)
+        assert all(a == b)
+    assert len(cache.DiskCache(str(tmpdir))) == 1
+
+
+def test_disk_cache_globals(tmpdir):
+    """Values of read-only globals are compiled in, and checked when loaded"""
+    global cache_global
+    f = stella.wrap(add_global, cache_dir=str(tmpdir))
+    assert f(1) == 2
+    assert len(f.disk_cache) == 1
+
+    cache_global = 2
+    try:
+        assert f(1) == 3
+        assert stella.wrap(add_global, cache_dir=str(tmpdir))(1) == 3
+    finally:
+        cache_global = 1
+
+
+def test_disk_cache_evict(tmpdir):
+    dcache = cache.DiskCache(str(tmpdir))
+    for i, key in enumerate(['a', 'b', 'c']):
+        dcache.store(key, {'name': key}, b'')
+        os.utime(str(tmpdir.join(key + dcache.suffix)), (i, i))
+    assert [e[0] for e in dcache.entries()] == ['c', 'b', 'a']
+
+    dcache.load('a')
+    dcache.max_entries = 2
+    dcache.evict()
+    assert [e[0] for e in dcache.entries()] == ['a', 'c']
+
+
+def test_cache_command(tmpdir):
+    stella.wrap(addition, cache_dir=str(tmpdir))(1, 2)
+    assert main(['cache', 'list', '--dir', str(tmpdir)]) == 0
+    assert main(['cache', 'purge', '--dir', str(tmpdir)]) == 0
+    assert len(cache.DiskCache(str(tmpdir))) == 0
+
+
+def test_jit():
+    f = stella.jit(addition, signatures=[(int, int), (float, float)])
+    assert len(f.cache) == 2
+    assert f(1, 2) == 3
+    assert f(1.5, 2.0) == 3.5
+    assert f.cache.hits == 2
+    assert f.__wrapped__ is addition
+
+
+def test_jit_decorator():
+    @stella.jit(signatures=[(stella.array(int),)])
+    def f(a):
+        return numpy_len_direct(a)
+
+    a = np.zeros(5, dtype=int)
+    b = np.zeros(5, dtype=int)
+    numpy_len_direct(a)
+    f(b)
+    assert all(a == b)
+    assert f.cache.hits == 1 and len(f.cache) == 1
+
+
+def test_jit_background():
+    f = stella.jit(addition, signatures=[(int, int)], background=True)
+    # the call waits for the compilation
+    assert f(40, 2) == 42
+    assert f.cache.hits == 1
+
+
+def test_jit_declaration():
+    with raises(exc.TypeError):
+        stella.jit(objList4, signatures=[(list,)])
+    with raises(exc.TypeError):
+        stella.jit(numpy_len_direct, signatures=[(stella.array(int),)], static_shape=True)
+    f = stella.jit(numpy_len_direct, signatures=[(stella.array(int, shape=(5,)),)],
+                   static_shape=True)
+    assert len(f.cache) == 1
+
+
+def test_tiered():
+    f = stella.wrap(addition, hot=2)
+    assert f(1, 2) == 3
+    assert f(2, 2) == 4
+    key, = f.tier_workers
+    f.tier_workers[key].join()
+    assert f.cache.entries[key].tier == 1
+    assert f(3, 2) == 5
+    assert f.cache.hits == 2 and f.cache.misses == 1
+
+
+def test_tiered_disabled():
+    f = stella.wrap(addition, opt=2, hot=1)
+    f(1, 2)
+    assert len(f.tier_workers) == 0
+
+
+def test_stats():
+    stats = {}
+    f = stella.wrap(addition, stats=stats)
+    f(1, 2)
+    for phase in ('disassemble', 'type_analysis', 'emit_ir', 'parse_ir', 'finalize', 'native'):
+        assert phase in stats['time_ns']
+    assert stats['counts']['functions'] == 1
+    assert stats['counts']['ir_bytes'] > 0
+    assert stats['elapsed'] >= 0
+
+    f(2, 3)
+    assert 'disassemble' not in stats['time_ns']
+    assert 'native' in stats['time_ns']
+
+
+def test_stats_callback():
+    calls = []
+    f = stella.wrap(addition, stats=calls.append)
+    f(1, 2)
+    f(2, 3)
+    assert len(calls) == 2
+    assert 'type_analysis' in calls[0]['time_ns']
+
+
+def test_concurrent():
+    """Every compilation and call has a context of its own"""
+    def compileAndCall(i):
+        b1 = B(i, i + 1)
+        b2 = B(i, i + 1)
+        setAttrib(b1)
+        stella.wrap(setAttrib)(b2)
+        l1 = [E(i), E(i + 1)]
+        l2 = [E(i), E(i + 1)]
+        objList4(l1)
+        stella.wrap(objList4)(l2)
+        return b1 == b2 and l1 == l2
+
+    with ThreadPoolExecutor(4) as pool:
+        assert all(pool.map(compileAndCall, range(16)))
+
+
+def test_concurrent_calls():
+    """Threads share the compiled code, but not the arguments"""
+    f = stella.wrap(setAttrib)
+
+    def call(i):
+        b1 = B(i, i + 1)
+        b2 = B(i, i + 1)
+        setAttrib(b1)
+        f(b2)
+        return b1 == b2
+
+    with ThreadPoolExecutor(4) as pool:
+        assert all(pool.map(call, range(64)))
+    assert len(f.cache) == 1
+
+
+def test_close_waits():
+    f = stella.wrap(addition, opt=2)
+    assert f(1, 2) == 3
+    prog, = f.cache.entries.values()
+    prog.enter()
+    f.invalidate()
+    assert prog.cfunc is not None
+    prog.leave()
+    assert prog.cfunc is None
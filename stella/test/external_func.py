@@ -46,3 +46,18 @@ def test1(f):
 @mark.parametrize('f', [seed, drand])
 def test2(f, arg):
     make_eq_test(f, arg)
+
+
+def drand_next():
+    return mtpy.mt_drand()
+
+
+@mark.parametrize('opt', [None, 3])
+def test_shared_state(opt):
+    """The compiled code and Python draw from the same generator, also if
+    the bitcode of mtwist is linked in."""
+    mtpy.mt_seed32new(7)
+    expected = [mtpy.mt_drand() for i in range(3)]
+    f = wrap(drand_next, opt=opt)
+    mtpy.mt_seed32new(7)
+    assert [mtpy.mt_drand(), f(), mtpy.mt_drand()] == expected
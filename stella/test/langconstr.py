@@ -15,6 +15,8 @@ import numpy as np
 
 from . import *  # noqa
 from stella.intrinsics.python import zeros
+from stella import exc
+from stella import parallel
 import stella
 from .basicmath import addition, subtraction
 from . import basicmath
@@ -127,6 +129,24 @@ def fib(x):
     return fib(x - 1) + fib(x - 2)
 
 
+def recursive_first(x):
+    if x > 0:
+        return x + recursive_first(x - 1)
+    return 0
+
+
+def is_even(x):
+    if x == 0:
+        return True
+    return is_odd(x - 1)
+
+
+def is_odd(x):
+    if x == 0:
+        return False
+    return is_even(x - 1)
+
+
 def fib_nonrecursive(n):
     if n == 0:
         return 1
@@ -309,6 +329,82 @@ def numpy_len_direct(a):
         a[i] = i + 1
 
 
+def numpy_copy(a, b):
+    for i in range(len(a)):
+        b[i] = a[i] * 2
+
+
+def view_store(f, i):
+    r = 0.0
+    for k in range(len(f)):
+        i[k] = 0
+        r += f[k]
+    return r
+
+
+def prange_fill(a):
+    for i in stella.prange(len(a)):
+        a[i] = i * 2 + 1
+
+
+def prange_sum(a):
+    s = 0.0
+    for i in stella.prange(len(a), schedule='dynamic'):
+        s += a[i] * a[i]
+    return s
+
+
+def prange_max(a, chunk):
+    m = -1.0
+    for i in stella.prange(1, len(a), chunk):
+        if i % 3 == 0:
+            continue
+        m = max(m, a[i])
+    return m
+
+
+def prange_nested(a, n):
+    total = 0
+    for i in stella.prange(n):
+        for j in stella.prange(n):
+            total += i * j + len(a)
+    return total
+
+
+def prange_shared(a):
+    x = 0
+    for i in stella.prange(len(a)):
+        x = a[i]
+    return x
+
+
+const_scale = 2.5
+
+
+class ConstSettings(object):
+    def __init__(self):
+        self.n = 3
+        self.scale = 1.5
+
+
+const_settings = stella.const(ConstSettings())
+
+
+def const_global(x):
+    return x * const_scale
+
+
+def const_object(x):
+    r = 0.0
+    for i in range(const_settings.n):
+        r += x * const_settings.scale
+    return r
+
+
+def const_object_assign():
+    const_settings.n = 4
+
+
 def numpy_passing(a):
     a[0] = 3
     a[2] = 1
@@ -736,7 +832,36 @@ def test19(f, args):
                                      np.array([0.0, 3.0])]))
 @mark.parametrize('f', [tuple_me])
 def test20(f, arg):
-    make_numpy_eq_test(f, arg)
+    make_numpy_eq_test(f, arg, static_shape=True)
+
+
+@mark.parametrize('arg', single_args([np.zeros(2, dtype=int), np.zeros(2)]))
+@mark.parametrize('f', [tuple_me])
+def test20_dynamic(f, arg):
+    """tuple() needs to know the shape of the array at compile time"""
+    with raises(exc.TypeError):
+        wrap(f)(*arg)
+
+
+@mark.parametrize('view', [lambda a: a[::2], lambda a: a[1:-1], lambda a: a[::-3]])
+@mark.parametrize('f', [numpy_len_direct, numpy_receiving, for3])
+def test21(f, view):
+    """Views with strides, make_numpy_eq_test() would copy them"""
+    a1 = np.array([1, 0, 2, 0, -3, 0, 4, 0, 5], dtype=int)
+    a2 = np.copy(a1)
+    assert f(view(a1)) == wrap(f)(view(a2))
+    assert all(a1 == a2)
+
+
+@mark.parametrize('view', [lambda a: a.T, lambda a: a[1:3, ::2]])
+@mark.parametrize('f', [numpy_array2d1, numpy_array2d2, numpy_array2d_for2,
+                        numpy_array2d_for4])
+def test22(f, view):
+    """2D views with strides"""
+    a1 = np.arange(24, dtype=float).reshape((4, 6))
+    a2 = np.copy(a1)
+    assert f(view(a1)) == wrap(f)(view(a2))
+    assert (a1 == a2).all()
 
 
 @mark.parametrize('args', [(40, 2), (43, 1), (42, 3), (0, 0), (2, 2), (3, 3), (3, 4), (4, 7),
@@ -744,3 +869,108 @@ def test20(f, arg):
 @mark.parametrize('f', [lt, gt, eq, le, ge, ne])
 def test19(f, args):
     make_eq_test(f, args)
+
+
+@mark.parametrize('arg', single_args([0, 1, 6, 7]))
+@mark.parametrize('f', [is_even, is_odd])
+def test23(f, arg):
+    make_eq_test(f, arg)
+
+
+def test23_unknown_return():
+    """The return type is only known after the recursive call returned"""
+    with raises(exc.TypeError):
+        wrap(recursive_first)(3)
+
+
+@mark.parametrize('views', [lambda a: (a[:5], a[5:]), lambda a: (a, a),
+                            lambda a: (a[1:], a[:-1]), lambda a: (a[:-1], a[1:])])
+def test24(views):
+    """Overlapping arrays must not be compiled as distinct"""
+    a1 = np.arange(10, dtype=float)
+    a2 = np.copy(a1)
+    numpy_copy(*views(a1))
+    wrap(numpy_copy)(*views(a2))
+    assert all(a1 == a2)
+
+
+def test24_metadata():
+    a = np.zeros(5)
+    ir = wrap(numpy_copy, ir=True)(a, np.zeros(5))
+    assert '!tbaa' in ir and '!alias.scope' in ir and 'noalias' in ir
+    assert '!alias.scope' not in wrap(numpy_copy, ir=True)(a, a)
+
+
+def test24_view():
+    """Arrays of different dtypes may share their memory"""
+    a1 = np.arange(10, dtype=float)
+    a2 = np.copy(a1)
+    assert view_store(a1, a1.view(np.int64)) == \
+        wrap(view_store)(a2, a2.view(np.int64))
+
+
+def test24_unaligned():
+    """Unaligned arrays are accessed with the alignment they have"""
+    a = np.zeros(8 * 5 + 1, dtype=np.uint8)[1:].view(float)
+    assert not a.flags.aligned
+    a[:] = np.arange(5)
+    b = np.zeros(8 * 5 + 1, dtype=np.uint8)[1:].view(float)
+    expected = np.zeros(5)
+    numpy_copy(np.copy(a), expected)
+    wrap(numpy_copy)(a, b)
+    assert all(b == expected)
+    assert 'align 1' in wrap(numpy_copy, ir=True)(a, b)
+    assert 'align 1' not in wrap(numpy_copy, ir=True)(np.copy(a), np.copy(b))
+
+
+@mark.parametrize('f, args', [(prange_fill, (np.zeros(1000, dtype=int),)),
+                              (prange_sum, (np.arange(1000, dtype=float),)),
+                              (prange_max, (np.arange(1000, dtype=float), 0)),
+                              (prange_max, (np.arange(1000, dtype=float), 7)),
+                              (prange_nested, (np.zeros(3), 100))])
+def test25(f, args):
+    make_numpy_eq_test(f, args)
+
+
+def test25_shared():
+    """Only reductions may assign to variables of the function"""
+    with raises(exc.UnimplementedError):
+        wrap(prange_shared)(np.zeros(5, dtype=int))
+
+
+def test25_failure(monkeypatch):
+    """A prange loop which cannot be run raises once the call returns"""
+    def broken():
+        raise RuntimeError("no thread pool")
+    monkeypatch.setattr(parallel, '_getPool', broken)
+    monkeypatch.setattr(parallel, '_num_threads', 2)
+    with raises(RuntimeError):
+        wrap(prange_fill)(np.zeros(10, dtype=int))
+
+
+def test25_namespace():
+    """The outlined loop bodies are not added to the module"""
+    make_numpy_eq_test(prange_nested, (np.zeros(3), 10))
+    assert not [name for name in globals() if name.startswith('__stella_prange')]
+
+
+def test26_global():
+    """Read-only scalar globals are compiled in as constants"""
+    make_eq_test(const_global, (2,))
+    assert 'const_scale' not in wrap(const_global, ir=True)(2)
+
+
+def test26_object():
+    f = wrap(const_object)
+    assert f(2.0) == const_object(2.0)
+    # the code is compiled again
+    const_settings.n = 5
+    try:
+        assert f(2.0) == const_object(2.0)
+    finally:
+        const_settings.n = 3
+
+
+def test26_object_assign():
+    with raises(exc.TypeError):
+        wrap(const_object_assign)()
@@ -15,6 +15,7 @@ import numpy as np
 
 from . import *  # noqa
 import stella
+from stella import exc
 
 
 class B(object):
@@ -162,6 +163,27 @@ class K(object):
         return 2
 
 
+# the attributes assigned to objects of class L
+assigned = []
+
+
+class L(object):
+    def __init__(self, x, y, flag):
+        self.x = x
+        self.y = y
+        self.flag = flag
+
+    def __setattr__(self, name, value):
+        assigned.append(name)
+        super().__setattr__(name, value)
+
+    def __eq__(self, other):
+        return (self.x, self.y, self.flag) == (other.x, other.y, other.flag)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+
 def justPassing(a):
     x = 1  # noqa
 
@@ -258,6 +280,25 @@ def objList5(l):
     return o.x
 
 
+def advanceX(l, dt):
+    for i in range(len(l)):
+        l[i].x += dt * l[i].y
+
+
+def doubleEvenY(l):
+    r = 0
+    for i in range(len(l)):
+        if l[i].flag:
+            r += l[i].x
+        if i % 2 == 0:
+            l[i].y = 2.0 * l[i].y
+    return r
+
+
+def soaCall(l):
+    return l[0].inc()
+
+
 def objContainingList1(f):
     return f.l[0].x + f.l[1].x
 
@@ -563,6 +604,82 @@ def test_mutation7(f):
     assert l1 == l2 and py == st
 
 
+@mark.parametrize('f', [objList1, objList2, objList3, objList5])
+def test_soa(f):
+    l1 = [E(4), E(1)]
+    l2 = stella.soa([E(4), E(1)])
+
+    py = f(l1)
+    st = stella.wrap(f)(l2)
+
+    assert l1 == l2 and py == st
+
+
+@mark.parametrize('f', [objList4])
+def test_soa_mutation(f):
+    l1 = [E(4), E(1)]
+    l2 = stella.soa([E(4), E(1)])
+
+    py = f(l1)
+    st = stella.wrap(f)(l2)
+
+    assert l1 == l2 and py == st
+
+
+def test_soa_write_back():
+    l1 = [B(1.0, 0.5), B(2.0, -1.0), B(3.0, 2.0)]
+    l2 = stella.soa([B(1.0, 0.5), B(2.0, -1.0), B(3.0, 2.0)])
+
+    advanceX(l1, 0.5)
+    stella.wrap(advanceX)(l2, 0.5)
+
+    assert l1 == l2
+
+
+def test_soa_unsupported():
+    with raises(exc.UnimplementedError):
+        stella.wrap(soaCall)(stella.soa([E(4), E(1)]))
+    with raises(exc.UnsupportedTypeError):
+        stella.wrap(objList1)(stella.soa([F([E(1)]), F([E(2)])]))
+
+
+def test_bulk_write_back():
+    l1 = [L(i, i + 0.5, i % 3 == 0) for i in range(100)]
+    l2 = [L(i, i + 0.5, i % 3 == 0) for i in range(100)]
+
+    py = doubleEvenY(l1)
+    del assigned[:]
+    st = stella.wrap(doubleEvenY)(l2)
+
+    assert l1 == l2 and py == st
+    # only the changed attributes are written back
+    assert assigned == ['y'] * 50
+
+
+def test_write_back_assigned():
+    a = L(1, 2.0, True)
+    f = F([L(3, 4.0, False), L(5, 6.0, True)])
+    del assigned[:]
+
+    assert stella.wrap(getAttrib)(a) == 1
+    assert stella.wrap(objContainingList1)(f) == 8
+    # read only objects are not written to
+    assert assigned == []
+
+    stella.wrap(setAttrib)(a)
+    assert a.x == 42 and assigned == ['x']
+
+
+@bench
+def test_marshal_list(bench_result):
+    l = [B(float(i), 1.0) for i in range(10**5)]
+    stats = {}
+    stella.wrap(advanceX, stats=stats)(l, 0.5)
+    assert l[-1].x == 10**5 - 0.5
+    times = stats['time_ns']
+    bench_result['marshal_list'] = {k: times[k] for k in ('marshal', 'native', 'write_back')}
+
+
 @mark.parametrize('f', [objContainingList1, objContainingList2])
 def test_no_mutation8(f):
     l1 = [E(2), E(5)]
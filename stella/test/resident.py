@@ -0,0 +1,107 @@
+# Copyright 2013-2015 David Mohr
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import numpy as np
+
+import stella
+from stella import exc
+
+from . import *  # noqa
+
+
+class Particle(object):
+    def __init__(self, x, v):
+        self.x = x
+        self.v = v
+
+
+class System(object):
+    def __init__(self, n):
+        self.particles = [Particle(float(i), 1.0) for i in range(n)]
+        self.kinetic = np.zeros(n)
+        self.t = 0.0
+
+    def step(self, dt):
+        for i in range(len(self.particles)):
+            self.particles[i].x += self.particles[i].v * dt
+            self.kinetic[i] = 0.5 * self.particles[i].v * self.particles[i].v
+        self.t += dt
+
+
+def step(system, dt):
+    system.step(dt)
+
+
+def positions(system):
+    return [p.x for p in system.particles]
+
+
+def test_in_place():
+    s1 = System(4)
+    s2 = System(4)
+    f = stella.wrap(step)
+
+    handle = stella.resident(s2)
+    for i in range(3):
+        step(s1, 0.5)
+        f(s2, 0.5)
+
+    # numpy arrays are shared, everything else is only copied by pull()
+    assert np.all(s1.kinetic == s2.kinetic)
+    assert s2.t == 0.0 and positions(s2) == [0.0, 1.0, 2.0, 3.0]
+    handle.pull()
+    assert s1.t == s2.t and positions(s1) == positions(s2)
+    handle.close()
+
+
+def test_push():
+    s1 = System(2)
+    s2 = System(2)
+    f = stella.wrap(step)
+
+    with stella.resident(s2) as handle:
+        for s in (s1, s2):
+            s.particles[1].v = 3.0
+            s.t = 10.0
+        handle.push()
+        step(s1, 1.0)
+        f(s2, 1.0)
+
+    assert handle.closed
+    assert s1.t == s2.t and positions(s1) == positions(s2)
+
+
+def test_bound_method():
+    s1 = System(3)
+    s2 = System(3)
+    f = stella.wrap(s2.step)
+
+    with stella.resident(s2):
+        for i in range(4):
+            s1.step(0.25)
+            f(0.25)
+
+    assert s1.t == s2.t and positions(s1) == positions(s2)
+    # after close() calls copy the objects again
+    s1.step(0.25)
+    f(0.25)
+    assert s1.t == s2.t and positions(s1) == positions(s2)
+
+
+def test_resident_errors():
+    s = System(1)
+    with stella.resident(s):
+        with raises(exc.StellaException):
+            stella.resident(s)
+    with raises(exc.TypeError):
+        stella.resident(1.0)
@@ -0,0 +1,117 @@
+# Copyright 2013-2015 David Mohr
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from stella import rng, exc
+
+from . import *  # noqa
+
+
+def uniform_sum(gen, n):
+    r = 0.0
+    for i in range(n):
+        r += rng.uniform(gen)
+    return r
+
+
+def exponential_sum(gen, n):
+    r = 0.0
+    for i in range(n):
+        r += rng.exponential(gen, 2)
+    return r
+
+
+def normal_sum(gen, n):
+    r = 0.0
+    for i in range(n):
+        r += rng.normal(gen)
+    return r
+
+
+def randint_sum(gen, n):
+    r = 0
+    for i in range(n):
+        r = r * 7 + rng.randint(gen, -3, 3)
+    return r
+
+
+def randint_float(gen):
+    return rng.randint(gen, 0, 1.5)
+
+
+def randint_empty(gen):
+    return rng.randint(gen, 3, 2)
+
+
+def randint_bounds(gen, low, high):
+    return rng.randint(gen, low, high)
+
+
+class NotAGenerator(object):
+    def __init__(self):
+        self.s0 = 1
+
+
+def not_a_generator(gen):
+    return rng.uniform(gen)
+
+
+def test_reference():
+    # the first output of xoshiro256** for the state 1, 2, 3, 4
+    gen = rng.Xoshiro256()
+    gen.s0, gen.s1, gen.s2, gen.s3 = 1, 2, 3, 4
+    assert rng.next_word(gen) == 11520
+    assert rng.next_word(gen) == 0
+    assert rng.next_word(gen) == 1509978240
+
+
+def test_streams():
+    gen = rng.Xoshiro256(seed=7)
+    a, b = gen.split(2)
+    assert a == rng.Xoshiro256(seed=7, stream=1)
+    assert b == rng.Xoshiro256(seed=7, stream=2)
+    assert a != b and gen == rng.Xoshiro256(seed=7)
+    assert rng.uniform(a) != rng.uniform(b)
+
+
+@mark.parametrize('f', [uniform_sum, randint_sum])
+@mark.parametrize('seed', [0, 42])
+def test_exact(f, seed):
+    gen1 = rng.Xoshiro256(seed)
+    gen2 = rng.Xoshiro256(seed)
+    assert f(gen1, 10) == wrap(f)(gen2, 10)
+    # the compiled code advanced the state of the object
+    assert gen1 == gen2
+
+
+@mark.parametrize('f', [exponential_sum, normal_sum])
+def test_close(f):
+    gen1 = rng.Xoshiro256(3)
+    gen2 = rng.Xoshiro256(3)
+    assert abs(f(gen1, 100) - wrap(f)(gen2, 100)) < delta
+    assert gen1 == gen2
+
+
+@mark.parametrize('f,arg', [(randint_float, rng.Xoshiro256()),
+                            (not_a_generator, NotAGenerator())])
+def test_type_errors(f, arg):
+    with raises(exc.TypeError):
+        wrap(f)(arg)
+
+
+def test_randint_empty():
+    with raises(ValueError):
+        randint_empty(rng.Xoshiro256())
+    with raises(exc.ValueError):
+        wrap(randint_empty)(rng.Xoshiro256())
+    # compiled code cannot raise for bounds only known at run time
+    assert wrap(randint_bounds)(rng.Xoshiro256(), 5, 4) == 5
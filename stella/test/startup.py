@@ -0,0 +1,71 @@
+# Copyright 2013-2015 David Mohr
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import os.path
+from subprocess import check_output
+import sys
+import time
+
+import stella
+
+from . import *  # noqa
+
+
+def python_startup(code, cwd):
+    """Seconds it takes a new interpreter to run code, and its output."""
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.path.dirname(os.path.dirname(stella.__file__))
+    env.pop('STELLA_FAULTHANDLER', None)
+    time_start = time.time()
+    out = check_output([sys.executable, '-c', code], cwd=cwd, env=env)
+    return time.time() - time_start, out.decode().strip()
+
+
+# versioneer in stella._version runs git with subprocess
+heavy_modules = ('llvmlite', 'numpy', 'stella.analysis', 'stella.codegen', 'stella._version',
+                 'subprocess')
+
+
+def test_import_lazy(tmpdir):
+    """import stella must neither load the compiler nor touch the file system"""
+    _, out = python_startup("import sys, stella; print(sorted(m for m in {!r} "
+                            "if m in sys.modules))".format(heavy_modules), str(tmpdir))
+    assert out == '[]'
+    assert tmpdir.listdir() == []
+
+
+def test_version(tmpdir):
+    """__version__ is static, versioneer only runs when asked for the full
+    version"""
+    _, out = python_startup("import sys, stella; print(bool(stella.__version__), "
+                            "'stella._version' in sys.modules)", str(tmpdir))
+    assert out == 'True False'
+
+
+def test_import_on_use(tmpdir):
+    _, out = python_startup("import stella; print(stella.prange(3), stella.rng.uniform.__name__)",
+                            str(tmpdir))
+    assert out == 'range(0, 3) uniform'
+
+
+@bench
+def test_import(bench_result, tmpdir):
+    n = 10
+    times = {'python': 0.0, 'stella': 0.0}
+    for i in range(n):
+        times['python'] += python_startup('pass', str(tmpdir))[0] / n
+        times['stella'] += python_startup('import stella', str(tmpdir))[0] / n
+    bench_result['import'] = {'startup': times}
+    # importing stella may at most double the startup time of the interpreter
+    assert times['stella'] <= 2 * times['python']
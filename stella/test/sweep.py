@@ -0,0 +1,45 @@
+# Copyright 2013-2015 David Mohr
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import stella
+from stella import sweep
+
+from . import *  # noqa
+from .basicmath import addition
+
+
+def scaled(x, seed):
+    if x < 0:
+        raise ValueError(x)
+    return x * seed
+
+
+def test_grid_points():
+    assert sweep.grid_points({'b': [3], 'a': [1, 2]}) == [{'a': 1, 'b': 3}, {'a': 2, 'b': 3}]
+    assert sweep.grid_points([{'a': 1}]) == [{'a': 1}]
+
+
+def test_ensemble(tmpdir):
+    runs = list(stella.ensemble(addition, {'a': [1, 2], 'b': [3, 4.5]}, processes=2,
+                                cache_dir=str(tmpdir)))
+    assert sorted(run.result for run in runs) == [4, 5, 5.5, 6.5]
+    assert all(run.ok and run.attempts == 1 for run in runs)
+
+
+def test_ensemble_errors():
+    runs = list(stella.ensemble(scaled, {'x': [-1, 2]}, seeds=3, processes=2, retries=1,
+                                compile=False))
+    failed = [run for run in runs if not run.ok]
+    assert len(failed) == 3
+    assert all(run.attempts == 2 and isinstance(run.error, ValueError) for run in failed)
+    assert sorted(run.result for run in runs if run.ok) == [0, 2, 4]
@@ -21,7 +21,9 @@ import inspect
 from functools import reduce
 import operator
 
+from . import context
 from . import exc
+from . import utils
 
 
 class Type(metaclass=ABCMeta):
@@ -324,32 +326,27 @@ class CType(object):
     """
     Dynamically create a ctype Structure.
     """
-    _registry = {}
-
     @classmethod
     def getStruct(klass, name, fields=[]):
         """
         Creates a Structure with the given fields. Caches based on (name, fields).
         """
         fields = tuple(fields)
-        if name not in klass._registry:
+        registry = context.current().ctypes
+        if name not in registry:
             if fields:
                 attribs = {'_fields_': fields}
             else:
                 attribs = {}
             type_ = type(name, (ctypes.Structure, ), attribs)
-            klass._registry[name] = type_
+            registry[name] = type_
             return type_
         else:
-            struct = klass._registry[name]
+            struct = registry[name]
             if fields:
                 assert fields == struct._fields_
             return struct
 
-    @classmethod
-    def destruct(klass):
-        klass._registry.clear()
-
 
 class StructType(Type):
     on_heap = True
@@ -360,7 +357,6 @@ class StructType(Type):
     attrib_idx = None
     _ctype = None
     _llvmtype = None
-    type_store = {}  # Class variable
 
     @classmethod
     def fromObj(klass, obj):
@@ -373,12 +369,13 @@ class StructType(Type):
 
         # cache it early, which allows fields of this type to be resolved
         # immediately
-        if type_name in klass.type_store:
-            return klass.type_store[type_name]
+        type_store = context.current().struct_types
+        if type_name in type_store:
+            return type_store[type_name]
 
         type_ = StructType(type_name)
         type_.makePointer()  # by default
-        klass.type_store[type_name] = type_
+        type_store[type_name] = type_
 
         attrib_type = {}
         attrib_idx = {}
@@ -417,10 +414,6 @@ class StructType(Type):
 
         return type_
 
-    @classmethod
-    def destruct(klass):
-        klass.type_store.clear()
-
     def __init__(self, name):
         self.name = name
 
@@ -430,6 +423,11 @@ class StructType(Type):
     def getMemberIdx(self, name):
         return self.attrib_idx[name]
 
+    def fieldName(self, name):
+        """Identifies the memory of the field name for the alias analysis, see
+        ir.Module.tbaa()."""
+        return '{}.{}'.format(self.name, name)
+
     def _scalarAttributeNames(self):
         return filter(lambda n: not isinstance(self.attrib_type[n], FunctionType),
                       self.attrib_names)
@@ -476,8 +474,7 @@ class StructType(Type):
         for name in self.attrib_names:
             item = getattr(value, name)
             if isinstance(item, np.ndarray):
-                # TODO: will this fail with float?
-                item = ctypes.cast(item.ctypes.data, ctypes.POINTER(ctypes.c_int))
+                item = self.attrib_type[name].ctypeValue(item)
             elif isinstance(item, list):
                 l = List.fromObj(item)
                 l.ctypeInit()
@@ -487,28 +484,39 @@ class StructType(Type):
             elif not supported_scalar(type(item)) and not isinstance(item, types.MethodType):
                 # struct, has to be the last check because everything is an
                 # object in Python
-                item = wrapValue(item).transfer_value
+                wrapped = wrapValue(item)
+                wrapped.ctypeInit()
+                item = wrapped.transfer_value
             setattr(transfer_value, name, item)
 
-    def constant(self, value, cge):
-        """Transfer values Python -> Stella"""
-        transfer_value = self.ctype()
-        # logging.debug("StructType.constant() {}/{:x} -> {}/{:x}".format(self, id(self),
-        #                                                                 transfer_value,
-        #                                                                 id(transfer_value)))
-
-        assert self.ptr == 1
-
-        self.ctypeInit(value, transfer_value)
-
-        addr_llvm = Int.constant(int(ctypes.addressof(transfer_value)))
-        result_llvm = ll.Constant(tp_int, addr_llvm).inttoptr(self.llvmType(cge.module))
-        # logging.debug("{} constant() transfer {}:{}".format(value, transfer_value,
-        #                                                     id(transfer_value)))
-        return (result_llvm, transfer_value)
+    def writtenAttributeNames(self, written):
+        """The attributes to copy back after a call of code which assigns the
+        fields written, see fieldName(). None stands for all fields."""
+        if written is None:
+            return list(self._scalarAttributeNames())
+        return [name for name in self._scalarAttributeNames()
+                if self.fieldName(name) in written]
+
+    def modified(self, written, seen=None):
+        """False if code which assigns the fields written changes neither an
+        object of this type nor any object it refers to."""
+        if written is None:
+            return True
+        if seen is None:
+            seen = set()
+        seen.add(id(self))
+        for name, type_ in self.items():
+            if self.fieldName(name) in written:
+                return True
+            if isinstance(type_, ListType):
+                type_ = type_.type_
+            if isinstance(type_, StructType) and id(type_) not in seen \
+                    and type_.modified(written, seen):
+                return True
+        return False
 
-    def ctype2Python(self, transfer_value, value):
-        for name in self._scalarAttributeNames():
+    def ctype2Python(self, transfer_value, value, written=None):
+        for name in self.writtenAttributeNames(written):
             item = getattr(transfer_value, name)
             # TODO generalize!
             if isinstance(self.attrib_type[name], List):
@@ -546,7 +554,7 @@ class StructType(Type):
         # logging.debug("*{:x}".format(ctypes.addressof(val.contents)))
         if (val):
             addr = ctypes.addressof(val.contents)
-            return Struct.obj_store[addr].value
+            return context.current().objects[addr].value
         else:
             # null pointer
             return None
@@ -621,6 +629,9 @@ class ArrayType(Type, Subscriptable):
     shape = None
     on_heap = True
     ctype = ctypes.POINTER(ctypes.c_int)  # TODO why is ndarray.ctypes.data of type int?
+    # the alignment of the elements in bytes if it is less than their size,
+    # see utils.array_alignment()
+    align = None
 
     @classmethod
     def fromObj(klass, obj):
@@ -645,10 +656,16 @@ class ArrayType(Type, Subscriptable):
 
         if ndim == 0:
             raise exc.UnimplementedError("Array with zero dimensions is not supported.")
+        elif not context.current().static_shape:
+            type_ = DynArrayType(dtype, ndim)
         elif ndim == 1:
-            return ArrayType(dtype, shape[0])
+            type_ = ArrayType(dtype, shape[0])
         else:
-            return ArrayNdType(dtype, shape)
+            type_ = ArrayNdType(dtype, shape)
+        align = utils.array_alignment(obj)
+        if align < obj.itemsize:
+            type_.align = align
+        return type_
 
     @classmethod
     def isValidType(klass, type_):
@@ -682,7 +699,45 @@ class ArrayType(Type, Subscriptable):
         p = cge.builder.gep(container.translate(cge),
                             [Int.constant(0), idx.translate(cge)],
                             inbounds=True)
-        return cge.builder.load(p)
+        return self._loadElement(cge, container, p)
+
+    def _alignment(self):
+        """numpy usually aligns the elements of arrays to their size."""
+        return self.align or ctypes.sizeof(self.type_.Ctype())
+
+    # A single name for the elements of all arrays: numpy views can show the
+    # same memory with different dtypes, e.g. a.view(np.int64) of a float array.
+    _element_name = 'array element'
+
+    def _loadElement(self, cge, container, p):
+        instr = cge.builder.load(p, align=self._alignment())
+        cge.module.annotateAccess(instr, self._element_name, container)
+        return instr
+
+    def _storeElement(self, cge, container, p, val):
+        instr = cge.builder.store(val, p, align=self._alignment())
+        cge.module.annotateAccess(instr, self._element_name, container)
+
+    def shapeType(self):
+        """The type of `array.shape'."""
+        return get(self.shape)
+
+    def loadShape(self, cge, container):
+        return wrapValue(self.shape).translate(cge)
+
+    def loadLength(self, cge, container):
+        """The llvm value of `len(array)'."""
+        return Int.constant(self.shape)
+
+    def ctypeValue(self, array):
+        """Convert the numpy array to the value passed to the native code."""
+        # TODO: will this fail with float?
+        return ctypes.cast(array.ctypes.data, ctypes.POINTER(ctypes.c_int))
+
+    def constantPointer(self, cge, array):
+        """Compile in the address of the numpy array."""
+        ptr_int_llvm = Int.constant(array.ctypes.data)
+        return ll.Constant(tp_int, ptr_int_llvm).inttoptr(self.llvmType(cge.module).as_pointer())
 
     def cast(self, value, cge):
         if value.type == self.type_:
@@ -698,7 +753,7 @@ class ArrayType(Type, Subscriptable):
             container.translate(cge), [
                 Int.constant(0), idx.translate(cge)], inbounds=True)
         val = self.cast(value, cge)
-        cge.builder.store(val, p)
+        self._storeElement(cge, container, p, val)
 
 
 class ArrayNdType(ArrayType):
@@ -726,6 +781,9 @@ class ArrayNdType(ArrayType):
         type_ = ll.ArrayType(self.type_.llvmType(module), reduce(operator.mul, self.shape))
         return type_
 
+    def loadLength(self, cge, container):
+        return Int.constant(self.shape[0])
+
     def _generateIndex(self, cge, idx):
         # TODO: test with dim > 2
         assert idx.type.len > 1
@@ -745,7 +803,7 @@ class ArrayNdType(ArrayType):
         p = cge.builder.gep(container.translate(cge),
                             self._generateIndex(cge, idx),
                             inbounds=True)
-        return cge.builder.load(p)
+        return self._loadElement(cge, container, p)
 
     def storeSubscript(self, cge, container, idx, value):
         self._boundsCheck(idx)
@@ -753,12 +811,139 @@ class ArrayNdType(ArrayType):
                             self._generateIndex(cge, idx),
                             inbounds=True)
         val = self.cast(value, cge)
-        cge.builder.store(val, p)
+        self._storeElement(cge, container, p, val)
+
+
+class DynArrayType(ArrayType):
+    """A numpy array whose shape is only known at run time.
+
+    The native code receives a pointer to a descriptor holding the data
+    pointer, the shape and the strides (in elements) of the array, so the same
+    code works for arrays of any size.
+    """
+    def __init__(self, type_, ndim):
+        self.type_ = type_
+        self.ndim = ndim
+
+    def _boundsCheck(self, idx):
+        """Only the number of dimensions can be checked at compile time."""
+        if idx.type is NoType:
+            return
+        if isinstance(idx.type, TupleType):
+            ndim = idx.type.len
+        else:
+            ndim = 1
+        if ndim != self.ndim:
+            msg = "TODO: indexing with {} dimensions into an {}-dimensional array".format(
+                ndim, self.ndim)
+            raise exc.TypeError(msg)
+
+    def _llvmType(self, module):
+        dims = ll.ArrayType(tp_int, self.ndim)
+        return ll.LiteralStructType([self.type_.llvmType(module).as_pointer(), dims, dims])
+
+    def __str__(self):
+        return "{}{}[{}d]".format('*'*self.ptr, self.type_, self.ndim)
+
+    def __eq__(self, other):
+        return (type(self) == type(other)
+                and self.type_ == other.type_
+                and self.ndim == other.ndim
+                and self.align == other.align)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def _loadField(self, cge, container, field, i=None):
+        idx = [Int.constant(0), getIndex(field)]
+        if i is not None:
+            idx.append(getIndex(i))
+        p = cge.builder.gep(container.translate(cge), idx, inbounds=True)
+        instr = cge.builder.load(p)
+        cge.module.annotateAccess(instr, 'array descriptor')
+        return instr
+
+    def _elementPointer(self, cge, container, idx):
+        self._boundsCheck(idx)
+        if self.ndim == 1:
+            indices = [idx.translate(cge)]
+        else:
+            indices = [idx.type.loadSubscript(cge, idx, i) for i in range(self.ndim)]
+
+        offset = None
+        for i, idx_val in enumerate(indices):
+            stride = self._loadField(cge, container, 2, i)
+            dim_offset = cge.builder.mul(idx_val, stride)
+            if offset is None:
+                offset = dim_offset
+            else:
+                offset = cge.builder.add(offset, dim_offset)
+
+        data = self._loadField(cge, container, 0)
+        return cge.builder.gep(data, [offset], inbounds=True)
+
+    def loadSubscript(self, cge, container, idx):
+        return self._loadElement(cge, container, self._elementPointer(cge, container, idx))
+
+    def storeSubscript(self, cge, container, idx, value):
+        p = self._elementPointer(cge, container, idx)
+        self._storeElement(cge, container, p, self.cast(value, cge))
+
+    def shapeType(self):
+        return TupleType([Int] * self.ndim)
+
+    def loadShape(self, cge, container):
+        shape_type = self.shapeType()
+        llvm = ll.Constant(shape_type.llvmType(cge.module), ll.Undefined)
+        for i in range(self.ndim):
+            llvm = cge.builder.insert_value(llvm, self._loadField(cge, container, 1, i), i)
+        return llvm
+
+    def loadLength(self, cge, container):
+        return self._loadField(cge, container, 1, 0)
+
+    def descriptor(self):
+        """The ctypes structure of the array descriptor."""
+        return CType.getStruct("__array{}d__".format(self.ndim), [
+            ("data", ctypes.c_void_p),
+            ("shape", ctypes.c_int64 * self.ndim),
+            ("strides", ctypes.c_int64 * self.ndim)])
+
+    @property
+    def ctype(self):
+        return ctypes.POINTER(self.descriptor())
+
+    def _dims(self, array):
+        if array.ndim != self.ndim:
+            raise exc.TypeError("Expected an array with {} dimensions, but it has {}".format(
+                self.ndim, array.ndim))
+        strides = [s // array.itemsize for s in array.strides]
+        return array.shape, strides
+
+    def ctypeValue(self, array):
+        shape, strides = self._dims(array)
+        desc = self.descriptor()(array.ctypes.data, tuple(shape), tuple(strides))
+        return ctypes.pointer(desc)
+
+    def constantPointer(self, cge, array):
+        """Compile in a descriptor of the numpy array."""
+        shape, strides = self._dims(array)
+        data = ll.Constant(tp_int, array.ctypes.data).inttoptr(
+            self.type_.llvmType(cge.module).as_pointer())
+        dims = ll.ArrayType(tp_int, self.ndim)
+        desc = ll.Constant.literal_struct([data,
+                                           ll.Constant(dims, list(shape)),
+                                           ll.Constant(dims, list(strides))])
+        gv = ll.GlobalVariable(cge.module.llvm, desc.type,
+                               cge.module.llvm.get_unique_name('__array'))
+        gv.initializer = desc
+        gv.global_constant = True
+        gv.linkage = 'internal'
+        return gv
 
 
 class ListType(ArrayType):
     req_transfer = True
-    type_store = {}  # Class variable
 
     @classmethod
     def fromObj(klass, obj):
@@ -787,27 +972,58 @@ class ListType(ArrayType):
     def getElementType(self, idx):
         return Reference(super().getElementType(idx))
 
-    @classmethod
-    def destruct(klass):
-        klass.type_store.clear()
-
     def __init__(self, base_type, shape):
         super().__init__(base_type, shape)
 
     def _llvmType(self, module):
         mangled_name = str(self)
+        type_store = context.current().list_types
 
-        if mangled_name not in self.__class__.type_store:
+        if mangled_name not in type_store:
             type_ = ll.ArrayType(self.type_.llvmType(module), self.shape)
-            self.__class__.type_store[mangled_name] = type_
+            type_store[mangled_name] = type_
             return type_
         else:
-            return self.__class__.type_store[mangled_name]
+            return type_store[mangled_name]
 
     def ctypeInit(self, value, transfer_value):
         for i in range(len(value)):
             self.type_.ctypeInit(value[i], transfer_value[i])
 
+    def ctype2Python(self, transfer_value, value, written=None):
+        for i in range(len(value)):
+            self.type_.ctype2Python(transfer_value[i], value[i], written)
+
+    def flat(self):
+        """True if the elements only have int, float and bool attributes. The
+        list is then transferred as a numpy structured array, see dtype()."""
+        names = list(self.type_._scalarAttributeNames())
+        return len(names) > 0 and all(self.isValidType(self.type_.getMemberType(name))
+                                      for name in names)
+
+    def dtype(self):
+        """The numpy dtype of the elements of a flat() list. It has the layout
+        of the struct ctype, so the native code can use the array in place."""
+        dtype = np.dtype([(name, self.type_.getMemberType(name).ctype)
+                          for name in self.type_._scalarAttributeNames()], align=True)
+        assert dtype.itemsize == ctypes.sizeof(self.type_.ctype)
+        return dtype
+
+    def arrayInit(self, value, array):
+        """Fill array column by column from the objects in value."""
+        for name in array.dtype.names:
+            array[name] = np.fromiter(map(operator.attrgetter(name), value),
+                                      array.dtype[name], len(value))
+
+    def array2Python(self, array, initial, value, written=None):
+        """Write the elements of array which differ from initial back into the
+        objects in value."""
+        for name in self.type_.writtenAttributeNames(written):
+            column = array[name]
+            changed = np.flatnonzero(column != initial[name])
+            for i, item in zip(changed.tolist(), column[changed].tolist()):
+                setattr(value[i], name, item)
+
     @property
     def ctype(self):
         return self.type_.ctype * self.shape
@@ -828,6 +1044,124 @@ class ListType(ArrayType):
         return p
 
 
+class SoAList(list):
+    """A list of objects which compiled code stores as a structure of arrays,
+    see soa()."""
+
+
+def soa(objects):
+    """Lay out the list of objects as one array per attribute in compiled
+    code instead of an array of structs.
+
+    A loop over `bodies[j].x' then reads consecutive memory, which can be
+    vectorized. The objects must be of one class with int, float and bool
+    attributes only, and their methods cannot be called from compiled code.
+    The attributes are copied back into the objects after each call.
+
+    Returns a new list of the same objects:
+
+        bodies = stella.soa(bodies)
+    """
+    return SoAList(objects)
+
+
+class SoAListType(ListType):
+    """The columns of a SoAList: a struct holding an array of each attribute."""
+    @classmethod
+    def fromObj(klass, obj):
+        type_ = super().fromObj(obj)
+        for name in type_.type_._scalarAttributeNames():
+            if not klass.isValidType(type_.type_.getMemberType(name)):
+                raise exc.UnsupportedTypeError(
+                    "stella.soa() requires scalar attributes, but {}.{} is of type {}".format(
+                        type_.type_.name, name, type_.type_.getMemberType(name)))
+        return type_
+
+    def flat(self):
+        # the columns are filled by ctypeInit() already
+        return False
+
+    def getElementType(self, idx):
+        self._boundsCheck(idx)
+        return SoAElementType(self)
+
+    def _columns(self):
+        return [(name, self.type_.getMemberType(name))
+                for name in self.type_._scalarAttributeNames()]
+
+    def _llvmType(self, module):
+        return ll.LiteralStructType([ll.ArrayType(type_.llvmType(module), self.shape)
+                                     for _, type_ in self._columns()])
+
+    def ctypeInit(self, value, transfer_value):
+        for name, _ in self._columns():
+            getattr(transfer_value, name)[:] = [getattr(o, name) for o in value]
+
+    def ctype2Python(self, transfer_value, value, written=None):
+        for name in self.type_.writtenAttributeNames(written):
+            for o, item in zip(value, getattr(transfer_value, name)):
+                setattr(o, name, item)
+
+    @property
+    def ctype(self):
+        fields = [(name, type_.ctype * self.shape) for name, type_ in self._columns()]
+        return CType.getStruct("_{}_soa{}_transfer".format(self.type_.name, self.shape), fields)
+
+    def __str__(self):
+        return "{}soa {}[{}]".format('*'*self.ptr, self.type_, self.shape)
+
+    def loadSubscript(self, cge, container, idx):
+        """The element is a reference to the columns and its index."""
+        self._boundsCheck(idx)
+        element = ll.Constant(self.getElementType(idx).llvmType(cge.module), ll.Undefined)
+        element = cge.builder.insert_value(element, container.translate(cge), 0)
+        return cge.builder.insert_value(element, idx.translate(cge), 1)
+
+    def storeSubscript(self, cge, container, idx, value):
+        raise exc.UnimplementedError("Cannot replace an element of a list marked with "
+                                     "stella.soa()")
+
+
+class SoAElementType(Type):
+    """An object in a SoAListType. Its attributes are loaded from the
+    columns of the list."""
+    def __init__(self, list_type):
+        self.list_type = list_type
+
+    def dereference(self):
+        return self
+
+    def getMemberType(self, name):
+        type_ = self.list_type.type_.getMemberType(name)
+        if isinstance(type_, FunctionType):
+            raise exc.UnimplementedError("Cannot call {} on an object in a list marked with "
+                                         "stella.soa()".format(name))
+        return type_
+
+    def fieldName(self, name):
+        return self.list_type.type_.fieldName(name)
+
+    def memberPointer(self, cge, element, name):
+        """The address of the attribute name of element."""
+        element_llvm = element.translate(cge)
+        columns = cge.builder.extract_value(element_llvm, 0)
+        idx = cge.builder.extract_value(element_llvm, 1)
+        column = getIndex(self.list_type.type_.getMemberIdx(name))
+        return cge.builder.gep(columns, [Int.constant(0), column, idx], inbounds=True)
+
+    def _llvmType(self, module):
+        return ll.LiteralStructType([self.list_type._llvmType(module).as_pointer(), tp_int])
+
+    def __str__(self):
+        return "{} of {}".format(self.list_type.type_, self.list_type)
+
+    def __eq__(self, other):
+        return type(self) == type(other) and self.list_type == other.list_type
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+
 class Callable(metaclass=ABCMeta):
     def combineArgs(self, args, kwargs):
         """Combine concrete args and kwargs according to calling conventions.
@@ -849,8 +1183,6 @@ class Foreign(object):
 
 
 class FunctionType(Type):
-    _registry = {}
-
     @classmethod
     def get(klass, obj, bound=None, builtin=False):
         if bound:
@@ -858,14 +1190,11 @@ class FunctionType(Type):
         else:
             key = obj
 
-        if key not in klass._registry:
-            klass._registry[key] = klass(obj, bound, builtin)
+        registry = context.current().function_types
+        if key not in registry:
+            registry[key] = klass(obj, bound, builtin)
 
-        return klass._registry[key]
-
-    @classmethod
-    def destruct(klass):
-        klass._registry.clear()
+        return registry[key]
 
     def __init__(self, obj, bound=None, builtin=False):
         """Type representing a function.
@@ -1056,6 +1385,8 @@ def get(obj):
         return ArrayType.fromObj(obj)
     elif type_ == list:
         return ListType.fromObj(obj)
+    elif type_ == SoAList:
+        return SoAListType.fromObj(obj)
     elif isinstance(obj, types.FunctionType):
         return FunctionType.get(obj)
     elif isinstance(obj, types.MethodType):
@@ -1084,8 +1415,12 @@ def from_ctype(type_):
     return _cscalars[type_]
 
 
-# values which need to be destructed: Any complex type that is wrapped.
-_stella_values_ = []
+def written_fields(cge):
+    """The fields assigned by the compiled code of cge, or None if they are
+    not known, e.g. for code compiled ahead of time."""
+    if cge is None:
+        return None
+    return cge.written
 
 
 class Typable(object):
@@ -1139,6 +1474,10 @@ class Typable(object):
         # test.langconstr.new_global_var
         return self.llvm
 
+    def python2Ctype(self):
+        """Returns the value that is passed to the native code for this object."""
+        return self.value
+
     def ctype2Python(self, cge):
         pass
 
@@ -1196,16 +1535,16 @@ class NumpyArray(Typable):
     def __init__(self, array):
         assert isinstance(array, np.ndarray)
 
-        # TODO: multi-dimensional arrays
         self.type = Reference(ArrayType.fromObj(array))
         self.value = array
 
-    def translate(self, cge):
-        ptr_int = self.value.ctypes.data
-        ptr_int_llvm = Int.constant(ptr_int)
+    def python2Ctype(self):
+        # keep the transfer value alive for the duration of the call
+        self.transfer_value = self.type.dereference().ctypeValue(self.value)
+        return ctypes.cast(self.transfer_value, ctypes.c_void_p).value
 
-        type_ = self.type.llvmType(cge.module)
-        self.llvm = ll.Constant(tp_int, ptr_int_llvm).inttoptr(type_)
+    def translate(self, cge):
+        self.llvm = self.type.dereference().constantPointer(cge, self.value)
         return self.llvm
 
     def __str__(self):
@@ -1216,17 +1555,16 @@ class NumpyArray(Typable):
 
 
 class Struct(Typable):
-    obj_store = {}  # Class variable, used to map returned objects back to the original Python
-
     @classmethod
     def fromObj(klass, obj):
         """Only one Struct representation per Python object instance.
         """
-        if not hasattr(obj, '__stella_wrapper__'):
-            obj.__stella_wrapper__ = Struct(obj)
-            _stella_values_.append(obj.__stella_wrapper__)
-        assert isinstance(obj.__stella_wrapper__, klass)
-        return obj.__stella_wrapper__
+        ctx = context.current()
+        if id(obj) not in ctx.structs:
+            wrapped = klass(obj)
+            ctx.structs[id(obj)] = wrapped
+            ctx.values.append(wrapped)
+        return ctx.structs[id(obj)]
 
     def __init__(self, obj):
         self.type = StructType.fromObj(obj)
@@ -1248,15 +1586,31 @@ class Struct(Typable):
     def __repr__(self):
         return repr(self.type)
 
-    def translate(self, cge):
+    def ctypeInit(self):
+        """Create the transfer value which represents the object in Stella."""
         for wrapped in self.transfer_attributes.values():
-            wrapped.translate(cge)
-        if not self.llvm:
-            (self.llvm, self.transfer_value) = self.type.constant(self.value, cge)
-            # logging.debug("translate() of {}: *{:x}".format(self.transfer_value,
+            wrapped.ctypeInit()
+        if not hasattr(self, 'transfer_value'):
+            assert self.type.ptr == 1
+            self.transfer_value = self.type.ctype()
+            self.type.ctypeInit(self.value, self.transfer_value)
+            # logging.debug("ctypeInit() of {}: *{:x}".format(self.transfer_value,
             #                                                 ctypes.addressof(self.transfer_value)))
             addr = ctypes.addressof(self.transfer_value)
-            self.__class__.obj_store[addr] = self
+            context.current().objects[addr] = self
+
+    def ctypeUpdate(self):
+        """Copy the attributes into the existing transfer value again."""
+        self.type.ctypeInit(self.value, self.transfer_value)
+
+    def python2Ctype(self):
+        self.ctypeInit()
+        return ctypes.addressof(self.transfer_value)
+
+    def translate(self, cge):
+        if not self.llvm:
+            addr_llvm = Int.constant(self.python2Ctype())
+            self.llvm = ll.Constant(tp_int, addr_llvm).inttoptr(self.type.llvmType(cge.module))
         assert self.transfer_value
         return self.llvm
 
@@ -1266,7 +1620,10 @@ class Struct(Typable):
 
         Please call self.destruct() afterwards.
         """
-        self.type.ctype2Python(self.transfer_value, self.value)
+        written = written_fields(cge)
+        if not self.type.modified(written):
+            return
+        self.type.ctype2Python(self.transfer_value, self.value, written)
         for wrapped in self.transfer_attributes.values():
             wrapped.ctype2Python(cge)
 
@@ -1274,35 +1631,33 @@ class Struct(Typable):
         # TODO why don't we always have a transfer_value?
         if hasattr(self, 'transfer_value'):
             # logging.debug("{}/{:x} destruct()".format(self, id(self.transfer_value)))
-            addr = ctypes.addressof(self.transfer_value)
-            del self.__class__.obj_store[addr]
             del self.transfer_value
-        del self.value.__stella_wrapper__
 
 
 class List(Typable):
-    _registry = {}  # Class variable
-
     @classmethod
     def fromObj(klass, obj):
-        """Only one Struct representation per Python object instance.
+        """Only one List representation per Python object instance.
         """
-        if id(obj) not in klass._registry:
+        ctx = context.current()
+        if id(obj) not in ctx.lists:
             wrapped = klass(obj)
-            klass._registry[id(obj)] = wrapped
-            _stella_values_.append(wrapped)
-        return klass._registry[id(obj)]
-
-    @classmethod
-    def destructList(klass):
-        klass._registry.clear()
+            ctx.lists[id(obj)] = wrapped
+            ctx.values.append(wrapped)
+        return ctx.lists[id(obj)]
 
     def __init__(self, obj):
-        self.type = ListType.fromObj(obj)
+        self.type = get(obj)
         self.type.makePointer()
         self.value = obj
 
-        self.transfer_value = self.type.ctype()
+        if self.type.flat():
+            # the transfer value shares the memory of the array
+            self.array = np.zeros(len(obj), self.type.dtype())
+            self.transfer_value = self.type.ctype.from_buffer(self.array)
+        else:
+            self.array = None
+            self.transfer_value = self.type.ctype()
 
     def __str__(self):
         return str(self.type)
@@ -1311,15 +1666,25 @@ class List(Typable):
         return repr(self.type)
 
     def ctypeInit(self):
-        self.type.ctypeInit(self.value, self.transfer_value)
+        if self.array is not None:
+            self.type.arrayInit(self.value, self.array)
+            # to find the changed elements, see ctype2Python()
+            self.initial = self.array.copy()
+        else:
+            self.type.ctypeInit(self.value, self.transfer_value)
+
+    def ctypeUpdate(self):
+        self.ctypeInit()
+
+    def python2Ctype(self):
+        self.ctypeInit()
+        return ctypes.addressof(self.transfer_value)
 
     def translate(self, cge):
         if self.llvm:
             return self.llvm
 
-        self.ctypeInit()
-
-        addr_llvm = Int.constant(int(ctypes.addressof(self.transfer_value)))
+        addr_llvm = Int.constant(self.python2Ctype())
         self.llvm = ll.Constant(tp_int, addr_llvm).inttoptr(self.type.llvmType(cge.module))
         return self.llvm
 
@@ -1329,11 +1694,17 @@ class List(Typable):
 
         Please call self.destruct() afterwards.
         """
-        for i in range(len(self.value)):
-            self.type.type_.ctype2Python(self.transfer_value[i], self.value[i])
+        written = written_fields(cge)
+        if not self.type.type_.modified(written):
+            return
+        if self.array is not None:
+            self.type.array2Python(self.array, self.initial, self.value, written)
+        else:
+            self.type.ctype2Python(self.transfer_value, self.value, written)
 
     def destruct(self):
         del self.transfer_value
+        self.array = self.initial = None
 
     def loadSubscript(self, cge, container, idx):
         p = cge.builder.gep(container.translate(cge),
@@ -1412,7 +1783,7 @@ def wrapValue(value):
         return Const(value)
     elif type_ == np.ndarray:
         return NumpyArray(value)
-    elif type_ == list:
+    elif type_ in (list, SoAList):
         return List.fromObj(value)
     else:
         return Struct.fromObj(value)
@@ -1462,14 +1833,3 @@ class Cast(Typable):
     def __str__(self):
         return self.name
 
-
-def destruct():
-    global _stella_values_
-    for value in _stella_values_:
-        value.destruct()
-    _stella_values_ = []
-    FunctionType.destruct()
-    StructType.destruct()
-    ListType.destruct()
-    CType.destruct()
-    List.destructList()
@@ -11,11 +11,61 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import contextlib
 import logging
+import threading
+import time
 
 # log level value for logging
 VERBOSE = 25
 
+# LLVM does not allow several threads to parse, link, optimize or emit code
+# at the same time, or to share a target machine. All calls into LLVM which
+# may run while another thread compiles hold this lock.
+llvm_lock = threading.RLock()
+
+
+# Statistics are collected in a dict with the durations of the phases in
+# nanoseconds under 'time_ns', and counts under 'counts'. See wrap(stats=...).
+
+if hasattr(time, 'perf_counter_ns'):
+    clock_ns = time.perf_counter_ns
+else:
+    # Python < 3.7
+    def clock_ns():
+        return int(time.perf_counter() * 1e9)
+
+
+def array_alignment(array):
+    """The alignment of the elements of the numpy array in bytes: their size,
+    unless the data or the strides are less aligned, e.g. in a packed
+    structured array."""
+    align = array.itemsize
+    for n in [array.ctypes.data] + list(array.strides):
+        if n:
+            align = min(align, n & -n)
+    return align
+
+
+def add_time(stats, phase, ns):
+    times = stats.setdefault('time_ns', {})
+    times[phase] = times.get(phase, 0) + ns
+
+
+@contextlib.contextmanager
+def timed(stats, phase):
+    """Add the time spent in the with block to phase."""
+    start = clock_ns()
+    try:
+        yield
+    finally:
+        add_time(stats, phase, clock_ns() - start)
+
+
+def count(stats, name, n=1):
+    counts = stats.setdefault('counts', {})
+    counts[name] = counts.get(name, 0) + n
+
 
 class Stack(object):
     backend = None